@@ -0,0 +1,374 @@
+import asyncio
+import base64
+import functools
+import ssl
+import time
+import traceback
+
+import pop_client as pop
+import smtp_client as smtp
+import tls_context
+from logger import FileLogger
+from message_index import MessageIndex
+from metrics import registry as metrics
+
+"""
+Асинхронные (asyncio) версии POP3 и SMTP клиентов.
+Разбор ответов, шаги POP3 сессии, запись писем и формирование текста письма общие
+с блокирующими клиентами (pop_client.POPSession, pop_client.MessageFileWriter,
+smtp_client.check_reply, smtp_client.format_letter), отличается только транспорт. Один поток с циклом событий
+может вести сотни сессий одновременно, у каждой сетевой операции свой таймаут,
+а сессию можно отменить через asyncio.Task.cancel().
+"""
+
+# максимальная длина строки ответа сервера для StreamReader
+line_limit = 1024 * 1024
+
+
+async def start_tls(writer, server_host, server_port, timeout):
+    """
+    Включить TLS на открытом соединении с общим для сервера контекстом из tls_context.
+    asyncio не умеет предлагать сохраненную сессию, поэтому возобновление возможно
+    только на стороне блокирующих клиентов, но время рукопожатия попадает в общую статистику
+    """
+    context = tls_context.contexts.context(server_host, server_port)
+    start = time.perf_counter()
+    await asyncio.wait_for(writer.start_tls(context, server_hostname=server_host), timeout)
+    ssl_object = writer.get_extra_info('ssl_object')
+    tls_context.contexts.record(server_host, server_port, time.perf_counter() - start, ssl_object.session_reused)
+
+
+class AsyncPOPClient:
+    """
+    Асинхронный POP3 клиент. Шаги сессии (скачивание с удалением или leave_on_server, политика
+    хранения, headers_only, журнал синхронизации) - общие с POPClient (pop_client.POPSession),
+    клиент только выполняет их операции: сетевые - в цикле событий, блокирующую работу
+    с хранилищем и индексом - в пуле потоков.
+    Атрибуты класса:
+    server_host, server_port - адрес и порт сервера;
+    login, password - учетные данные;
+    pipeline_window, leave_on_server, delete_after_days, server_quota, headers_only - как у POPClient;
+    timeout - таймаут одной сетевой операции в секундах;
+    last_error, downloaded, expected, on_message, cancel_event - как у POPClient
+    """
+    messages_dir = pop.POPClient.messages_dir
+    state_dir = pop.POPClient.state_dir
+
+    def __init__(self, server_host, server_port, login, password, pipeline_window=32,
+                 leave_on_server=False, delete_after_days=None, server_quota=None, headers_only=False,
+                 timeout=10, use_tls=None):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.login = login
+        self.password = password
+        self.pipeline_window = pipeline_window
+        self.leave_on_server = leave_on_server or headers_only
+        self.headers_only = headers_only
+        self.delete_after_days = delete_after_days
+        self.server_quota = server_quota
+        self.timeout = timeout
+        self.capabilities = set()
+        self.last_error = None
+        self.downloaded = 0
+        self.expected = 0
+        self.on_message = None
+        self.cancel_event = None
+        self.use_tls = (self.server_port == 995) if use_tls is None else use_tls
+        self.__logfile = FileLogger(pop.log_filename)
+        self.__reader = None
+        self.__writer = None
+        self.__bytes_in = 0
+        self.__bytes_out = 0
+        self.__trace = None
+
+    async def __create_connection(self):
+        """
+        Подключение к серверу и получение приветствия
+        """
+        start = time.perf_counter()
+        self.__reader, self.__writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server_host, self.server_port, limit=line_limit), self.timeout)
+        metrics.observe_phase('pop3', 'connect', time.perf_counter() - start, self.__trace)
+        if self.use_tls:
+            await start_tls(self.__writer, self.server_host, self.server_port, self.timeout)
+        self.__logfile.write_log(f"Successfully connected to {self.server_host}:{self.server_port}")
+        await self.__recv()
+
+    async def __readline(self):
+        line = await asyncio.wait_for(self.__reader.readline(), self.timeout)
+        if not line:
+            raise pop.POPClientException("Connection closed by server")
+        self.__bytes_in += len(line)
+        return line
+
+    async def __recv(self):
+        server_response = (await self.__readline()).decode('utf-8', errors='replace')
+        self.__logfile.write_log(f"Server: {server_response}".rstrip(), "DEBUG")
+        return server_response
+
+    async def __send_many(self, commands):
+        for command in commands:
+            self.__logfile.write_log(f"Client: {command}", "DEBUG")
+        data = ''.join(command + "\r\n" for command in commands).encode()
+        self.__bytes_out += len(data)
+        self.__writer.write(data)
+        await asyncio.wait_for(self.__writer.drain(), self.timeout)
+
+    async def __drive(self, steps):
+        """
+        Выполнить шаги pop_client.POPSession: сетевые операции ожидаются в цикле событий,
+        операции call (сжатие, fsync, sqlite) выполняются в пуле потоков. Ошибка операции,
+        в том числе отмена задачи, передается в генератор, чтобы сработали его finally;
+        отмена во время call передается после завершения call
+
+        :param steps: генератор операций
+        :return: результат генератора
+        """
+        loop = asyncio.get_running_loop()
+        result, error = None, None
+        deferred = None
+        while True:
+            try:
+                operation = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            result, error = None, None
+            if deferred is not None:
+                error, deferred = deferred, None
+                continue
+            try:
+                kind = operation[0]
+                if kind == 'recv':
+                    result = await self.__recv()
+                elif kind == 'send':
+                    await self.__send_many(operation[1])
+                elif kind == 'read_body':
+                    writer = operation[1]
+                    while writer.feed(await self.__readline()):
+                        pass
+                else:
+                    future = loop.run_in_executor(None, functools.partial(*operation[1:]))
+                    try:
+                        result = await asyncio.shield(future)
+                    except asyncio.CancelledError as e:
+                        # работа в потоке все равно завершится (например, письмо будет записано):
+                        # ее результат передается в генератор, а отмена - на следующей операции
+                        result = await future
+                        deferred = e
+            except BaseException as e:
+                error = e
+
+    def cancelled(self):
+        """
+        Запрошена ли отмена сессии между письмами (cancel_event); задачу можно и просто отменить
+        """
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    async def __run_session(self, action):
+        """
+        Провести одну POP3 сессию: подключиться, выполнить шаги action в pop_client.POPSession и выйти
+
+        :param action: функция (POPSession) -> генератор операций шагов сессии
+        :return: результат action или 1, если произошла ошибка
+        """
+        loop = asyncio.get_running_loop()
+        index = await loop.run_in_executor(None, MessageIndex, self.messages_dir)
+        self.last_error = None
+        self.downloaded = 0
+        self.__trace = metrics.start_trace('pop3', f"{self.server_host}:{self.server_port}")
+        session_start = time.perf_counter()
+        try:
+            await self.__create_connection()
+            session = pop.POPSession(self, index, self.__logfile, self.__trace)
+            result = await self.__drive(session.run(action(session)))
+            await self.close()
+            # место удаленных писем освобождается после сессии
+            await loop.run_in_executor(None, index.store.maybe_compact)
+            return result
+        except pop.POPClientException as e:
+            self.__logfile.write_log(f"POPClientException: {e}", msg_type="ERROR")
+            self.last_error = e
+            await self.close()
+            return 1
+        except asyncio.TimeoutError as e:
+            self.__logfile.write_log("POP3 command timeout", msg_type="ERROR")
+            self.last_error = e
+            await self.close()
+            return 1
+        except asyncio.CancelledError as e:
+            self.__logfile.write_log("POP3 session cancelled", msg_type="ERROR")
+            self.last_error = e
+            await self.close()
+            raise
+        except Exception as e:
+            self.__logfile.write_log(f"Unexpected exception: {e}", msg_type="ERROR")
+            self.last_error = e
+            print(traceback.format_exc())
+            await self.close()
+            raise
+        finally:
+            await loop.run_in_executor(None, index.close)
+            metrics.observe_phase('pop3', 'session', time.perf_counter() - session_start, self.__trace)
+            if self.last_error is not None:
+                metrics.count_error('pop3', type(self.last_error).__name__)
+            metrics.finish_trace(self.__trace, self.last_error)
+            self.__trace = None
+
+    async def get_messages(self):
+        """
+        Скачать письма из ящика так же, как POPClient.get_messages
+
+        :return: количество писем в ящике или 1, если произошла ошибка
+        """
+        return await self.__run_session(lambda session: session.download())
+
+    async def fetch_bodies(self, msg_files=None):
+        """
+        Докачать тела писем, от которых при синхронизации были скачаны только заголовки
+
+        :return: количество докачанных писем или 1, если произошла ошибка
+        """
+        return await self.__run_session(lambda session: session.fetch_bodies(msg_files))
+
+    async def retrieve_message(self, msg_id, msg_size):
+        """
+        Скачать одно письмо командой RETR в хранилище писем (в отдельной сессии)
+
+        :return: ключ письма в хранилище или 1, если произошла ошибка
+        """
+        return await self.__run_session(lambda session: session.retrieve(msg_id, msg_size))
+
+    async def close(self):
+        """
+        Метод закрытия соединения и файлов
+        """
+        if self.__writer is not None:
+            self.__logfile.write_log("Connection closed\n___________________\n\n\n")
+            metrics.add_bytes('pop3', self.__bytes_in, self.__bytes_out)
+            self.__bytes_in = self.__bytes_out = 0
+            self.__writer.close()
+            try:
+                await self.__writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+            self.__writer = None
+        self.__logfile.close()
+
+
+class AsyncSMTPClient:
+    """
+    Асинхронный SMTP клиент.
+    Атрибуты класса:
+    server_host, server_port - адрес и порт сервера;
+    login, password - учетные данные;
+    timeout - таймаут одной сетевой операции в секундах
+    """
+
+    def __init__(self, server_host, server_port, login, password, timeout=10):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.login = login
+        self.password = password
+        self.timeout = timeout
+        # использовать шифрование или нет определяется по порту
+        self.use_tls = True if self.server_port in (465, 587) else False
+        self.capabilities = smtp.Capabilities()
+        self.__logfile = FileLogger(smtp.log_filename)
+        self.__reader = None
+        self.__writer = None
+
+    async def __recv_reply(self):
+        """
+        Прочитать ответ сервера целиком, включая строки продолжения ("250-...")
+        """
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.__reader.readline(), self.timeout)
+            if not line:
+                raise smtp.SMTPClientException("Connection closed by server")
+            line = line.decode('utf-8', errors='replace')
+            lines.append(line)
+            if line[3:4] != '-':
+                break
+        server_response = ''.join(lines)
+        self.__logfile.write_log(f"Server: {server_response}", "DEBUG")
+        return server_response
+
+    async def __send_cmd(self, command, no_response=False):
+        self.__logfile.write_log(f"Client: {command}", "DEBUG")
+        self.__writer.write((command + "\r\n").encode())
+        await asyncio.wait_for(self.__writer.drain(), self.timeout)
+        if no_response:
+            return
+        server_response = await self.__recv_reply()
+        smtp.check_reply(command, server_response)
+        return server_response
+
+    async def send_letter(self, sender, recipients, subj, msg):
+        """
+        Метод отправки письма
+
+        :param sender: отправитель
+        :param recipients: получатели (список)
+        :param subj: тема письма
+        :param msg: тело письма
+        :return: 0, если письмо успешно отправлено и 1, если произошла ошибка и письмо не было отправлено
+        """
+        try:
+            self.__reader, self.__writer = await asyncio.wait_for(
+                asyncio.open_connection(self.server_host, self.server_port, limit=line_limit), self.timeout)
+            self.__logfile.write_log(f"Successfully connected to {self.server_host}:{self.server_port}")
+            await self.__recv_reply()
+            self.capabilities = smtp.parse_ehlo_reply(await self.__send_cmd("EHLO localhost"))
+
+            if self.use_tls is True:
+                await self.__send_cmd("STARTTLS")
+                await start_tls(self.__writer, self.server_host, self.server_port, self.timeout)
+                self.capabilities = smtp.parse_ehlo_reply(await self.__send_cmd("EHLO localhost"))
+
+                await self.__send_cmd("AUTH LOGIN")
+                await self.__send_cmd(base64.b64encode(self.login.encode()).decode())
+                await self.__send_cmd(base64.b64encode(self.password.encode()).decode())
+            smtp.capability_cache.put(self.server_host, self.server_port, self.capabilities)
+
+            await self.__send_cmd(f"MAIL FROM:{sender}")
+            for recipient in ([recipients] if isinstance(recipients, str) else recipients):
+                await self.__send_cmd(f"RCPT TO:{recipient}")
+            await self.__send_cmd("DATA")
+            await self.__send_cmd(smtp.format_letter(sender, recipients, subj, msg))
+            await self.__send_cmd("QUIT")
+            self.__logfile.write_log("Letter was sent successfully!")
+
+            await self.close()
+            return 0
+        except smtp.SMTPClientException as e:
+            self.__logfile.write_log(f"SMTPClientException: {e}", msg_type="ERROR")
+            await self.close()
+            return 1
+        except asyncio.TimeoutError:
+            self.__logfile.write_log("SMTP command timeout", msg_type="ERROR")
+            await self.close()
+            return 1
+        except asyncio.CancelledError:
+            self.__logfile.write_log("SMTP session cancelled", msg_type="ERROR")
+            await self.close()
+            raise
+        except Exception as e:
+            self.__logfile.write_log(f"Unexpected exception: {e}", msg_type="ERROR")
+            print(traceback.format_exc())
+            await self.close()
+            raise
+
+    async def close(self):
+        """
+        Метод закрытия соединения и файлов
+        """
+        if self.__writer is not None:
+            self.__logfile.write_log("Connection closed\n___________________\n\n\n")
+            self.__writer.close()
+            try:
+                await self.__writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+            self.__writer = None
+        self.__logfile.close()
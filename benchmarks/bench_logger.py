@@ -0,0 +1,52 @@
+"""
+Бенчмарк журнала FileLogger: сколько строк протокола в секунду успевают записать
+несколько клиентов, пишущих в один файл (вывод на экран отключен).
+
+Запуск из корня репозитория:
+python -m benchmarks.bench_logger --lines 200000 --threads 4
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import logger
+from logger import FileLogger
+
+
+def run_once(path, lines, threads, level):
+    logger.configure(console=False, level=level)
+    per_thread = lines // threads
+
+    def client():
+        logfile = FileLogger(path)
+        for n in range(per_thread):
+            logfile.write_log(f"Client: RETR {n}", "DEBUG")
+            logfile.write_log("Server: +OK 1024 octets", "DEBUG")
+        logfile.close()
+
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return per_thread * threads * 2 / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FileLogger benchmark")
+    parser.add_argument('--lines', type=int, default=200000, help="пар строк протокола всего")
+    parser.add_argument('--threads', type=int, default=4, help="количество клиентов")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'bench.log')
+        for level in ('DEBUG', 'INFO'):
+            rate = run_once(path, args.lines, args.threads, level)
+            print(f"level {level:<5} {rate:12.0f} lines/s  (log size {os.path.getsize(path)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
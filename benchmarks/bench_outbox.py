@@ -0,0 +1,70 @@
+"""
+Бенчмарк движка доставки исходящей очереди (outbox.DeliveryEngine).
+Ставит в очередь пачку писем с получателями в нескольких доменах и разбирает ее
+пулом потоков разного размера на локальном тестовом сервере с искусственной задержкой.
+
+Запуск из корня репозитория:
+python -m benchmarks.bench_outbox --letters 200 --domains 3 --latency 0.01 --workers 1 2 4 8
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import smtp_client as smtp
+from benchmarks.fake_smtp import FakeSMTPServer
+from outbox import DeliveryEngine, Outbox
+
+
+def run_once(letters, domains, latency, workers, rate_limit):
+    """
+    Разобрать очередь из letters писем пулом из workers потоков
+
+    :return: скорость в транзакциях в секунду и количество принятых сервером транзакций
+    """
+    server = FakeSMTPServer(latency=latency).start()
+    outbox = Outbox(spool_dir=tempfile.mkdtemp(prefix='outbox-', dir='.'))
+    for n in range(letters):
+        outbox.enqueue('bench@example.com', [f"user{n}@domain{d}.example" for d in range(domains)],
+                       f"Benchmark letter {n}", "Hello!\n" * 20)
+    # порт без STARTTLS и авторизации
+    engine = DeliveryEngine(outbox, lambda: smtp.SMTPClient(server.host, server.port, 'user', 'password'),
+                            workers=workers, rate_limit=rate_limit)
+    start = time.perf_counter()
+    # клиент подробно печатает протокол, для замера вывод не нужен
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine.start()
+        engine.wait_idle()
+        elapsed = time.perf_counter() - start
+        engine.stop()
+    outbox.close()
+    server.stop()
+    return letters * domains / elapsed, len(server.received)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Outbox delivery engine benchmark")
+    parser.add_argument('--letters', type=int, default=200, help="количество писем")
+    parser.add_argument('--domains', type=int, default=3, help="доменов получателей в одном письме")
+    parser.add_argument('--latency', type=float, default=0.01, help="задержка ответа сервера, с")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help="размеры пула потоков")
+    parser.add_argument('--rate-limit', type=float, default=None, help="транзакций в секунду на поток")
+    args = parser.parse_args()
+
+    print(f"{args.letters} letters x {args.domains} domains, latency {args.latency * 1000:.0f} ms")
+    with tempfile.TemporaryDirectory() as work_dir:
+        # журнал smtp_3.log и каталоги очереди создаются в текущем каталоге
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            for workers in args.workers:
+                rate, received = run_once(args.letters, args.domains, args.latency, workers, args.rate_limit)
+                print(f"{workers:>3} workers {rate:10.2f} transactions/s  ({received} accepted)")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
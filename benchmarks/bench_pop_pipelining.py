@@ -0,0 +1,67 @@
+"""
+Бенчмарк конвейерного режима POP3 (RFC 2449, PIPELINING).
+Сравнивает скорость скачивания писем в пошаговом и конвейерном режимах
+на локальном тестовом сервере с искусственной задержкой.
+
+Запуск из корня репозитория:
+python -m benchmarks.bench_pop_pipelining --messages 200 --latency 0.02 --window 1 8 32
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import logger
+import pop_client as pop
+from benchmarks.fake_pop3 import FakePOP3Server, make_message
+
+
+def run_once(messages, latency, window):
+    """
+    Один прогон get_messages
+
+    :return: скорость в письмах в секунду
+    """
+    server = FakePOP3Server(messages, latency=latency, pipelining=True).start()
+    with tempfile.TemporaryDirectory() as work_dir:
+        client = pop.POPClient(server.host, server.port, 'user', 'password', pipeline_window=window)
+        client.messages_dir = os.path.join(work_dir, '')
+        # состояние и журнал синхронизации свои у каждого прогона
+        client.state_dir = client.messages_dir
+        start = time.perf_counter()
+        # клиент подробно печатает протокол, для замера вывод не нужен
+        with contextlib.redirect_stdout(io.StringIO()):
+            client.get_messages()
+        elapsed = time.perf_counter() - start
+    server.stop()
+    return len(messages) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="POP3 pipelining benchmark")
+    parser.add_argument('--messages', type=int, default=200, help="количество писем в ящике")
+    parser.add_argument('--size', type=int, default=4096, help="размер письма в байтах")
+    parser.add_argument('--latency', type=float, default=0.02, help="задержка ответа сервера, с")
+    parser.add_argument('--window', type=int, nargs='+', default=[1, 8, 32], help="размеры окна")
+    args = parser.parse_args()
+
+    messages = [make_message(i, args.size) for i in range(args.messages)]
+    print(f"{args.messages} messages x {args.size} bytes, latency {args.latency * 1000:.0f} ms")
+    with tempfile.TemporaryDirectory() as log_dir:
+        # журнал pop_3.log пишется в текущий каталог
+        cwd = os.getcwd()
+        os.chdir(log_dir)
+        try:
+            for window in args.window:
+                mode = "lock-step" if window <= 1 else "pipelined"
+                rate = run_once(messages, args.latency, window)
+                print(f"window={window:<4} {mode:<10} {rate:10.1f} msg/s")
+        finally:
+            os.chdir(cwd)
+            logger.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Бенчмарк конвейерной передачи конверта письма (RFC 2920, PIPELINING).
+Сравнивает пошаговую и конвейерную отправку MAIL FROM / RCPT TO / DATA
+на локальном тестовом сервере с искусственной задержкой.
+
+Запуск из корня репозитория:
+python -m benchmarks.bench_smtp_pipelining --letters 20 --recipients 50 --latency 0.01
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import smtp_client as smtp
+from benchmarks.fake_smtp import FakeSMTPServer
+
+
+def run_once(letters, recipients, latency, pipelining):
+    """
+    Отправить пачку писем в одной сессии
+
+    :return: скорость в письмах в секунду и количество принятых сервером писем
+    """
+    server = FakeSMTPServer(latency=latency, pipelining=True).start()
+    # порт 25: без STARTTLS и авторизации
+    client = smtp.SMTPClient(server.host, server.port, 'user', 'password', pipelining=pipelining)
+    batch = [{'sender': 'bench@example.com',
+              'recipients': [f"user{i}@example.com" for i in range(recipients)],
+              'subj': f"Benchmark letter {n}",
+              'msg': "Hello!\n" * 20} for n in range(letters)]
+    start = time.perf_counter()
+    # клиент подробно печатает протокол, для замера вывод не нужен
+    with contextlib.redirect_stdout(io.StringIO()):
+        client.send_many(batch)
+    elapsed = time.perf_counter() - start
+    client.close()
+    server.stop()
+    return letters / elapsed, len(server.received)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SMTP pipelining benchmark")
+    parser.add_argument('--letters', type=int, default=20, help="количество писем")
+    parser.add_argument('--recipients', type=int, default=50, help="получателей в одном письме")
+    parser.add_argument('--latency', type=float, default=0.01, help="задержка ответа сервера, с")
+    args = parser.parse_args()
+
+    print(f"{args.letters} letters x {args.recipients} recipients, latency {args.latency * 1000:.0f} ms")
+    with tempfile.TemporaryDirectory() as work_dir:
+        # журнал smtp_3.log пишется в текущий каталог
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            for pipelining in (False, True):
+                rate, received = run_once(args.letters, args.recipients, args.latency, pipelining)
+                mode = "pipelined" if pipelining else "lock-step"
+                print(f"{mode:<10} {rate:10.2f} letters/s  ({received} accepted)")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Бенчмарк потоковой отправки письма с большим вложением.
+Сравнивает передачу через DATA (с dot-stuffing) и через BDAT (CHUNKING, RFC 3030):
+скорость и пиковую память процесса (tracemalloc), которая не должна зависеть от размера вложения.
+
+Запуск из корня репозитория:
+python -m benchmarks.bench_smtp_streaming --size 200 --latency 0.01
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+
+import smtp_client as smtp
+from benchmarks.fake_smtp import FakeSMTPServer
+
+
+def make_attachment(path, size_mb):
+    with open(path, 'wb') as attachment:
+        for _ in range(size_mb):
+            attachment.write(os.urandom(1024 * 1024))
+
+
+def run_once(attachment_path, latency, chunking):
+    """
+    Отправить одно письмо с вложением
+
+    :return: скорость в МБ/с исходных данных, пик памяти в байтах, размер принятого письма
+    """
+    # письмо с вложением в base64 больше вложения примерно на треть; клиент не отправляет письмо
+    # больше объявленного сервером SIZE, поэтому предел берется с запасом
+    size_limit = 2 * os.path.getsize(attachment_path) + 2 ** 20
+    server = FakeSMTPServer(latency=latency, chunking=chunking, keep_data=False, size_limit=size_limit).start()
+    client = smtp.SMTPClient(server.host, server.port, 'user', 'password')
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = client.send_letter('bench@example.com', ['user@example.com'], "Large attachment",
+                                    "See the attachment.\n", attachments=[attachment_path])
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    client.close()
+    server.stop()
+    if result != 0:
+        raise RuntimeError(f"Letter wasn't sent: {client.last_error}")
+    return os.path.getsize(attachment_path) / elapsed / 1024 / 1024, peak, server.received[0]['size']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SMTP streaming attachment benchmark")
+    parser.add_argument('--size', type=int, default=200, help="размер вложения, МБ")
+    parser.add_argument('--latency', type=float, default=0.01, help="задержка ответа сервера, с")
+    args = parser.parse_args()
+
+    print(f"Attachment {args.size} MB, latency {args.latency * 1000:.0f} ms")
+    with tempfile.TemporaryDirectory() as work_dir:
+        # журнал smtp_3.log пишется в текущий каталог
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            make_attachment('attachment.bin', args.size)
+            for chunking in (False, True):
+                rate, peak, size = run_once('attachment.bin', args.latency, chunking)
+                mode = "BDAT" if chunking else "DATA"
+                print(f"{mode:<5} {rate:8.1f} MB/s  peak memory {peak / 1024:8.0f} KB  ({size} bytes accepted)")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
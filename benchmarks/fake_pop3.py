@@ -0,0 +1,149 @@
+"""
+Локальный тестовый POP3 сервер для бенчмарков.
+Хранит почтовый ящик в памяти и умеет искусственно задерживать ответы
+и ограничивать скорость, чтобы имитировать медленный канал, и работать по TLS.
+Содержимое ящика генерируется с заданным распределением размеров писем.
+"""
+import math
+import random
+
+from benchmarks.fake_server import FakeServer
+
+
+def size_sampler(spec, seed=0):
+    """
+    Генератор размеров писем по описанию распределения:
+    "fixed:4096" - все одного размера;
+    "uniform:1024:65536" - равномерно в диапазоне;
+    "lognormal:16384:1.5" - логнормальное с медианой 16384 байт и параметром sigma
+        (много мелких писем и редкие крупные, как в настоящем ящике);
+    "mix:4096:2097152:0.05" - доля крупных писем (с вложениями) среди мелких
+
+    :return: функция без аргументов, возвращающая очередной размер в байтах
+    """
+    kind, *args = spec.split(':')
+    args = [float(arg) for arg in args]
+    rng = random.Random(seed)
+    if kind == 'fixed':
+        return lambda: int(args[0])
+    if kind == 'uniform':
+        return lambda: rng.randint(int(args[0]), int(args[1]))
+    if kind == 'lognormal':
+        return lambda: max(256, int(rng.lognormvariate(math.log(args[0]), args[1])))
+    if kind == 'mix':
+        return lambda: int(args[1]) if rng.random() < args[2] else int(args[0])
+    raise ValueError(f"Unknown size distribution: {spec}")
+
+
+def make_message(number, body_size):
+    """
+    Сгенерировать простое письмо заданного размера
+
+    :param number: порядковый номер письма (попадает в Message-ID и тему)
+    :param body_size: примерный размер тела письма в байтах
+    :return: письмо в байтах с CRLF окончаниями строк
+    """
+    line = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit.\r\n"
+    body = line * max(1, body_size // len(line))
+    headers = (f"From: sender{number}@example.com\r\n"
+               f"To: user@example.com\r\n"
+               f"Subject: Test message {number}\r\n"
+               f"Date: Mon, 21 Nov 2022 00:08:33 +0700\r\n"
+               f"Message-ID: <{number}.bench@example.com>\r\n"
+               f"\r\n").encode()
+    return headers + body
+
+
+def make_mailbox(count, sizes='fixed:4096', seed=0):
+    """
+    Сгенерировать содержимое ящика
+
+    :param count: количество писем
+    :param sizes: описание распределения размеров (см. size_sampler)
+    :return: список писем в байтах
+    """
+    next_size = size_sampler(sizes, seed)
+    return [make_message(number, next_size()) for number in range(count)]
+
+
+def dot_stuff(message):
+    """
+    Подготовить письмо к передаче в многострочном ответе: dot-stuffing и терминатор
+    """
+    lines = message.split(b"\r\n")
+    if lines and lines[-1] == b'':
+        lines.pop()
+    stuffed = [b"." + line if line[:1] == b"." else line for line in lines]
+    return b"\r\n".join(stuffed) + b"\r\n.\r\n"
+
+
+class FakePOP3Server(FakeServer):
+    """
+    Класс тестового POP3 сервера.
+    Атрибуты класса:
+    messages - список писем (байты) в ящике;
+    latency - задержка ответа на каждую команду в секундах (имитация RTT);
+    pipelining - объявлять ли расширение PIPELINING в ответе на CAPA;
+    bandwidth, tls_context - см. FakeServer (TLS - неявный, с начала сессии)
+    """
+
+    def __init__(self, messages, latency=0.0, pipelining=True, host='127.0.0.1', port=0, bandwidth=None,
+                 tls_context=None):
+        super().__init__(latency, host, port, bandwidth, tls_context)
+        self.messages = list(messages)
+        self.pipelining = pipelining
+
+    def handle_session(self, client_sock, reader, replies):
+        if self.tls_context is not None:
+            client_sock, reader = self.start_tls(client_sock, reader, replies)
+        try:
+            self.__handle_commands(client_sock, reader, replies.schedule)
+        finally:
+            reader.close()
+
+    def __handle_commands(self, client_sock, reader, schedule):
+        deleted = set()
+        # приветствие отправляется без задержки
+        client_sock.sendall(b"+OK fake POP3 server ready\r\n")
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            command, _, arg = line.decode().strip().partition(' ')
+            command = command.upper()
+            if command in ('USER', 'PASS', 'NOOP', 'RSET'):
+                schedule(b"+OK\r\n")
+            elif command == 'CAPA':
+                capabilities = b"USER\r\nUIDL\r\nTOP\r\n"
+                if self.pipelining:
+                    capabilities += b"PIPELINING\r\n"
+                schedule(b"+OK Capability list follows\r\n" + capabilities + b".\r\n")
+            elif command == 'STAT':
+                schedule(f"+OK {len(self.messages)} {sum(map(len, self.messages))}\r\n".encode())
+            elif command == 'LIST':
+                listing = b"".join(f"{i} {len(msg)}\r\n".encode() for i, msg in enumerate(self.messages, 1)
+                                   if i not in deleted)
+                schedule(f"+OK {len(self.messages)} {sum(map(len, self.messages))}\r\n".encode()
+                         + listing + b".\r\n")
+            elif command == 'RETR':
+                msg = self.messages[int(arg) - 1]
+                schedule(f"+OK {len(msg)} octets\r\n".encode() + dot_stuff(msg))
+            elif command == 'UIDL':
+                listing = b"".join(f"{i} {i}.bench\r\n".encode() for i in range(1, len(self.messages) + 1)
+                                   if i not in deleted)
+                schedule(b"+OK\r\n" + listing + b".\r\n")
+            elif command == 'TOP':
+                number, _, lines = arg.partition(' ')
+                msg = self.messages[int(number) - 1]
+                headers, _, body = msg.partition(b"\r\n\r\n")
+                body_lines = body.split(b"\r\n")[:int(lines or 0)]
+                top = headers + b"\r\n\r\n" + b"".join(line + b"\r\n" for line in body_lines)
+                schedule(b"+OK top of message follows\r\n" + dot_stuff(top))
+            elif command == 'DELE':
+                deleted.add(int(arg))
+                schedule(f"+OK message {arg} deleted\r\n".encode())
+            elif command == 'QUIT':
+                schedule(b"+OK bye\r\n", closing=True)
+                break
+            else:
+                schedule(b"-ERR unknown command\r\n")
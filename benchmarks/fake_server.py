@@ -0,0 +1,204 @@
+"""
+Основа локальных тестовых серверов для бенчмарков: прием подключений
+и отправка ответов с искусственной задержкой и ограничением пропускной способности,
+TLS с самоподписанным сертификатом.
+"""
+import heapq
+import itertools
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import threading
+import time
+
+
+def make_self_signed_cert(work_dir, host='localhost'):
+    """
+    Создать самоподписанный сертификат для localhost и 127.0.0.1 утилитой openssl
+
+    :param work_dir: каталог для файлов сертификата и ключа
+    :return: пути (сертификат, ключ); сертификат же служит корневым для клиента (cafile)
+    """
+    openssl = os.environ.get('OPENSSL') or shutil.which('openssl')
+    if openssl is None:
+        raise RuntimeError("openssl is required to create a test certificate (set OPENSSL=/path/to/openssl)")
+    cert_file = os.path.join(work_dir, 'bench_cert.pem')
+    key_file = os.path.join(work_dir, 'bench_key.pem')
+    subprocess.run([openssl, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-keyout', key_file, '-out', cert_file, '-subj', f'/CN={host}',
+                    '-addext', f'subjectAltName=DNS:{host},IP:127.0.0.1'],
+                   check=True, capture_output=True)
+    return cert_file, key_file
+
+
+def server_tls_context(cert_file, key_file):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+class Throttle:
+    """
+    Класс ограничителя скорости передачи одного направления сессии.
+    consume() засыпает так, чтобы средняя скорость с начала сессии не превышала bandwidth байт в секунду
+    """
+
+    def __init__(self, bandwidth=None):
+        self.bandwidth = bandwidth
+        self.__start = time.monotonic()
+        self.__sent = 0
+
+    def consume(self, size):
+        if not self.bandwidth:
+            return
+        self.__sent += size
+        delay = self.__start + self.__sent / self.bandwidth - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class DelayedReplies:
+    """
+    Класс очереди ответов одной сессии. Ответ отправляется отдельным потоком
+    не раньше, чем через latency секунд после приема команды. Так конвейерные
+    команды «летят» одновременно, как в реальной сети с задержкой.
+    """
+
+    # большие ответы при ограничении скорости отправляются частями такого размера
+    slice_size = 16 * 1024
+
+    def __init__(self, client_sock, latency, bandwidth=None):
+        self.client_sock = client_sock
+        self.latency = latency
+        self.throttle = Throttle(bandwidth)
+        self.__replies = []
+        self.__order = itertools.count()
+        self.__sending = False
+        self.__condition = threading.Condition()
+        threading.Thread(target=self.__writer, daemon=True).start()
+
+    def schedule(self, data, closing=False):
+        """
+        Поставить ответ в очередь
+
+        :param data: байты ответа
+        :param closing: закрыть соединение после отправки
+        """
+        with self.__condition:
+            heapq.heappush(self.__replies, (time.monotonic() + self.latency, next(self.__order), data, closing))
+            self.__condition.notify()
+
+    def drain(self):
+        """
+        Дождаться отправки всех ответов из очереди (перед STARTTLS)
+        """
+        with self.__condition:
+            while self.__replies or self.__sending:
+                self.__condition.wait(0.01)
+
+    def __send(self, data):
+        if not self.throttle.bandwidth:
+            self.client_sock.sendall(data)
+            return
+        for offset in range(0, len(data), self.slice_size):
+            piece = data[offset:offset + self.slice_size]
+            self.client_sock.sendall(piece)
+            self.throttle.consume(len(piece))
+
+    def __writer(self):
+        while True:
+            with self.__condition:
+                while not self.__replies:
+                    self.__condition.wait()
+                due, _, data, closing = self.__replies[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self.__condition.wait(delay)
+                    continue
+                heapq.heappop(self.__replies)
+                self.__sending = True
+            try:
+                self.__send(data)
+            except OSError:
+                return
+            finally:
+                self.__sending = False
+            if closing:
+                self.client_sock.close()
+                return
+
+
+class FakeServer:
+    """
+    Класс тестового TCP сервера. Каждая сессия обслуживается в своем потоке
+    методом handle_session, который переопределяют наследники.
+    Атрибуты класса:
+    latency - задержка ответа на каждую команду в секундах (имитация RTT);
+    bandwidth - пропускная способность канала в байтах в секунду (None - без ограничения);
+    tls_context - серверный ssl.SSLContext: POP3 сервер работает по неявному TLS (как на порту 995),
+        SMTP сервер объявляет STARTTLS; None - без шифрования;
+    host, port - адрес, на котором слушает сервер
+    """
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0, bandwidth=None, tls_context=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.tls_context = tls_context
+        self.__server_sock = socket.socket()
+        self.__server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__server_sock.bind((host, port))
+        self.host, self.port = self.__server_sock.getsockname()
+        self.__stopped = False
+
+    def start(self):
+        self.__server_sock.listen(128)
+        threading.Thread(target=self.__accept_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.__stopped = True
+        self.__server_sock.close()
+
+    def __accept_loop(self):
+        while not self.__stopped:
+            try:
+                client_sock, _ = self.__server_sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.__session, args=(client_sock,), daemon=True).start()
+
+    def __session(self, client_sock):
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = None
+        try:
+            reader = client_sock.makefile('rb')
+            self.handle_session(client_sock, reader, DelayedReplies(client_sock, self.latency, self.bandwidth))
+        except OSError:
+            pass
+        finally:
+            if reader is not None:
+                reader.close()
+
+    def start_tls(self, client_sock, reader, replies):
+        """
+        Перевести сессию на TLS (неявный TLS в начале сессии или после STARTTLS)
+
+        :return: TLS сокет и новый поток для чтения команд
+        """
+        replies.drain()
+        reader.close()
+        tls_sock = self.tls_context.wrap_socket(client_sock, server_side=True)
+        replies.client_sock = tls_sock
+        return tls_sock, tls_sock.makefile('rb')
+
+    def handle_session(self, client_sock, reader, replies):
+        """
+        Обслужить одну сессию
+
+        :param client_sock: сокет клиента (приветствие можно отправить сразу через него)
+        :param reader: буферизованный поток для чтения команд
+        :param replies: очередь ответов с задержкой
+        """
+        raise NotImplementedError
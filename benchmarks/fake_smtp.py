@@ -0,0 +1,131 @@
+"""
+Локальный тестовый SMTP сервер для бенчмарков.
+Принимает письма в память, умеет объявлять PIPELINING и CHUNKING (BDAT),
+STARTTLS с авторизацией и отклонять отдельных получателей.
+"""
+from benchmarks.fake_server import FakeServer, Throttle
+
+
+class FakeSMTPServer(FakeServer):
+    """
+    Класс тестового SMTP сервера.
+    Атрибуты класса:
+    latency - задержка ответа на каждую команду в секундах (имитация RTT);
+    pipelining - объявлять ли расширение PIPELINING в ответе на EHLO;
+    chunking - объявлять ли расширение CHUNKING и принимать BDAT;
+    reject - функция (адрес получателя) -> строка ответа с ошибкой или None;
+    keep_data - хранить ли текст писем (для больших писем достаточно размера);
+    size_limit - максимальный размер письма, объявляемый расширением SIZE (RFC 1870), в байтах;
+    bandwidth - см. FakeServer (ограничивает и прием писем);
+    tls_context - см. FakeServer: сервер объявляет STARTTLS, после него - AUTH PLAIN LOGIN
+        (клиент включает STARTTLS для портов 465 и 587 или при use_tls=True);
+    received - список принятых писем: словари с ключами sender, recipients, data, size
+    """
+
+    def __init__(self, latency=0.0, pipelining=True, reject=None, host='127.0.0.1', port=0, chunking=False,
+                 keep_data=True, bandwidth=None, tls_context=None, size_limit=50 * 2 ** 20):
+        super().__init__(latency, host, port, bandwidth, tls_context)
+        self.size_limit = size_limit
+        self.pipelining = pipelining
+        self.chunking = chunking
+        self.reject = reject or (lambda recipient: None)
+        self.keep_data = keep_data
+        self.received = []
+
+    def __accept(self, sender, recipients, data, size):
+        self.received.append({'sender': sender, 'recipients': recipients,
+                              'data': b"".join(data) if self.keep_data else None, 'size': size})
+
+    def handle_session(self, client_sock, reader, replies):
+        schedule = replies.schedule
+        # скорость приема данных письма от клиента
+        throttle = Throttle(self.bandwidth)
+        encrypted = False
+        sender = None
+        recipients = []
+        chunks, chunks_size = [], 0
+        client_sock.sendall(b"220 fake SMTP server ready\r\n")
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                extensions = [b"SIZE %d" % self.size_limit, b"8BITMIME"]
+                if self.tls_context is not None:
+                    extensions.append(b"AUTH PLAIN LOGIN" if encrypted else b"STARTTLS")
+                if self.chunking:
+                    extensions.append(b"CHUNKING")
+                if self.pipelining:
+                    extensions.append(b"PIPELINING")
+                schedule(b"250-fake.local\r\n" + b"".join(b"250-" + ext + b"\r\n" for ext in extensions[:-1])
+                         + b"250 " + extensions[-1] + b"\r\n")
+            elif command.upper() == 'STARTTLS' and self.tls_context is not None and not encrypted:
+                schedule(b"220 2.0.0 Ready to start TLS\r\n")
+                client_sock, reader = self.start_tls(client_sock, reader, replies)
+                encrypted = True
+            elif verb == 'AUTH':
+                if command.upper().startswith('AUTH LOGIN'):
+                    # логин и пароль - следующими строками в ответ на приглашения 334
+                    for prompt in (b"VXNlcm5hbWU6", b"UGFzc3dvcmQ6"):
+                        schedule(b"334 " + prompt + b"\r\n")
+                        reader.readline()
+                schedule(b"235 2.7.0 Authentication successful\r\n")
+            elif verb == 'MAIL':
+                sender = command.split(':', 1)[1]
+                recipients = []
+                schedule(b"250 2.1.0 Sender OK\r\n")
+            elif verb == 'RCPT':
+                recipient = command.split(':', 1)[1]
+                error = self.reject(recipient)
+                if error:
+                    schedule(error.encode() + b"\r\n")
+                else:
+                    recipients.append(recipient)
+                    schedule(b"250 2.1.5 Recipient OK\r\n")
+            elif verb == 'DATA':
+                if not recipients:
+                    schedule(b"554 5.5.1 No valid recipients\r\n")
+                    continue
+                schedule(b"354 Start mail input; end with <CRLF>.<CRLF>\r\n")
+                data, size = [], 0
+                while True:
+                    line = reader.readline()
+                    if not line or line == b".\r\n":
+                        break
+                    size += len(line)
+                    throttle.consume(len(line))
+                    if self.keep_data:
+                        data.append(line)
+                self.__accept(sender, recipients, data, size)
+                sender, recipients = None, []
+                schedule(b"250 2.6.0 Queued\r\n")
+            elif verb == 'BDAT' and self.chunking:
+                args = command.split()
+                chunk = reader.read(int(args[1]))
+                throttle.consume(len(chunk))
+                chunks_size += len(chunk)
+                if self.keep_data:
+                    chunks.append(chunk)
+                if not recipients:
+                    chunks, chunks_size = [], 0
+                    schedule(b"554 5.5.1 No valid recipients\r\n")
+                elif len(args) > 2 and args[2].upper() == 'LAST':
+                    self.__accept(sender, recipients, chunks, chunks_size)
+                    sender, recipients = None, []
+                    chunks, chunks_size = [], 0
+                    schedule(b"250 2.6.0 Queued\r\n")
+                else:
+                    schedule(f"250 2.0.0 {len(chunk)} octets received\r\n".encode())
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                chunks, chunks_size = [], 0
+                schedule(b"250 2.0.0 Reset\r\n")
+            elif verb == 'NOOP':
+                schedule(b"250 2.0.0 OK\r\n")
+            elif verb == 'QUIT':
+                schedule(b"221 2.0.0 Bye\r\n", closing=True)
+                break
+            else:
+                schedule(b"502 5.5.2 Command not implemented\r\n")
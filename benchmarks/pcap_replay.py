@@ -0,0 +1,594 @@
+"""
+Воспроизведение записанных сессий POP3 и SMTP из файлов pcapng (pop3_3.pcapng, smtp_3.pcapng,
+smtp_test3.pcapng) локальным сервером. Из записи выделяются TCP диалоги, серверная сторона
+диалога превращается в сценарий: какие сегменты сервер отправил в ответ на какую команду
+клиента, с какими паузами и какими порциями. Сервер воспроизведения отдает клиенту те же
+байты теми же порциями, с паузами, умноженными на time_scale (0 - без пауз), или нарезает
+ответы на порции заданного размера, чтобы проверить чтение ответов по частям.
+
+Команды клиента сопоставляются со сценарием по имени команды: команды, которых клиент не
+отправил (например, AUTH в записи с другим клиентом), пропускаются, а на команды, которых нет
+в записи, сервер отвечает ошибкой протокола (QUIT - прощанием). Шифрованная часть диалога
+(POP3S, после STARTTLS) воспроизведена быть не может: сценарий заканчивается там, где в записи
+начинается TLS, а для диалога доступна только сводка (объемы, время, RTT).
+
+Формат pcapng разбирается без внешних библиотек (блоки SHB, IDB, EPB, SPB; Ethernet с VLAN,
+Linux cooked capture, raw IP; IPv4 и IPv6; TCP), классический pcap тоже читается.
+
+Запуск из корня репозитория:
+python -m benchmarks.pcap_replay smtp_test3.pcapng                       - список диалогов
+python -m benchmarks.pcap_replay smtp_test3.pcapng --serve --port 2525   - сервер воспроизведения
+python -m benchmarks.pcap_replay smtp_test3.pcapng --run-client --repeat 200 --time-scale 0 --chunk 1
+"""
+import argparse
+import contextlib
+import io
+import os
+import socket
+import struct
+import tempfile
+import time
+
+from benchmarks.fake_server import FakeServer
+
+# типы канального уровня (LINKTYPE_*)
+linktype_ethernet = 1
+linktype_raw = 101
+linktype_linux_sll = 113
+
+pop3_ports = {110, 995}
+smtp_ports = {25, 465, 587, 2525}
+
+# ответы на команды, которых нет в записи
+fallback_replies = {
+    'pop3': {'QUIT': b"+OK bye\r\n", None: b"-ERR command is not in the capture\r\n"},
+    'smtp': {'QUIT': b"221 2.0.0 Bye\r\n", None: b"502 5.5.2 Command is not in the capture\r\n"},
+}
+
+
+def read_packets(path):
+    """
+    Прочитать пакеты из файла pcapng или pcap
+
+    :return: итератор кортежей (время в секундах, тип канального уровня, байты пакета)
+    """
+    with open(path, 'rb') as capture_file:
+        data = capture_file.read()
+    magic = data[:4]
+    if magic == b'\x0a\x0d\x0d\x0a':
+        yield from read_pcapng(data)
+    elif magic in (b'\xd4\xc3\xb2\xa1', b'\xa1\xb2\xc3\xd4', b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d'):
+        yield from read_pcap(data)
+    else:
+        raise ValueError(f"{path}: not a pcap or pcapng file")
+
+
+def read_pcap(data):
+    endian = '<' if data[:4] in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1') else '>'
+    # вторая пара сигнатур - время в наносекундах
+    resolution = 1e-9 if data[:4] in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 1e-6
+    linktype = struct.unpack_from(endian + 'I', data, 20)[0] & 0xFFFF
+    offset = 24
+    while offset + 16 <= len(data):
+        seconds, fraction, captured, _ = struct.unpack_from(endian + 'IIII', data, offset)
+        yield seconds + fraction * resolution, linktype, data[offset + 16:offset + 16 + captured]
+        offset += 16 + captured
+
+
+def read_pcapng(data):
+    """
+    Разобрать блоки pcapng. У каждого интерфейса (IDB) свой тип канального уровня
+    и своя единица времени (опция if_tsresol, по умолчанию микросекунды)
+    """
+    endian = '<'
+    interfaces = []
+    offset = 0
+    while offset + 12 <= len(data):
+        block_type = struct.unpack_from('<I', data, offset)[0]
+        if block_type == 0x0A0D0D0A:
+            # Section Header Block: порядок байт определяется по сигнатуре, интерфейсы секции заново
+            endian = '<' if data[offset + 8:offset + 12] == b'\x4d\x3c\x2b\x1a' else '>'
+            interfaces = []
+        block_type, block_length = struct.unpack_from(endian + 'II', data, offset)
+        if block_length < 12:
+            raise ValueError(f"Broken pcapng block at offset {offset}")
+        body = data[offset + 8:offset + block_length - 4]
+        offset += block_length
+
+        if block_type == 1:
+            # Interface Description Block
+            linktype = struct.unpack_from(endian + 'H', body, 0)[0]
+            interfaces.append((linktype, pcapng_resolution(body[8:], endian)))
+        elif block_type == 6:
+            # Enhanced Packet Block
+            interface, high, low, captured = struct.unpack_from(endian + 'IIII', body, 0)
+            linktype, resolution = interfaces[interface]
+            yield ((high << 32) | low) * resolution, linktype, body[20:20 + captured]
+        elif block_type == 3 and interfaces:
+            # Simple Packet Block: без времени, интерфейс всегда первый
+            linktype, _ = interfaces[0]
+            captured = min(struct.unpack_from(endian + 'I', body, 0)[0], len(body) - 4)
+            yield None, linktype, body[4:4 + captured]
+
+
+def pcapng_resolution(options, endian):
+    """
+    Единица времени интерфейса из опции if_tsresol (код 9)
+    """
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack_from(endian + 'HH', options, offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = options[offset + 4]
+            # старший бит - степень двойки, иначе степень десяти
+            return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        offset += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def parse_tcp(packet, linktype):
+    """
+    Достать TCP сегмент из кадра
+
+    :return: кортеж (адрес и порт отправителя, адрес и порт получателя, seq, флаги, данные) или None
+    """
+    if linktype == linktype_ethernet:
+        ethertype, offset = struct.unpack_from('!H', packet, 12)[0], 14
+        # метки VLAN (802.1Q, 802.1ad)
+        while ethertype in (0x8100, 0x88A8) and len(packet) >= offset + 4:
+            ethertype, offset = struct.unpack_from('!H', packet, offset + 2)[0], offset + 4
+    elif linktype == linktype_linux_sll:
+        ethertype, offset = struct.unpack_from('!H', packet, 14)[0], 16
+    elif linktype == linktype_raw:
+        ethertype, offset = (0x0800 if packet[:1] and packet[0] >> 4 == 4 else 0x86DD), 0
+    else:
+        return None
+
+    ip = packet[offset:]
+    if ethertype == 0x0800 and len(ip) >= 20:
+        header_length = (ip[0] & 0x0F) * 4
+        protocol = ip[9]
+        # нулевая длина бывает у пакетов, записанных до сегментации сетевой картой (TSO)
+        total_length = struct.unpack_from('!H', ip, 2)[0] or len(ip)
+        source = socket.inet_ntop(socket.AF_INET, ip[12:16])
+        destination = socket.inet_ntop(socket.AF_INET, ip[16:20])
+        segment = ip[header_length:total_length]
+    elif ethertype == 0x86DD and len(ip) >= 40:
+        # заголовки расширений IPv6 не разбираются: TCP должен идти сразу за основным заголовком
+        protocol = ip[6]
+        payload_length = struct.unpack_from('!H', ip, 4)[0] or len(ip) - 40
+        source = socket.inet_ntop(socket.AF_INET6, ip[8:24])
+        destination = socket.inet_ntop(socket.AF_INET6, ip[24:40])
+        segment = ip[40:40 + payload_length]
+    else:
+        return None
+    if protocol != 6 or len(segment) < 20:
+        return None
+    source_port, destination_port, seq = struct.unpack_from('!HHI', segment, 0)
+    data_offset = (segment[12] >> 4) * 4
+    flags = segment[13]
+    return (source, source_port), (destination, destination_port), seq, flags, segment[data_offset:]
+
+
+FIN, SYN, RST, ACK = 0x01, 0x02, 0x04, 0x10
+
+
+class Conversation:
+    """
+    Класс TCP диалога из записи.
+    Атрибуты класса:
+    client, server - (адрес, порт) сторон: клиент - тот, кто отправил SYN;
+    protocol - 'pop3', 'smtp' или None (по порту сервера или приветствию);
+    segments - список сегментов с данными без повторов: (время, 'client' или 'server', байты);
+    handshake_rtt - время от SYN до SYN-ACK или None;
+    server_closed - сервер закрыл соединение (FIN или RST);
+    packets - количество пакетов диалога
+    """
+
+    def __init__(self, client, server):
+        self.client = client
+        self.server = server
+        self.protocol = 'pop3' if server[1] in pop3_ports else 'smtp' if server[1] in smtp_ports else None
+        self.segments = []
+        self.handshake_rtt = None
+        self.server_closed = False
+        self.packets = 0
+        self.__syn_time = None
+        # следующий ожидаемый номер байта в каждом направлении (для отбрасывания повторов)
+        self.__next_seq = {}
+
+    def add(self, timestamp, side, seq, flags, payload):
+        self.packets += 1
+        if flags & SYN:
+            self.__next_seq[side] = (seq + 1) & 0xFFFFFFFF
+            if not flags & ACK:
+                self.__syn_time = timestamp
+            elif self.__syn_time is not None and timestamp is not None:
+                self.handshake_rtt = timestamp - self.__syn_time
+            return
+        if side == 'server' and flags & (FIN | RST):
+            self.server_closed = True
+        if not payload:
+            return
+        expected = self.__next_seq.get(side)
+        if expected is not None:
+            # повтор уже полученных данных отбрасывается, частичный повтор обрезается
+            behind = (expected - seq) & 0xFFFFFFFF
+            if behind < 0x80000000:
+                if behind >= len(payload):
+                    return
+                payload = payload[behind:]
+                seq = expected
+        self.__next_seq[side] = (seq + len(payload)) & 0xFFFFFFFF
+        self.segments.append((timestamp, side, payload))
+        if self.protocol is None and side == 'server' and len(self.segments) == 1:
+            self.protocol = 'pop3' if payload.startswith(b'+OK') else 'smtp' if payload[:3] == b'220' else None
+
+    def encrypted_from(self):
+        """
+        Номер первого сегмента, начиная с которого диалог зашифрован (TLS запись), или None
+        """
+        for number, (_, _, payload) in enumerate(self.segments):
+            # TLS handshake record: тип 22, версия 3.x
+            if payload[:1] == b'\x16' and payload[1:2] == b'\x03':
+                return number
+        return None
+
+    def summary(self):
+        client_bytes = sum(len(payload) for _, side, payload in self.segments if side == 'client')
+        server_bytes = sum(len(payload) for _, side, payload in self.segments if side == 'server')
+        times = [timestamp for timestamp, _, _ in self.segments if timestamp is not None]
+        encrypted = self.encrypted_from()
+        return {'client': f"{self.client[0]}:{self.client[1]}", 'server': f"{self.server[0]}:{self.server[1]}",
+                'protocol': self.protocol, 'packets': self.packets, 'segments': len(self.segments),
+                'client_bytes': client_bytes, 'server_bytes': server_bytes,
+                'duration': times[-1] - times[0] if times else None, 'handshake_rtt': self.handshake_rtt,
+                'encrypted_from_segment': encrypted,
+                'replay_steps': len(ReplayScript(self).steps)}
+
+
+def read_conversations(path, ports=None):
+    """
+    Выделить TCP диалоги из записи
+
+    :param ports: порты серверов, диалоги с которыми нужны (None - POP3 и SMTP порты)
+    :return: список объектов Conversation в порядке начала
+    """
+    ports = ports or (pop3_ports | smtp_ports)
+    conversations = {}
+    for timestamp, linktype, packet in read_packets(path):
+        parsed = parse_tcp(packet, linktype)
+        if parsed is None:
+            continue
+        source, destination, seq, flags, payload = parsed
+        if destination[1] in ports:
+            key, side = (source, destination), 'client'
+        elif source[1] in ports:
+            key, side = (destination, source), 'server'
+        else:
+            continue
+        conversation = conversations.get(key)
+        if conversation is None:
+            conversation = conversations[key] = Conversation(*key)
+        conversation.add(timestamp, side, seq, flags, payload)
+    return [conversation for conversation in conversations.values() if conversation.segments]
+
+
+def command_verb(line, last_reply=None):
+    """
+    Имя команды клиента; строки в ответ на приглашения AUTH (334, "+ ") - AUTH-CONT
+    """
+    if last_reply is not None and (last_reply.startswith(b'334') or last_reply.startswith(b'+ ')):
+        return 'AUTH-CONT'
+    return line.split(b' ', 1)[0].strip().upper().decode('ascii', errors='replace')
+
+
+def multiline_reply(protocol, line):
+    """
+    Ответ POP3 на команду многострочный (заканчивается строкой ".")
+    """
+    if protocol != 'pop3':
+        return False
+    words = line.split()
+    verb = words[0].upper() if words else b''
+    return verb in (b'CAPA', b'RETR', b'TOP') or (verb in (b'LIST', b'UIDL') and len(words) == 1)
+
+
+def reply_complete(protocol, reply, multiline):
+    """
+    Получен ли ответ на команду целиком
+    """
+    if not reply.endswith(b'\r\n'):
+        return False
+    if protocol == 'smtp':
+        # последняя строка многострочного ответа SMTP - "250 ...", остальные - "250-..."
+        last_line = reply[:-2].rsplit(b'\r\n', 1)[-1]
+        return last_line[3:4] != b'-'
+    if multiline and reply.startswith(b'+OK'):
+        return reply.endswith(b'\r\n.\r\n')
+    return True
+
+
+class ReplayStep:
+    """
+    Класс шага сценария: команда клиента и сегменты ответа сервера на нее.
+    Атрибуты класса:
+    verb - имя команды (DATA-BODY - данные письма после DATA, AUTH-CONT - продолжение AUTH);
+    multiline - ответ многострочный (POP3);
+    segments - список (пауза в секундах перед отправкой, байты)
+    """
+
+    def __init__(self, verb, multiline=False):
+        self.verb = verb
+        self.multiline = multiline
+        self.segments = []
+
+    def reply(self):
+        return b''.join(payload for _, payload in self.segments)
+
+
+class ReplayScript:
+    """
+    Класс сценария воспроизведения серверной стороны диалога.
+    Атрибуты класса:
+    protocol - 'pop3' или 'smtp';
+    greeting - шаг приветствия сервера (без команды);
+    steps - список шагов ReplayStep в порядке записи;
+    close - закрыть соединение после последнего шага (сервер закрыл его в записи
+        или дальше диалог зашифрован)
+    """
+
+    def __init__(self, conversation):
+        self.protocol = conversation.protocol or 'smtp'
+        encrypted = conversation.encrypted_from()
+        segments = conversation.segments if encrypted is None else conversation.segments[:encrypted]
+        self.close = conversation.server_closed or encrypted is not None
+        self.greeting = ReplayStep(None)
+        self.steps = []
+
+        # сегменты сервера относятся к самой старой команде, ответ на которую еще не получен целиком
+        # (при конвейерной отправке команд в записи ответов ждут сразу несколько команд)
+        waiting = []
+        buffer = b''
+        in_data = False
+        previous_time = None
+        for timestamp, side, payload in segments:
+            if side == 'client':
+                buffer += payload
+                while True:
+                    if in_data:
+                        if buffer.startswith(b'.\r\n'):
+                            cut = 3
+                        else:
+                            end = buffer.find(b'\r\n.\r\n')
+                            if end < 0:
+                                break
+                            cut = end + 5
+                        buffer = buffer[cut:]
+                        step = ReplayStep('DATA-BODY')
+                        in_data = False
+                    else:
+                        end = buffer.find(b'\n')
+                        if end < 0:
+                            break
+                        line, buffer = buffer[:end + 1], buffer[end + 1:]
+                        last_reply = (self.steps[-1] if self.steps else self.greeting).reply()
+                        step = ReplayStep(command_verb(line, last_reply), multiline_reply(self.protocol, line))
+                        # за DATA следуют данные письма (клиент отправляет их после ответа 354)
+                        in_data = self.protocol == 'smtp' and step.verb == 'DATA'
+                    self.steps.append(step)
+                    waiting.append(step)
+                    previous_time = timestamp
+                continue
+            target = waiting[0] if waiting else (self.steps[-1] if self.steps else self.greeting)
+            delay = 0.0 if previous_time is None or timestamp is None else max(0.0, timestamp - previous_time)
+            target.segments.append((delay, payload))
+            previous_time = timestamp
+            if waiting and reply_complete(self.protocol, target.reply(), target.multiline):
+                waiting.pop(0)
+
+    def find(self, verb, start, strict=False):
+        """
+        Найти шаг для команды клиента
+
+        :param start: номер первого непройденного шага
+        :param strict: только ближайший шаг, без пропуска команд, которых клиент не отправил
+        :return: номер шага или None
+        """
+        candidates = self.steps[start:start + 1] if strict else self.steps[start:]
+        for offset, step in enumerate(candidates):
+            if step.verb == verb:
+                return start + offset
+        return None
+
+
+def rechunk(segments, chunk):
+    """
+    Порции отправки: как в записи ('recorded'), слитые в одну ('merged') или по chunk байт
+    """
+    if chunk == 'recorded':
+        return segments
+    data = b''.join(payload for _, payload in segments)
+    delay = segments[0][0] if segments else 0.0
+    if chunk == 'merged':
+        return [(delay, data)] if data else []
+    size = int(chunk)
+    return [(delay if offset == 0 else 0.0, data[offset:offset + size]) for offset in range(0, len(data), size)]
+
+
+class ReplayServer(FakeServer):
+    """
+    Класс сервера воспроизведения записанного диалога.
+    Атрибуты класса:
+    script - сценарий ReplayScript;
+    time_scale - множитель пауз из записи (1 - как в записи, 0 - без пауз);
+    chunk - порции отправки: 'recorded', 'merged' или размер в байтах;
+    strict - не пропускать шаги сценария (команды клиента должны идти как в записи);
+    unmatched - команды клиента, которых не нашлось в сценарии
+    """
+
+    def __init__(self, script, time_scale=1.0, chunk='recorded', strict=False, host='127.0.0.1', port=0):
+        super().__init__(0.0, host, port)
+        self.script = script
+        self.time_scale = time_scale
+        self.chunk = chunk
+        self.strict = strict
+        self.unmatched = []
+
+    def __send(self, client_sock, segments):
+        for delay, payload in rechunk(segments, self.chunk):
+            if delay and self.time_scale:
+                time.sleep(delay * self.time_scale)
+            client_sock.sendall(payload)
+
+    def handle_session(self, client_sock, reader, replies):
+        fallback = fallback_replies[self.script.protocol]
+        self.__send(client_sock, self.script.greeting.segments)
+        last_reply = self.script.greeting.reply()
+        cursor = 0
+        in_data = False
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            if in_data:
+                # данные письма до строки "." - одна единица сценария
+                while line and line != b".\r\n":
+                    line = reader.readline()
+                verb = 'DATA-BODY'
+            else:
+                verb = command_verb(line, last_reply)
+            step = self.script.find(verb, cursor, self.strict)
+            if step is None:
+                self.unmatched.append(verb)
+                last_reply = fallback.get(verb, fallback[None])
+                client_sock.sendall(last_reply)
+                if verb == 'QUIT':
+                    break
+            else:
+                cursor = step + 1
+                segments = self.script.steps[step].segments
+                self.__send(client_sock, segments)
+                last_reply = self.script.steps[step].reply()
+            in_data = self.script.protocol == 'smtp' and verb == 'DATA' and last_reply.startswith(b'354')
+            if self.script.close and cursor >= len(self.script.steps):
+                break
+        client_sock.close()
+
+
+def envelope(script_conversation):
+    """
+    Отправитель и получатели из записанного SMTP диалога (для запуска клиента с теми же адресами)
+    """
+    sender, recipients = 'replay@example.com', []
+    for _, side, payload in script_conversation.segments:
+        if side != 'client':
+            continue
+        for line in payload.split(b'\r\n'):
+            upper = line.upper()
+            if upper.startswith(b'MAIL FROM:') or upper.startswith(b'RCPT TO:'):
+                address = line.split(b':', 1)[1].split(b'>', 1)[0].strip(b' <').decode(errors='replace')
+                if upper.startswith(b'MAIL'):
+                    sender = address
+                else:
+                    recipients.append(address)
+    return sender, recipients or ['replay@example.com']
+
+
+def run_client(conversation, server, repeat):
+    """
+    Прогнать настоящий клиент против сервера воспроизведения
+
+    :return: список длительностей сессий в секундах
+    """
+    import logger
+    import pop_client as pop
+    import smtp_client as smtp
+
+    sender, recipients = envelope(conversation)
+    timings = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        # журналы клиентов пишутся в текущий каталог
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if conversation.protocol == 'pop3':
+                        client = pop.POPClient(server.host, server.port, 'user', 'password', use_tls=False)
+                        client.messages_dir = tempfile.mkdtemp(dir=work_dir) + os.sep
+                        client.state_dir = client.messages_dir
+                        client.get_messages()
+                        error = client.last_error
+                    else:
+                        client = smtp.SMTPClient(server.host, server.port, 'user', 'password', use_tls=False)
+                        status = client.send_letter(sender, recipients, "Replay", "Replayed letter")
+                        error = client.last_error if status else None
+                        client.close()
+                timings.append(time.perf_counter() - start)
+                if error is not None:
+                    print(f"client error: {error}")
+        finally:
+            os.chdir(cwd)
+            logger.close_all()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded POP3/SMTP sessions from pcapng captures")
+    parser.add_argument('capture', help="файл pcapng или pcap")
+    parser.add_argument('--conversation', type=int, default=None,
+                        help="номер диалога (по умолчанию - первый, который можно воспроизвести)")
+    parser.add_argument('--serve', action='store_true', help="запустить сервер воспроизведения")
+    parser.add_argument('--run-client', action='store_true', help="прогнать клиент против воспроизведения")
+    parser.add_argument('--port', type=int, default=0, help="порт сервера воспроизведения")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="множитель пауз записи (0 - без пауз)")
+    parser.add_argument('--chunk', default='recorded',
+                        help="порции ответов: recorded (как в записи), merged или размер в байтах")
+    parser.add_argument('--strict', action='store_true', help="команды клиента должны идти строго как в записи")
+    parser.add_argument('--repeat', type=int, default=1, help="сессий клиента в --run-client")
+    args = parser.parse_args()
+
+    conversations = read_conversations(args.capture)
+    for number, conversation in enumerate(conversations):
+        summary = conversation.summary()
+        rtt = f"{summary['handshake_rtt'] * 1000:.1f} ms" if summary['handshake_rtt'] is not None else "-"
+        encrypted = "" if summary['encrypted_from_segment'] is None else \
+            f", TLS from segment {summary['encrypted_from_segment']}"
+        print(f"#{number} {summary['protocol']} {summary['client']} -> {summary['server']}: "
+              f"{summary['segments']} segments, {summary['client_bytes']}/{summary['server_bytes']} bytes "
+              f"client/server, {summary['duration'] or 0:.3f} s, rtt {rtt}, "
+              f"{summary['replay_steps']} replay steps{encrypted}")
+    if not (args.serve or args.run_client):
+        return
+
+    if args.conversation is None:
+        replayable = [conversation for conversation in conversations if ReplayScript(conversation).steps]
+        if not replayable:
+            raise SystemExit("No conversation can be replayed: the capture is encrypted from the start")
+        conversation = replayable[0]
+    else:
+        conversation = conversations[args.conversation]
+    server = ReplayServer(ReplayScript(conversation), args.time_scale, args.chunk, args.strict,
+                          port=args.port).start()
+    print(f"Replaying {conversation.protocol} conversation on {server.host}:{server.port}")
+    if args.run_client:
+        timings = sorted(run_client(conversation, server, args.repeat))
+        print(f"{len(timings)} sessions: median {timings[len(timings) // 2] * 1000:.2f} ms, "
+              f"max {timings[-1] * 1000:.2f} ms")
+        if server.unmatched:
+            print(f"commands not in the capture: {sorted(set(server.unmatched))}")
+        server.stop()
+        return
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
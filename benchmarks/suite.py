@@ -0,0 +1,305 @@
+"""
+Набор бенчмарков клиентов на локальных тестовых серверах: скачивание ящика (get_messages),
+скачивание отдельного письма (retrieve_message, по одному RETR без конвейера) и отправка
+писем (send_letter), без шифрования и по TLS с самоподписанным сертификатом.
+Для каждого сценария измеряются пропускная способность, перцентили задержек и пиковая
+память процесса (tracemalloc, отдельным прогоном, чтобы трассировка не искажала время).
+
+Результаты пишутся в JSON, который можно сравнить с результатами другого коммита:
+python -m benchmarks.suite --output new.json --compare old.json
+Сравнение печатает изменения и завершается с кодом 1, если какая-либо метрика
+ухудшилась больше порога (--threshold, по умолчанию 10%).
+
+Запуск из корня репозитория:
+python -m benchmarks.suite --messages 200 --sizes lognormal:16384:1.5 --latency 0.005 --output bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import logger
+import pop_client as pop
+import smtp_client as smtp
+import tls_context
+from benchmarks.fake_pop3 import FakePOP3Server, make_mailbox, size_sampler
+from benchmarks.fake_server import make_self_signed_cert, server_tls_context
+from benchmarks.fake_smtp import FakeSMTPServer
+from metrics import registry as metrics
+
+# какая метрика лучше при росте значения, а какая - при уменьшении
+higher_is_better = {'messages_per_second', 'letters_per_second', 'megabytes_per_second'}
+
+
+def percentiles(samples):
+    """
+    Перцентили выборки задержек в миллисекундах
+    """
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99), 'max_ms': ordered[-1] * 1000}
+
+
+def peak_memory(run):
+    """
+    Пиковая память Python объектов процесса во время прогона (клиент и тестовый сервер), в КБ
+    """
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def retrieve_latencies(trace):
+    """
+    Задержки скачивания писем из трассы сессии: ответ на RETR и чтение письма
+    """
+    latencies = []
+    retr = None
+    for _, kind, name, duration, _ in trace.events:
+        if kind == 'command' and name == 'RETR':
+            retr = duration
+        elif kind == 'phase' and name == 'retrieve' and retr is not None:
+            latencies.append(retr + duration)
+            retr = None
+    return latencies
+
+
+class Bench:
+    """
+    Класс одного прогона набора: общие настройки, тестовые серверы и рабочий каталог
+    """
+
+    def __init__(self, args, work_dir):
+        self.args = args
+        self.work_dir = work_dir
+        self.mailbox = make_mailbox(args.messages, args.sizes, args.seed)
+        self.server_tls = None
+        if args.tls:
+            cert_file, key_file = make_self_signed_cert(work_dir)
+            self.server_tls = server_tls_context(cert_file, key_file)
+            tls_context.contexts.configure(cafile=cert_file)
+
+    def __pop_server(self, tls):
+        return FakePOP3Server(self.mailbox, latency=self.args.latency, bandwidth=self.args.bandwidth,
+                              tls_context=self.server_tls if tls else None).start()
+
+    def __pop_session(self, tls, window):
+        """
+        Скачать весь ящик в новый каталог
+
+        :return: время сессии и трасса сессии
+        """
+        server = self.__pop_server(tls)
+        client = pop.POPClient(server.host, server.port, 'user', 'password', pipeline_window=window, use_tls=tls)
+        client.messages_dir = tempfile.mkdtemp(dir=self.work_dir) + os.sep
+        client.state_dir = client.messages_dir
+        metrics.traces.clear()
+        start = time.perf_counter()
+        # клиент подробно печатает протокол, для замера вывод не нужен
+        with contextlib.redirect_stdout(io.StringIO()):
+            client.get_messages()
+        elapsed = time.perf_counter() - start
+        server.stop()
+        if client.last_error is not None:
+            raise RuntimeError(f"POP3 session failed: {client.last_error}")
+        return elapsed, metrics.traces[-1]
+
+    def get_messages(self, tls):
+        times = [self.__pop_session(tls, self.args.window)[0] for _ in range(self.args.repeat)]
+        best = min(times)
+        total = sum(map(len, self.mailbox))
+        return {'messages_per_second': len(self.mailbox) / best,
+                'megabytes_per_second': total / best / 2 ** 20,
+                'session_ms': percentiles(times),
+                'peak_memory_kb': peak_memory(lambda: self.__pop_session(tls, self.args.window))}
+
+    def retrieve_message(self, tls):
+        latencies = []
+        for _ in range(self.args.repeat):
+            latencies += retrieve_latencies(self.__pop_session(tls, 1)[1])
+        return {'messages_per_second': len(latencies) / sum(latencies),
+                'latency': percentiles(latencies),
+                'peak_memory_kb': peak_memory(lambda: self.__pop_session(tls, 1))}
+
+    def __attachment(self, size):
+        """
+        Файл вложения заданного размера (создается один раз), чтобы письмо читалось с диска потоком
+        """
+        path = os.path.join(self.work_dir, f"attachment_{size}.bin")
+        if not os.path.exists(path):
+            with open(path, 'wb') as attachment_file:
+                for _ in range(size // 2 ** 20):
+                    attachment_file.write(os.urandom(2 ** 20))
+                attachment_file.write(os.urandom(size % 2 ** 20))
+        return path
+
+    def __send_letters(self, tls, attachment_size=0):
+        """
+        Отправить пачку писем в одной сессии (keep_alive)
+
+        :return: время сессии и задержки отдельных писем
+        """
+        # предел SIZE с запасом на вложение в base64: клиент не отправляет письмо больше предела
+        server = FakeSMTPServer(latency=self.args.latency, bandwidth=self.args.bandwidth, keep_data=False,
+                                chunking=True, tls_context=self.server_tls if tls else None,
+                                size_limit=max(50 * 2 ** 20, 2 * attachment_size + 2 ** 20)).start()
+        client = smtp.SMTPClient(server.host, server.port, 'user', 'password', keep_alive=True, use_tls=tls)
+        next_size = size_sampler(self.args.sizes, self.args.seed)
+        attachments = [self.__attachment(attachment_size)] if attachment_size else None
+        latencies = []
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for number in range(self.args.letters):
+                letter_start = time.perf_counter()
+                status = client.send_letter('bench@example.com', [f"user{i}@example.com" for i in range(5)],
+                                            f"Benchmark letter {number}", "Hello!\n" * (next_size() // 7),
+                                            attachments=attachments)
+                latencies.append(time.perf_counter() - letter_start)
+                if status != 0:
+                    raise RuntimeError(f"SMTP send failed: {client.last_error}")
+            client.quit()
+        elapsed = time.perf_counter() - start
+        client.close()
+        server.stop()
+        return elapsed, latencies
+
+    def send_letter(self, tls):
+        runs = [self.__send_letters(tls) for _ in range(self.args.repeat)]
+        best = min(elapsed for elapsed, _ in runs)
+        return {'letters_per_second': self.args.letters / best,
+                'latency': percentiles([latency for _, latencies in runs for latency in latencies]),
+                'peak_memory_kb': peak_memory(lambda: self.__send_letters(tls))}
+
+    def send_attachment(self, tls):
+        size = self.args.attachment_mb * 2 ** 20
+        runs = [self.__send_letters(tls, size) for _ in range(self.args.repeat)]
+        best = min(elapsed for elapsed, _ in runs)
+        return {'letters_per_second': self.args.letters / best,
+                'megabytes_per_second': self.args.letters * size / best / 2 ** 20,
+                'latency': percentiles([latency for _, latencies in runs for latency in latencies]),
+                'peak_memory_kb': peak_memory(lambda: self.__send_letters(tls, size))}
+
+
+scenarios = ('get_messages', 'retrieve_message', 'send_letter', 'send_attachment')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(result, prefix=''):
+    """
+    Плоский словарь метрик сценария: {"latency.p99_ms": значение, ...}
+    """
+    flat = {}
+    for name, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{name}."))
+        else:
+            flat[f"{prefix}{name}"] = value
+    return flat
+
+
+def compare(baseline, current, threshold):
+    """
+    Напечатать изменения метрик относительно прошлых результатов
+
+    :return: список ухудшившихся метрик
+    """
+    regressions = []
+    for scenario, result in current['results'].items():
+        old_result = baseline['results'].get(scenario)
+        if old_result is None:
+            continue
+        old_flat = flatten(old_result)
+        for name, value in flatten(result).items():
+            old = old_flat.get(name)
+            if not old or value is None:
+                continue
+            change = (value - old) / old
+            # для пропускной способности плохо падение, для задержек и памяти - рост
+            worse = -change if name.rsplit('.', 1)[-1] in higher_is_better else change
+            mark = ' REGRESSION' if worse > threshold else ''
+            print(f"{scenario:<28} {name:<24} {old:12.2f} -> {value:12.2f} {change:+8.1%}{mark}")
+            if mark:
+                regressions.append(f"{scenario}.{name}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="POP3/SMTP client benchmark suite")
+    parser.add_argument('--scenarios', nargs='+', choices=scenarios, default=list(scenarios))
+    parser.add_argument('--messages', type=int, default=100, help="писем в ящике")
+    parser.add_argument('--sizes', default='lognormal:16384:1.5',
+                        help="распределение размеров писем: fixed:N, uniform:A:B, lognormal:MEDIAN:SIGMA, "
+                             "mix:SMALL:LARGE:SHARE")
+    parser.add_argument('--letters', type=int, default=20, help="писем в сценариях отправки")
+    parser.add_argument('--attachment-mb', type=int, default=5, help="размер вложения в send_attachment, МБ")
+    parser.add_argument('--latency', type=float, default=0.005, help="задержка ответа сервера, с")
+    parser.add_argument('--bandwidth', type=float, default=None, help="пропускная способность канала, байт/с")
+    parser.add_argument('--window', type=int, default=32, help="окно конвейера POP3 в get_messages")
+    parser.add_argument('--repeat', type=int, default=3, help="повторов каждого замера (берется лучший)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-tls', dest='tls', action='store_false', help="не запускать TLS варианты")
+    parser.add_argument('--output', help="файл для результатов в JSON")
+    parser.add_argument('--compare', help="JSON с прошлыми результатами для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.1, help="допустимое ухудшение (доля)")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        # журналы клиентов пишутся в текущий каталог
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        metrics.tracing = True
+        try:
+            bench = Bench(args, work_dir)
+            for scenario in args.scenarios:
+                for tls in ((False, True) if args.tls else (False,)):
+                    name = f"{scenario}.{'tls' if tls else 'plain'}"
+                    results[name] = getattr(bench, scenario)(tls)
+                    summary = ", ".join(f"{key} {value:.2f}" for key, value in flatten(results[name]).items())
+                    print(f"{name:<28} {summary}")
+        finally:
+            os.chdir(cwd)
+            logger.close_all()
+
+    report = {'meta': {'commit': git_commit(), 'time': time.time(), 'python': sys.version.split()[0],
+                       'platform': platform.platform(), 'options': vars(args),
+                       'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=1)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\nCompared with {baseline['meta'].get('commit')}:")
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} metrics regressed more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,230 @@
+import atexit
+import os
+import queue
+import re
+import threading
+import time
 from datetime import datetime as dt
 
+"""
+Журнал почтовых сессий.
+Строки журнала ставятся в очередь и записываются в файл фоновым потоком пачками,
+поэтому протоколирование не тормозит сетевой обмен. Все клиенты, пишущие в один файл,
+используют общий обработчик (один файл и один поток). Поддерживаются уровни
+(DEBUG - протокол обмена, INFO, WARNING, ERROR), ротация по размеру и по времени,
+а пароли и данные авторизации вырезаются из строк фильтром.
+
+Настройки задаются функцией configure() или переменной окружения MAIL_LOG_LEVEL.
+"""
+
+levels = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+# минимальный уровень записываемых сообщений (DEBUG - вместе с протоколом обмена,
+# по умолчанию протокол не пишется)
+level = os.environ.get('MAIL_LOG_LEVEL', 'INFO').upper()
+# дублировать строки журнала на экран (печать идет в потоке клиента, мимо очереди)
+console = False
+# ротация: максимальный размер файла в байтах и период в секундах (0 - без ротации),
+# сколько старых файлов хранить
+max_bytes = 0
+rotate_interval = 0
+backup_count = 3
+# сколько строк записывать одной пачкой
+batch_size = 512
+
+handlers = {}
+handlers_lock = threading.Lock()
+
 
 def current_time():
     return dt.now().strftime('%Y-%m-%d %H:%M:%S')
 
 
+def configure(**options):
+    """
+    Изменить настройки журнала: level, console, max_bytes, rotate_interval, backup_count
+    """
+    for name, value in options.items():
+        if name not in ('level', 'console', 'max_bytes', 'rotate_interval', 'backup_count'):
+            raise ValueError(f"Unknown logger option: {name}")
+        if name == 'level':
+            value = value.upper()
+            if value not in levels:
+                raise ValueError(f"Unknown log level: {value}")
+        globals()[name] = value
+
+
+class SecretFilter:
+    """
+    Класс фильтра секретов в строках протокола: пароль команды PASS и все ответы клиента
+    во время обмена AUTH (до итогового ответа сервера) заменяются на ****.
+    Фильтр хранит состояние обмена, поэтому у каждого клиента он свой
+    """
+    pass_command = re.compile(r'^(Client: (?:PASS|APOP \S+) ).*', re.IGNORECASE | re.DOTALL)
+    auth_command = re.compile(r'^(Client: AUTH \S+)( .*)?$', re.IGNORECASE | re.DOTALL)
+
+    def __init__(self):
+        self.in_auth = False
+
+    def __call__(self, message):
+        if message.startswith('Client: '):
+            if self.in_auth:
+                return 'Client: ****'
+            match = self.auth_command.match(message)
+            if match:
+                self.in_auth = True
+                # начальный ответ (AUTH PLAIN <данные>) тоже секрет
+                return match.group(1) + (' ****' if match.group(2) else '')
+            return self.pass_command.sub(r'\1****', message)
+        if self.in_auth and message.startswith('Server: ') and message[8:11] != '334':
+            # сервер завершил обмен AUTH (успехом или ошибкой)
+            self.in_auth = False
+        return message
+
+
+class LogHandler:
+    """
+    Класс обработчика одного файла журнала: очередь строк и фоновый поток записи.
+    Атрибуты класса:
+    filename - имя файла журнала;
+    users - сколько объектов FileLogger пишут в этот файл
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.users = 0
+        self.__queue = queue.SimpleQueue()
+        self.__file = open(filename, 'a', encoding='utf-8')
+        self.__opened_at = time.time()
+        # время форматируется не чаще раза в секунду
+        self.__time_cache = (None, '')
+        self.__thread = threading.Thread(target=self.__writer_loop, name=f'log-writer-{filename}', daemon=True)
+        self.__thread.start()
+
+    def put(self, timestamp, msg_type, message):
+        self.__queue.put((timestamp, msg_type, message))
+
+    def flush(self):
+        """
+        Дождаться записи в файл всех строк, поставленных в очередь до вызова
+        """
+        done = threading.Event()
+        self.__queue.put(done)
+        done.wait()
+
+    def close(self):
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __format_time(self, timestamp):
+        second = int(timestamp)
+        if self.__time_cache[0] != second:
+            self.__time_cache = (second, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second)))
+        return self.__time_cache[1]
+
+    def __writer_loop(self):
+        while True:
+            batch = [self.__queue.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            flushed = []
+            stop = False
+            for item in batch:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    flushed.append(item)
+                else:
+                    timestamp, msg_type, message = item
+                    lines.append(f'{self.__format_time(timestamp)} [{msg_type}]: {message}\n')
+            if lines:
+                self.__file.write(''.join(lines))
+                self.__file.flush()
+                self.__rotate_if_needed()
+            for done in flushed:
+                done.set()
+            if stop:
+                self.__file.close()
+                return
+
+    def __rotate_if_needed(self):
+        too_big = max_bytes and self.__file.tell() >= max_bytes
+        too_old = rotate_interval and time.time() - self.__opened_at >= rotate_interval
+        if not (too_big or too_old):
+            return
+        self.__file.close()
+        # smtp_3.log -> smtp_3.log.1 -> smtp_3.log.2 ..., самый старый удаляется
+        for number in range(backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.filename}.{number}"):
+                os.replace(f"{self.filename}.{number}", f"{self.filename}.{number + 1}")
+        if backup_count:
+            os.replace(self.filename, f"{self.filename}.1")
+        else:
+            os.remove(self.filename)
+        self.__file = open(self.filename, 'a', encoding='utf-8')
+        self.__opened_at = time.time()
+
+
+def acquire_handler(filename):
+    with handlers_lock:
+        handler = handlers.get(filename)
+        if handler is None:
+            handler = handlers[filename] = LogHandler(filename)
+        handler.users += 1
+        return handler
+
+
+def release_handler(handler):
+    """
+    Отпустить обработчик: последний пользователь закрывает файл, остальные дожидаются записи своих строк
+    """
+    with handlers_lock:
+        handler.users -= 1
+        last = handler.users == 0
+        if last:
+            del handlers[handler.filename]
+    if last:
+        handler.close()
+    else:
+        handler.flush()
+
+
+@atexit.register
+def close_all():
+    """
+    Дописать очереди всех журналов при завершении процесса
+    """
+    with handlers_lock:
+        pending = list(handlers.values())
+        handlers.clear()
+    for handler in pending:
+        handler.close()
+
+
 class FileLogger:
+    """
+    Класс журнала одного клиента.
+    Атрибуты класса:
+    filename - имя файла журнала (обработчик файла общий для всех журналов с этим именем);
+    active - признак записи в файл
+    """
+
     def __init__(self, filename):
-        self.logfile = open(filename, 'a')
+        self.filename = filename
         self.active = True
+        self.__filter = SecretFilter()
+        self.__handler = acquire_handler(filename)
 
     def change_active_state(self, state):
+        """
+        Включить или выключить запись в файл.
+        Для скрытия паролей не нужен: секреты вырезает фильтр строк
+        """
         if state is True:
             self.active = True
             self.write_log("Logging was enabled.")
@@ -19,10 +233,22 @@ class FileLogger:
             self.active = False
 
     def write_log(self, message, msg_type="INFO"):
-        log_string = f'{current_time()} [{msg_type}]: {message}\n'
-        print(log_string)
+        if levels.get(msg_type, levels['INFO']) < levels[level]:
+            return
+        message = self.__filter(message)
+        if console:
+            print(f'{current_time()} [{msg_type}]: {message}\n')
         if self.active:
-            self.logfile.write(log_string)
+            if self.__handler is None:
+                # журнал пишут и после close() (например, повторная отправка тем же клиентом)
+                self.__handler = acquire_handler(self.filename)
+            self.__handler.put(time.time(), msg_type, message)
+
+    def flush(self):
+        if self.__handler is not None:
+            self.__handler.flush()
 
     def close(self):
-        self.logfile.close()
+        if self.__handler is not None:
+            release_handler(self.__handler)
+            self.__handler = None
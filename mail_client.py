@@ -5,18 +5,229 @@ from PyQt5 import QtWidgets, QtCore
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QLineEdit
 import sys
+import threading
+import time
 import email
 from email import header as email_header
 import datetime
+import mimetypes
+import shutil
 
 import smtp_client
 import smtp_client as smtp
 import pop_client as pop
+from message_index import MessageIndex, rank_window
+from outbox import DeliveryEngine, Outbox
+
+
+def create_smtp_client():
+    # параметры читаются при открытии каждой новой сессии, поэтому смена настроек подхватывается
+    settings = QtCore.QSettings("SIT Brigade 3", "Mail Client")
+    return smtp_client.SMTPClient(settings.value('smtp_host'), int(settings.value('smtp_port')),
+                                  settings.value('login'), settings.value('password'))
+
+
+# исходящая очередь: письмо сохраняется на диск и отправляется в фоне, при ошибке - повторяется
+outbox = Outbox()
+delivery_engine = DeliveryEngine(outbox, create_smtp_client)
+
+
+class POPTaskSignals(QtCore.QObject):
+    """
+    Сигналы фоновой POP3 сессии (QRunnable не наследует QObject и сам сигналы отправлять не может).
+    Слоты окна выполняются в главном потоке: соединение между потоками ставит вызовы в очередь
+    """
+    # имя файла сохраненного письма
+    message = QtCore.pyqtSignal(str)
+    # скачано писем, всего писем в сессии
+    progress = QtCore.pyqtSignal(int, int)
+    # текст ошибки сессии или пустая строка
+    finished = QtCore.pyqtSignal(str)
+
+
+class POPTask(QtCore.QRunnable):
+    """
+    Класс POP3 сессии в пуле потоков: сеть и разбор писем не блокируют окно.
+    Атрибуты класса:
+    pop_client - клиент, созданный в главном потоке (настройки читаются там же);
+    action - функция (клиент), выполняющая сессию: get_messages, fetch_bodies и т.п.;
+    signals - сигналы POPTaskSignals;
+    cancel_event - установка прерывает сессию между письмами
+    """
+
+    def __init__(self, pop_client, action):
+        super(POPTask, self).__init__()
+        self.pop_client = pop_client
+        self.action = action
+        self.signals = POPTaskSignals()
+        self.cancel_event = threading.Event()
+        pop_client.cancel_event = self.cancel_event
+        pop_client.on_message = self.__on_message
+
+    def __on_message(self, msg_file, downloaded, expected):
+        self.signals.message.emit(msg_file)
+        self.signals.progress.emit(downloaded, expected)
+
+    def run(self):
+        try:
+            self.action(self.pop_client)
+            error = self.pop_client.last_error
+        except Exception as e:
+            error = e
+        self.signals.finished.emit('' if error is None else str(error))
+
+    def start(self):
+        QtCore.QThreadPool.globalInstance().start(self)
+        return self
+
+
+class MessageTableModel(QtCore.QAbstractTableModel):
+    """
+    Модель списка писем поверх индекса MessageIndex.
+    Строки читаются из индекса страницами по мере прокрутки (canFetchMore/fetchMore), сортировка и
+    поиск выполняются запросом к индексу. Загруженные строки всегда совпадают с началом списка
+    query при текущих порядке и запросе, поэтому следующая страница читается со смещения len(rows).
+    Найденные письма без сортировки по колонке идут по релевантности.
+    Атрибуты класса:
+    index - индекс писем;
+    rows - загруженные строки (словари из MessageIndex.query);
+    total - сколько всего писем в списке;
+    order, descending, text - текущие порядок и поисковый запрос
+    """
+    columns = (('from', 'From'), ('subject', 'Subject'), ('date', 'Date'))
+    page_size = 500
+
+    def __init__(self, index, parent=None):
+        super(MessageTableModel, self).__init__(parent)
+        self.index = index
+        self.rows = []
+        self.total = 0
+        self.order = 'arrival'
+        self.descending = False
+        self.text = None
+        # имена загруженных писем: новое письмо не нужно искать в rows
+        self.__loaded = set()
+
+    def __order(self):
+        return 'relevance' if self.text and self.order == 'arrival' else self.order
+
+    def reload(self):
+        """
+        Сбросить загруженные строки и прочитать первую страницу заново
+        """
+        self.beginResetModel()
+        self.rows = self.index.query(self.__order(), self.descending, self.text, limit=self.page_size)
+        self.__loaded = {msg_data['msg_file'] for msg_data in self.rows}
+        self.total = self.index.count(self.text)
+        if self.__order() == 'relevance':
+            # по релевантности ранжируются только последние найденные письма
+            self.total = min(self.total, rank_window)
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return self.rows[index.row()][self.columns[index.column()][0]]
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.columns[section][1]
+        return None
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and len(self.rows) < self.total
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return
+        page = self.index.query(self.__order(), self.descending, self.text, offset=len(self.rows),
+                                limit=self.page_size)
+        if len(page) < self.page_size:
+            # писем меньше, чем считалось (например, удалены в обход модели)
+            self.total = len(self.rows) + len(page)
+        if not page:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), len(self.rows), len(self.rows) + len(page) - 1)
+        self.rows.extend(page)
+        self.__loaded.update(msg_data['msg_file'] for msg_data in page)
+        self.endInsertRows()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        # column -1 - порядок получения писем (при поиске - релевантность)
+        self.order = self.columns[column][0] if column >= 0 else 'arrival'
+        self.descending = order == Qt.DescendingOrder
+        self.reload()
+
+    def set_filter(self, text):
+        self.text = text or None
+        self.reload()
+
+    def message(self, row):
+        return self.rows[row]
+
+    def __find(self, msg_file):
+        if msg_file not in self.__loaded:
+            return None
+        return next(row for row, msg_data in enumerate(self.rows) if msg_data['msg_file'] == msg_file)
+
+    def __remove_row(self, row):
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        self.__loaded.discard(self.rows.pop(row)['msg_file'])
+        self.endRemoveRows()
+
+    def message_added(self, msg_file):
+        """
+        Вставить новое или обновленное письмо (уже записанное в индекс) на его место в списке
+        """
+        row = self.__find(msg_file)
+        if row is not None:
+            # обновленное письмо (докачано тело) могло сменить место в списке
+            self.__remove_row(row)
+            self.total -= 1
+        if self.__order() == 'arrival':
+            # новое или обновленное письмо получает в индексе наибольший rowid и оказывается
+            # последним в порядке получения: место известно без запроса позиции (он O(N))
+            position = 0 if self.descending else self.total
+        else:
+            position = self.index.position(msg_file, self.__order(), self.descending, self.text)
+            if position is None:
+                return
+        all_loaded = len(self.rows) >= self.total
+        self.total += 1
+        if position < len(self.rows) or all_loaded:
+            # письма за концом загруженных строк появятся со следующей страницей
+            msg_data = self.index.get(msg_file)
+            if msg_data is None:
+                # письмо уже удалено из индекса
+                self.total -= 1
+                return
+            self.beginInsertRows(QtCore.QModelIndex(), position, position)
+            self.rows.insert(position, msg_data)
+            self.__loaded.add(msg_file)
+            self.endInsertRows()
+
+    def message_removed(self, msg_file):
+        """
+        Убрать из списка письмо, удаленное из индекса
+        """
+        row = self.__find(msg_file)
+        if row is not None:
+            self.__remove_row(row)
+            self.total -= 1
 
 
 class ClientWindow(QMainWindow):
     settings = QtCore.QSettings("SIT Brigade 3", "Mail Client")
     msg_dir = ".msg/"
+    # период добавления скачанных писем в таблицу (кадр при 60 fps) и время на добавление за кадр, с
+    flush_interval = 16
+    flush_budget = 0.008
     # smtp_host = settings.va
     # smtp_port = ''
     # pop_host = ''
@@ -27,19 +238,52 @@ class ClientWindow(QMainWindow):
     def __init__(self):
         super(ClientWindow, self).__init__()
         loadUi("design/main.ui", self)
+        self.index = MessageIndex(self.msg_dir)
+        # подхватываем письма, сохраненные в обход индекса
+        self.index.refresh()
+        self.model = MessageTableModel(self.index, self)
+        self.msgTable.setModel(self.model)
         self.msgTable.setColumnWidth(0, 250)
         self.msgTable.setColumnWidth(1, 400)
         self.msgTable.setColumnWidth(2, 150)
+        # без индикатора сортировки письма идут в порядке получения; включение сортировки загружает модель
+        self.msgTable.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.msgTable.setSortingEnabled(True)
         self.btn_settings.clicked.connect(self.settings_open)
         self.btn_refresh.clicked.connect(self.refresh)
         self.btn_send.clicked.connect(self.msg_form)
         self.btn_delete.clicked.connect(self.msg_delete)
         self.msgTable.doubleClicked.connect(self.msg_open)
+        # поиск выполняется, когда пользователь перестал печатать
+        self.search_timer = QtCore.QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(250)
+        self.search_timer.timeout.connect(lambda: self.model.set_filter(self.search_box.text().strip()))
+        self.search_box.textChanged.connect(self.search_timer.start)
+        self.prefetch_thread = None
+        self.prefetch_stop = threading.Event()
 
-        self.msg_info_list = []
+        # фоновая синхронизация: письма копятся в pending_files и добавляются в таблицу по таймеру,
+        # чтобы поток писем не забивал очередь событий и окно перерисовывалось без задержек
+        self.sync_task = None
+        self.pending_files = []
+        self.flush_timer = QtCore.QTimer(self)
+        self.flush_timer.setInterval(self.flush_interval)
+        self.flush_timer.timeout.connect(self.flush_messages)
+        self.btn_cancel_sync.clicked.connect(self.cancel_sync)
+        self.sync_progress.hide()
+        self.btn_cancel_sync.hide()
 
         print(self.settings.value('smtp_host'))
 
+    def closeEvent(self, event):
+        # останавливаем фоновую докачку писем и синхронизацию (сессия завершится командой QUIT)
+        self.prefetch_stop.set()
+        if self.sync_task is not None:
+            self.sync_task.cancel_event.set()
+        QtCore.QThreadPool.globalInstance().waitForDone(5000)
+        super(ClientWindow, self).closeEvent(event)
+
     def settings_open(self):
         self.settings_window = SettingsWindow()
         # self.settings.saveClicked.connect(self.update_settings)
@@ -48,52 +292,122 @@ class ClientWindow(QMainWindow):
 
         
     def refresh(self):
-        self.download_messages()
-        self.msgTable.clear()
-        self.get_messages()
+        if self.sync_task is not None:
+            # синхронизация уже идет
+            return
+        self.sync_task = POPTask(self.create_pop_client(), pop.POPClient.get_messages)
+        self.sync_task.signals.message.connect(self.pending_files.append)
+        self.sync_task.signals.progress.connect(self.sync_progress_changed)
+        self.sync_task.signals.finished.connect(self.sync_finished)
+        self.btn_refresh.setEnabled(False)
+        # пока количество писем неизвестно, индикатор просто показывает занятость
+        self.sync_progress.setRange(0, 0)
+        self.sync_progress.show()
+        self.btn_cancel_sync.setEnabled(True)
+        self.btn_cancel_sync.show()
+        self.statusbar.showMessage("Receiving messages...")
+        self.flush_timer.start()
+        self.sync_task.start()
+
+    def sync_progress_changed(self, downloaded, expected):
+        self.sync_progress.setRange(0, expected)
+        self.sync_progress.setValue(downloaded)
+
+    def cancel_sync(self):
+        if self.sync_task is not None:
+            self.sync_task.cancel_event.set()
+            self.btn_cancel_sync.setEnabled(False)
+            self.statusbar.showMessage("Cancelling...")
+
+    def sync_finished(self, error):
+        pop_client = self.sync_task.pop_client
+        cancelled = self.sync_task.cancel_event.is_set()
+        self.sync_task = None
+        self.flush_messages()
+        self.sync_progress.hide()
+        self.btn_cancel_sync.hide()
+        self.btn_refresh.setEnabled(True)
+        if error:
+            self.statusbar.showMessage(f"Receiving failed: {error}")
+        else:
+            self.statusbar.showMessage(f"{'Cancelled' if cancelled else 'Done'}: "
+                                       f"{pop_client.downloaded} new messages", 5000)
+        if pop_client.headers_only and not cancelled:
+            self.start_prefetch()
+
+    def flush_messages(self):
+        """
+        Добавить в таблицу письма, скачанные с прошлого кадра. Вставка в отсортированную таблицу
+        стоит запроса позиции к индексу, поэтому за кадр письма добавляются не дольше flush_budget,
+        остальные ждут следующего кадра
+        """
+        deadline = time.perf_counter() + self.flush_budget
+        added = 0
+        for msg_file in self.pending_files:
+            self.model.message_added(msg_file)
+            added += 1
+            if time.perf_counter() >= deadline:
+                break
+        del self.pending_files[:added]
+        if self.sync_task is None and not self.pending_files:
+            self.flush_timer.stop()
 
     def msg_open(self):
-        # QtWidgets.QTableWidget.click
-        local_id = self.msgTable.currentRow()
-        # msg_file =
-        self.message_inspector = MessageInspector(self.msg_dir + self.msg_info_list[local_id]['msg_file'])
+        row = self.msgTable.currentIndex().row()
+        if row < 0:
+            return
+        msg_file = self.model.message(row)['msg_file']
+        pop_client = self.create_pop_client()
+        if not pop_client.is_partial(msg_file):
+            self.show_message(msg_file)
+            return
+        # скачаны только заголовки - докачиваем тело письма в фоне и открываем письмо после этого
+        self.statusbar.showMessage("Downloading message...")
+        task = POPTask(pop_client, lambda client: client.fetch_bodies([msg_file]))
+        task.signals.finished.connect(lambda error: self.show_message(msg_file, error))
+        # задача должна жить до конца сессии
+        self.fetch_task = task.start()
+
+    def show_message(self, msg_file, error=''):
+        if error:
+            self.statusbar.showMessage(f"Downloading failed: {error}")
+        else:
+            self.statusbar.clearMessage()
+        self.message_inspector = MessageInspector(self.index, msg_file)
         self.message_inspector.show()
-        # print(msg_file)
 
     def msg_form(self):
         self.message_form = MessageForm()
         self.message_form.show()
 
     def msg_delete(self):
-        local_id = self.msgTable.currentRow()
-        os.remove(self.msg_dir + self.msg_info_list[local_id]['msg_file'])
-        self.refresh()
+        row = self.msgTable.currentIndex().row()
+        if row < 0:
+            return
+        msg_file = self.model.message(row)['msg_file']
+        self.index.delete_message(msg_file)
+        self.model.message_removed(msg_file)
 
     def get_messages(self):
-        msg_list = os.listdir(self.msg_dir)
-        if not msg_list:
-            return
-        self.msgTable.setRowCount(len(msg_list))
-
-        self.msg_info_list = []
-        for row, file in enumerate(msg_list):
-            print(file)
-            msg_data = pop.read_message_from_file(self.msg_dir + file, without_body=True)
-            self.msgTable.setItem(row, 0, QtWidgets.QTableWidgetItem(msg_data['from']))
-            self.msgTable.setItem(row, 1, QtWidgets.QTableWidgetItem(msg_data['subject']))
-            self.msgTable.setItem(row, 2, QtWidgets.QTableWidgetItem(msg_data['date']))
-            msg_data['local_id'] = row
-            msg_data['msg_file'] = file
-            self.msg_info_list.append(msg_data)
-
-    def download_messages(self):
-        pop_client = pop.POPClient(server_host=self.settings.value('pop_host'),
-                                   server_port=int(self.settings.value('pop_port')),
-                                   login=self.settings.value('login'),
-                                   password=self.settings.value('password'))
-        pop_client.get_messages()
-        # pop_client.close()
-        return
+        # заголовки берем из индекса, а не перечитываем каждый файл; строки читаются по мере прокрутки
+        self.model.reload()
+
+    def create_pop_client(self):
+        delete_after_days = self.settings.value('delete_after_days')
+        return pop.POPClient(server_host=self.settings.value('pop_host'),
+                             server_port=int(self.settings.value('pop_port')),
+                             login=self.settings.value('login'),
+                             password=self.settings.value('password'),
+                             leave_on_server=self.settings.value('leave_on_server', False, type=bool),
+                             delete_after_days=int(delete_after_days) if delete_after_days else None,
+                             headers_only=self.settings.value('headers_only', False, type=bool))
+
+    def start_prefetch(self):
+        if self.prefetch_thread is None or not self.prefetch_thread.is_alive():
+            # тела писем докачиваем в фоне, таблица заполняется по одним заголовкам
+            self.prefetch_thread = threading.Thread(target=self.create_pop_client().prefetch_bodies,
+                                                    kwargs={'stop_event': self.prefetch_stop}, daemon=True)
+            self.prefetch_thread.start()
 
 
 class SettingsWindow(QWidget):
@@ -112,6 +426,9 @@ class SettingsWindow(QWidget):
         self.pop_port.setText(self.settings.value('pop_port'))
         self.email_address.setText(self.settings.value('login'))
         self.password.setText(self.settings.value('password'))
+        self.leave_on_server.setChecked(self.settings.value('leave_on_server', False, type=bool))
+        self.delete_after_days.setText(self.settings.value('delete_after_days'))
+        self.headers_only.setChecked(self.settings.value('headers_only', False, type=bool))
 
     def save(self):
         # settings = {
@@ -128,6 +445,9 @@ class SettingsWindow(QWidget):
         self.settings.setValue('pop_port', self.pop_port.text())
         self.settings.setValue('login', self.email_address.text())
         self.settings.setValue('password', self.password.text())
+        self.settings.setValue('leave_on_server', self.leave_on_server.isChecked())
+        self.settings.setValue('delete_after_days', self.delete_after_days.text())
+        self.settings.setValue('headers_only', self.headers_only.isChecked())
         # self.saveClicked.emit(settings)
         self.close()
 
@@ -135,15 +455,53 @@ class SettingsWindow(QWidget):
         self.close()
 
 
+def size_text(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
 class MessageInspector(QWidget):
-    def __init__(self, msg_file):
+    def __init__(self, index, msg_file):
         super(MessageInspector, self).__init__()
         loadUi("design/message_inspector.ui", self)
-        msg_data = pop.read_message_from_file(msg_file)
+        self.index = index
+        self.msg_file = msg_file
+        msg_data = pop.read_message(index.store, msg_file)
         self.txtbox_from.setText(msg_data['from'])
         self.txtbox_to.setText(msg_data['to'])
         self.txtbox_subj.setText(msg_data['subject'])
         self.txtbox_body.setText(msg_data['body'])
+        # список вложений берется из индекса, вложение раскодируется, только когда его сохраняют
+        self.attachments = index.attachments(msg_file)
+        for attachment in self.attachments:
+            self.attachment_list.addItem(f"{self.attachment_name(attachment)} "
+                                         f"({attachment['content_type']}, {size_text(attachment['size'])})")
+        self.label_attachments.setVisible(bool(self.attachments))
+        self.attachment_list.setVisible(bool(self.attachments))
+        self.attachment_list.itemDoubleClicked.connect(self.save_attachment)
+
+    @staticmethod
+    def attachment_name(attachment):
+        if attachment['filename']:
+            return os.path.basename(attachment['filename'])
+        extension = mimetypes.guess_extension(attachment['content_type']) or '.bin'
+        return f"part-{attachment['part']}{extension}"
+
+    def save_attachment(self, item):
+        attachment = self.attachments[self.attachment_list.row(item)]
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save attachment", self.attachment_name(attachment))
+        if not path:
+            return
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            shutil.copyfile(self.index.attachment_file(self.msg_file, attachment['part']), path)
+        except (OSError, KeyError) as error:
+            QtWidgets.QMessageBox.warning(self, "Save attachment", f"Could not save attachment: {error}")
+        finally:
+            QApplication.restoreOverrideCursor()
 
 
 class MessageForm(QWidget):
@@ -156,17 +514,13 @@ class MessageForm(QWidget):
         self.btn_send.clicked.connect(self.send_message)
 
     def send_message(self):
-        client = smtp_client.SMTPClient(self.settings.value('smtp_host'),
-                                        int(self.settings.value('smtp_port')),
-                                        self.settings.value('login'),
-                                        self.settings.value('password'))
-
-        res = client.send_letter(self.txtbox_from.text(),
-                                 self.txtbox_to.text().replace(" ", "").split(','),
-                                 self.txtbox_subj.text(),
-                                 self.txtbox_body.toPlainText())
-        if res == 0:
-            self.close()
+        # письмо уходит в исходящую очередь, отправкой занимаются потоки доставки
+        outbox.enqueue(self.txtbox_from.text(),
+                       self.txtbox_to.text().replace(" ", "").split(','),
+                       self.txtbox_subj.text(),
+                       self.txtbox_body.toPlainText())
+        delivery_engine.wake()
+        self.close()
 
 def application():
     app = QApplication(sys.argv)
@@ -177,7 +531,15 @@ def application():
     window.get_messages()
 
     window.refresh()
-    sys.exit(app.exec_())
+    try:
+        delivery_engine.start()
+    except BlockingIOError as error:
+        # очередь общая: письма, поставленные в нее здесь, отправит другой движок
+        QtWidgets.QMessageBox.warning(window, "Outbox", f"Outbox is not delivered by this window: {error}")
+    exit_code = app.exec_()
+    delivery_engine.stop()
+    outbox.close()
+    sys.exit(exit_code)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,342 @@
+import argparse
+import mmap
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from email.parser import BytesHeaderParser
+
+import message_store
+from message_index import MessageIndex, parse_message
+from message_store import headers_length, open_store, safe_name, store_config
+
+"""
+Массовый импорт писем в локальное хранилище: файлы mbox, каталоги Maildir (вместе с
+вложенными папками Maildir++) и каталоги писем клиента (.msg/ - отдельные файлы или пачки).
+Источники разбиваются на порции по unit_messages писем или unit_bytes байт; порции
+разбираются и сжимаются в пуле процессов (ProcessPoolExecutor), а главный процесс
+записывает готовые порции в хранилище одной блокировкой и в индекс одной транзакцией.
+Разбор и сжатие - основная работа импорта, поэтому скорость растет с числом ядер.
+Письма с Message-ID, который уже есть в хранилище, пропускаются, поэтому прерванный
+импорт можно просто запустить еще раз.
+
+Тот же механизм выполняет полную переиндексацию хранилища (например, после изменения
+формата индекса): письма читаются из хранилища и заново разбираются в пуле процессов.
+
+Запуск из командной строки:
+python mail_import.py archive.mbox ~/Maildir old_client/.msg/ [--dest .msg/] [--workers 4]
+python mail_import.py --reindex [--dest .msg/]
+"""
+
+# размер порции работы одного процесса пула
+unit_messages = 256
+unit_bytes = 8 * 2 ** 20
+# строки вида >From в mbox экранируют строки From в тексте письма (mboxo и mboxrd)
+mbox_escaped_from = re.compile(rb'^>(>*From )', re.MULTILINE)
+
+
+def mbox_items(path):
+    """
+    Письма файла mbox: письмо начинается строкой "From " и продолжается до следующей такой строки
+
+    :return: список (mbox, путь, смещение, длина)
+    """
+    size = os.path.getsize(path)
+    if not size:
+        return []
+    with open(path, 'rb') as mbox_file, mmap.mmap(mbox_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        starts = [0] if mapped[:5] == b'From ' else []
+        position = mapped.find(b'\nFrom ')
+        while position >= 0:
+            starts.append(position + 1)
+            position = mapped.find(b'\nFrom ', position + 1)
+    ends = starts[1:] + [size]
+    return [('mbox', path, start, end - start) for start, end in zip(starts, ends)]
+
+
+def is_maildir(path):
+    return all(os.path.isdir(os.path.join(path, name)) for name in ('cur', 'new'))
+
+
+def maildir_items(path):
+    """
+    Письма Maildir из cur и new, а также из вложенных папок Maildir++ (.Folder)
+
+    :return: список (file, путь, 0, длина)
+    """
+    folders = [path] + sorted(os.path.join(path, name) for name in os.listdir(path)
+                              if name.startswith('.') and is_maildir(os.path.join(path, name)))
+    items = []
+    for folder in folders:
+        for subdir in ('cur', 'new'):
+            with os.scandir(os.path.join(folder, subdir)) as entries:
+                # имя письма Maildir начинается со времени доставки
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        items.append(('file', entry.path, 0, entry.stat().st_size))
+    return items
+
+
+def directory_items(path):
+    """
+    Письма каталога клиента: хранилище с .store.json читается через message_store,
+    иначе каждый файл каталога (кроме служебных) - одно письмо
+
+    :return: список (store, каталог, ключ, длина) или (file, путь, 0, длина)
+    """
+    if os.path.exists(os.path.join(path, store_config)):
+        return [('store', path, msg_file, size) for msg_file, mtime, size in open_store(path).entries()]
+    with os.scandir(path) as dir_entries:
+        entries = [entry for entry in dir_entries if entry.is_file() and not entry.name.startswith('.')]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    return [('file', entry.path, 0, entry.stat().st_size) for entry in entries]
+
+
+def source_items(path):
+    """
+    Письма источника импорта по его виду: файл - mbox, каталог - Maildir или каталог писем
+    """
+    if os.path.isfile(path):
+        return mbox_items(path)
+    if is_maildir(path):
+        return maildir_items(path)
+    if os.path.isdir(path):
+        return directory_items(path)
+    raise FileNotFoundError(path)
+
+
+def work_units(items):
+    """
+    Разбить письма на порции не больше unit_messages писем и unit_bytes байт
+    """
+    units = []
+    unit = []
+    unit_size = 0
+    for item in items:
+        if unit and (len(unit) >= unit_messages or unit_size + item[3] > unit_bytes):
+            units.append(unit)
+            unit, unit_size = [], 0
+        unit.append(item)
+        unit_size += item[3]
+    if unit:
+        units.append(unit)
+    return units
+
+
+def read_item(item):
+    """
+    Прочитать письмо источника целиком
+    """
+    kind, path, offset, length = item
+    if kind == 'store':
+        return bytes(open_store(path).read(offset))
+    with open(path, 'rb') as source:
+        source.seek(offset)
+        data = source.read(length) if kind == 'mbox' else source.read()
+    if kind == 'mbox':
+        # строка-разделитель "From " не входит в письмо, экранирование строк From снимается
+        data = mbox_escaped_from.sub(rb'\1', data[data.find(b'\n') + 1:])
+    return data
+
+
+def message_id(data):
+    """
+    Message-ID письма в том же виде, в каком его сохраняет POP3 клиент (без <> и пробелов)
+    """
+    length = headers_length(data)
+    headers = BytesHeaderParser().parsebytes(data[:len(data) if length is None else length])
+    return (headers['Message-ID'] or '').strip(' <>\t\r\n')
+
+
+def is_stored(store, msg_id):
+    """
+    Есть ли в хранилище письмо с таким Message-ID (письма без Message-ID не считаются повторами)
+    """
+    if not msg_id:
+        return False
+    try:
+        store.stat(safe_name(msg_id))
+    except KeyError:
+        return False
+    return True
+
+
+def worker_init():
+    # хранилища, открытые родительским процессом до fork, делят с ним блокировку файла:
+    # процесс пула открывает свои
+    message_store.stores.clear()
+
+
+def import_unit(unit, messages_dir):
+    """
+    Порция импорта в процессе пула: прочитать, разобрать и подготовить к записи письма порции
+
+    :return: список (результат store.prepare, Message-ID, результат parse_message) или None для повторов
+    """
+    store = open_store(messages_dir)
+    results = []
+    for item in unit:
+        data = read_item(item)
+        msg_id = message_id(data)
+        if is_stored(store, msg_id):
+            results.append(None)
+            continue
+        results.append((store.prepare(data), msg_id, parse_message(data)))
+    return results
+
+
+def reindex_unit(keys, messages_dir):
+    """
+    Порция переиндексации в процессе пула: заново разобрать письма хранилища
+
+    :return: список пар (ключ, результат parse_message)
+    """
+    store = open_store(messages_dir)
+    results = []
+    for msg_file in keys:
+        try:
+            results.append((msg_file, parse_message(bytes(store.read(msg_file)))))
+        except KeyError:
+            # письмо удалено во время переиндексации
+            continue
+    return results
+
+
+class MailImporter:
+    """
+    Класс массового импорта и переиндексации.
+    Атрибуты класса:
+    messages_dir - каталог писем, в который идет импорт;
+    workers - число процессов пула;
+    on_progress - функция (обработано писем, всего писем), вызывается после каждой порции
+    """
+
+    def __init__(self, messages_dir, workers=None, on_progress=None):
+        self.messages_dir = messages_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.on_progress = on_progress
+        self.index = MessageIndex(messages_dir)
+        self.store = self.index.store
+
+    def __run(self, units, worker, write):
+        """
+        Выполнить порции в пуле процессов и записать результаты в порядке порций, чтобы письма
+        попали в индекс в порядке источника. В работе не больше двух порций на процесс,
+        поэтому память не зависит от размера импорта
+
+        :param write: функция записи результата порции, возвращает число обработанных писем
+        """
+        total = sum(map(len, units))
+        done = 0
+        if self.on_progress is not None:
+            self.on_progress(done, total)
+        with ProcessPoolExecutor(self.workers, initializer=worker_init) as executor:
+            pending = deque()
+            try:
+                for unit in units:
+                    pending.append((executor.submit(worker, unit, self.messages_dir), len(unit)))
+                    while len(pending) >= 2 * self.workers or (pending and pending[0][0].done()):
+                        future, count = pending.popleft()
+                        write(future.result())
+                        done += count
+                        if self.on_progress is not None:
+                            self.on_progress(done, total)
+                while pending:
+                    future, count = pending.popleft()
+                    write(future.result())
+                    done += count
+                    if self.on_progress is not None:
+                        self.on_progress(done, total)
+            finally:
+                for future, _ in pending:
+                    future.cancel()
+        return total
+
+    def import_paths(self, paths):
+        """
+        Импортировать письма из mbox, Maildir и каталогов писем
+
+        :return: словарь imported, skipped, seconds
+        """
+        start = time.perf_counter()
+        items = [item for path in paths for item in source_items(path)]
+        result = {'imported': 0, 'skipped': 0}
+        # повторы внутри одного импорта: порции разбираются параллельно и не видят друг друга
+        seen = set()
+
+        def write(results):
+            batch = []
+            entries = []
+            for prepared in results:
+                if prepared is None:
+                    result['skipped'] += 1
+                    continue
+                msg_id = prepared[1]
+                if (msg_id and msg_id in seen) or is_stored(self.store, msg_id):
+                    self.store.discard(prepared[0])
+                    result['skipped'] += 1
+                    continue
+                if msg_id:
+                    seen.add(msg_id)
+                batch.append(prepared[:2])
+                entries.append(prepared[2])
+            keys = self.store.add_prepared(batch)
+            self.index.add_parsed(list(zip(keys, entries)))
+            result['imported'] += len(keys)
+
+        self.__run(work_units(items), import_unit, write)
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    def reindex(self):
+        """
+        Заново построить индекс по всем письмам хранилища; порядок писем в списке сохраняется
+
+        :return: словарь reindexed, seconds
+        """
+        start = time.perf_counter()
+        ordered = [msg_data['msg_file'] for msg_data in self.index.list()]
+        sizes = {msg_file: size for msg_file, mtime, size in self.store.entries()}
+        known = set(ordered)
+        ordered = [msg_file for msg_file in ordered if msg_file in sizes]
+        ordered += [msg_file for msg_file in sizes if msg_file not in known]
+        units = [[msg_file for _, _, msg_file, _ in unit]
+                 for unit in work_units([('store', None, msg_file, sizes[msg_file]) for msg_file in ordered])]
+        self.index.reset()
+        total = self.__run(units, reindex_unit, self.index.add_parsed)
+        return {'reindexed': total, 'seconds': time.perf_counter() - start}
+
+    def close(self):
+        self.index.close()
+
+
+def print_progress(done, total):
+    print(f"\r{done}/{total} messages", end='' if done < total else '\n', flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import of mbox, Maildir and message directories")
+    parser.add_argument('sources', nargs='*', help="файлы mbox, каталоги Maildir или каталоги писем")
+    parser.add_argument('--dest', default='.msg/', help="каталог писем клиента")
+    parser.add_argument('--workers', type=int, default=None, help="число процессов (по умолчанию - число ядер)")
+    parser.add_argument('--reindex', action='store_true', help="заново построить индекс каталога писем")
+    args = parser.parse_args()
+    if not args.sources and not args.reindex:
+        parser.error("nothing to do: give sources to import or --reindex")
+
+    importer = MailImporter(args.dest, args.workers, on_progress=print_progress)
+    try:
+        if args.sources:
+            summary = importer.import_paths(args.sources)
+            print(f"Imported {summary['imported']} messages, skipped {summary['skipped']} duplicates "
+                  f"in {summary['seconds']:.1f} s")
+        if args.reindex:
+            summary = importer.reindex()
+            print(f"Reindexed {summary['reindexed']} messages in {summary['seconds']:.1f} s")
+    except (OSError, ValueError) as error:
+        print(f"Import failed: {error}")
+        sys.exit(1)
+    finally:
+        importer.close()
@@ -0,0 +1,563 @@
+import io
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from email import errors as email_errors
+from email import header as email_header
+from email import utils as email_utils
+from email.parser import BytesHeaderParser
+
+from message_store import headers_length, open_store
+from mime_parts import BlobStore, read_structure
+
+index_filename = '.index.sqlite'
+header_keys = ('from', 'to', 'subject', 'date')
+columns = ('msg_file', 'mtime', 'size', 'msg_from', 'msg_to', 'subject', 'date', 'body_offset', 'timestamp')
+
+# порядок списка писем: выражение сортировки для каждого ключа. Выражения совпадают с индексами
+# таблицы (rowid входит в любой индекс), поэтому страница списка читается по индексу без сортировки
+# всей таблицы. NULL заменяется пустым значением, чтобы строки сравнивались при поиске позиции письма
+sort_orders = {
+    'arrival': "rowid",
+    'from': "COALESCE(msg_from, '') COLLATE NOCASE",
+    'subject': "COALESCE(subject, '') COLLATE NOCASE",
+    'date': "COALESCE(timestamp, 0)",
+}
+
+# поля полнотекстового поиска: префикс в запросе (from:alice) -> колонка таблицы messages_fts,
+# и веса колонок в ранжировании bm25 (совпадение в теме важнее совпадения в тексте письма)
+search_fields = {'from': 'msg_from', 'to': 'msg_to', 'subject': 'subject', 'body': 'body'}
+search_weights = (4.0, 2.0, 8.0, 1.0)
+# сколько последних найденных писем ранжируется: bm25 считается для каждой строки, и на запросе,
+# который находит почти весь ящик, ранжирование всех писем заняло бы сотни миллисекунд
+rank_window = 5000
+# слово или фраза в кавычках, возможно с префиксом поля
+search_term = re.compile(r'(?:(\w+):)?(?:"([^"]*)"?|(\S+))')
+
+
+def decode_header_value(value):
+    """
+    Полностью раскодировать значение заголовка (все части RFC 2047)
+    """
+    if value is None:
+        return None
+    try:
+        return str(email_header.make_header(email_header.decode_header(value)))
+    except (UnicodeDecodeError, LookupError, email_errors.HeaderParseError):
+        return value
+
+
+def parse_headers(header_bytes):
+    """
+    Раскодировать заголовки from/to/subject/date из байт заголовков письма
+    """
+    email_msg = BytesHeaderParser().parsebytes(bytes(header_bytes))
+    return {key: decode_header_value(email_msg[key]) for key in header_keys}
+
+
+def read_headers(path):
+    """
+    Прочитать только заголовки письма, не трогая тело
+
+    :param path: путь к файлу письма
+    :return: словарь заголовков from/to/subject/date и смещение начала тела в файле
+    """
+    header_lines = []
+    with open(path, 'rb') as message_file:
+        for line in message_file:
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n'):
+                break
+    header_bytes = b''.join(header_lines)
+    return parse_headers(header_bytes), len(header_bytes)
+
+
+def date_timestamp(date):
+    """
+    Время из заголовка Date в секундах эпохи или None, если дата не разбирается
+    """
+    if not date:
+        return None
+    try:
+        return email_utils.parsedate_to_datetime(date).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def index_fields(header_bytes):
+    """
+    Колонки таблицы messages, которые берутся из заголовков письма (после msg_file, mtime и size)
+    """
+    headers = parse_headers(header_bytes)
+    return (headers['from'], headers['to'], headers['subject'], headers['date'], len(header_bytes),
+            date_timestamp(headers['date']))
+
+
+def parse_message(data):
+    """
+    Разобрать письмо для индекса без обращения к хранилищу и базе, например в процессе импорта
+
+    :param data: письмо целиком (bytes)
+    :return: колонки из заголовков (index_fields), текст письма и вложения - для MessageIndex.add_parsed
+    """
+    length = headers_length(data)
+    body, parts = read_structure(io.BytesIO(data))
+    return index_fields(data[:len(data) if length is None else length]), body, parts
+
+
+def read_text_body(path):
+    """
+    Текст письма из файла (text_body)
+    """
+    with open(path, 'rb') as message_file:
+        return text_body(message_file)
+
+
+def text_body(data):
+    """
+    Текст письма для поискового индекса: первая часть text/plain, раскодированная из base64
+    или quoted-printable в строку. Вложения пропускаются без раскодирования
+
+    :param data: письмо целиком (bytes или memoryview из хранилища) или бинарный поток письма
+    :return: текст или пустая строка, если текстовой части нет
+    """
+    stream = data if hasattr(data, 'readline') else io.BytesIO(data)
+    return read_structure(stream)[0]
+
+
+def match_query(text):
+    """
+    Перевести поисковый запрос пользователя в запрос FTS5.
+    Слова ищутся по префиксу (invo найдет invoice), фраза в кавычках - целиком, все условия
+    должны выполняться одновременно. Префикс from:, to:, subject: или body: ограничивает
+    условие одним полем. Синтаксис FTS5 в тексте пользователя не действует: каждое условие
+    берется в кавычки, поэтому запрос не может вызвать ошибку разбора
+
+    :return: строка для MATCH или None, если в запросе нет ни одного слова
+    """
+    conditions = []
+    for field, phrase, word in search_term.findall(text):
+        column = search_fields.get(field.lower())
+        if field and column is None:
+            # двоеточие внутри слова, а не префикс поля
+            word = f"{field}:{phrase or word}"
+        value = phrase if phrase else word.rstrip('*')
+        if not re.search(r'\w', value):
+            continue
+        condition = '"' + value.replace('"', '""') + '"' + ('' if phrase else '*')
+        conditions.append(f"{column} : {condition}" if column else condition)
+    return ' AND '.join(conditions) if conditions else None
+
+
+class MessageIndex:
+    """
+    Класс постоянного индекса заголовков локального хранилища писем.
+    Индекс хранится в sqlite базе внутри каталога писем и обновляется по мере
+    сохранения и удаления писем, поэтому для вывода списка писем не нужно
+    перечитывать каждое письмо.
+    Атрибуты класса:
+    messages_dir - каталог писем;
+    store - хранилище писем каталога (message_store);
+    blobs - хранилище раскодированных вложений (mime_parts.BlobStore);
+    index_path - путь к файлу базы индекса
+    """
+
+    def __init__(self, messages_dir):
+        self.messages_dir = messages_dir
+        self.store = open_store(messages_dir)
+        self.blobs = BlobStore(messages_dir)
+        self.index_path = os.path.join(messages_dir, index_filename)
+        self.__lock = threading.Lock()
+        # соединение используется из разных потоков (фоновая докачка писем), доступ - под блокировкой
+        self.__db = sqlite3.connect(self.index_path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                msg_file TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER,
+                msg_from TEXT,
+                msg_to TEXT,
+                subject TEXT,
+                date TEXT,
+                body_offset INTEGER,
+                timestamp REAL
+            )""")
+        fts_exists = self.__db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
+        # поисковый индекс: rowid строки совпадает с rowid письма в messages
+        self.__db.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                {', '.join(search_fields.values())}, tokenize = 'unicode61 remove_diacritics 2'
+            )""")
+        attachments_exist = self.__db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'attachments'").fetchone() is not None
+        # вложения писем: blob - хеш раскодированного содержимого в blobs или NULL, пока вложение не открывали
+        self.__db.execute("""
+            CREATE TABLE IF NOT EXISTS attachments (
+                msg_file TEXT,
+                part INTEGER,
+                filename TEXT,
+                content_type TEXT,
+                size INTEGER,
+                blob TEXT,
+                PRIMARY KEY (msg_file, part)
+            )""")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS attachments_by_blob ON attachments(blob)")
+        self.__migrate(fts_exists, attachments_exist)
+        for key, expression in sort_orders.items():
+            if key != 'arrival':
+                self.__db.execute(f"CREATE INDEX IF NOT EXISTS messages_by_{key} ON messages({expression})")
+        self.__db.commit()
+
+    def __migrate(self, fts_exists, attachments_exist):
+        """
+        Дополнить индекс, созданный прошлыми версиями: колонка timestamp для сортировки по дате,
+        поисковый индекс и список вложений по уже сохраненным письмам
+        """
+        known = {row[1] for row in self.__db.execute("PRAGMA table_info(messages)")}
+        if 'timestamp' not in known:
+            self.__db.execute("ALTER TABLE messages ADD COLUMN timestamp REAL")
+            self.__db.executemany("UPDATE messages SET timestamp = ? WHERE rowid = ?",
+                                  [(date_timestamp(date), rowid)
+                                   for rowid, date in self.__db.execute("SELECT rowid, date FROM messages")])
+        if fts_exists and attachments_exist:
+            return
+        rows = self.__db.execute("SELECT rowid, msg_file, msg_from, msg_to, subject FROM messages").fetchall()
+        for rowid, msg_file, msg_from, msg_to, subject in rows:
+            try:
+                body, parts = self.__structure(msg_file)
+            except KeyError:
+                body, parts = '', []
+            if not fts_exists:
+                self.__db.execute("INSERT INTO messages_fts (rowid, msg_from, msg_to, subject, body) "
+                                  "VALUES (?, ?, ?, ?, ?)", (rowid, msg_from, msg_to, subject, body))
+            if not attachments_exist:
+                self.__insert_attachments(self.__db, msg_file, parts)
+
+    def __structure(self, msg_file):
+        """
+        Текст письма и его вложения за один проход по письму (mime_parts.read_structure)
+        """
+        with self.store.open(msg_file) as stream:
+            return read_structure(stream)
+
+    def __row(self, msg_file):
+        mtime, size = self.store.stat(msg_file)
+        row = (msg_file, mtime, size) + index_fields(self.store.read_headers(msg_file))
+        body, parts = self.__structure(msg_file)
+        return row, body, parts
+
+    @staticmethod
+    def __insert_attachments(db, msg_file, parts):
+        db.executemany("INSERT INTO attachments (msg_file, part, filename, content_type, size) VALUES (?, ?, ?, ?, ?)",
+                       [(msg_file, part.index, part.filename, part.content_type, part.size) for part in parts])
+
+    @staticmethod
+    def __drop_attachments(db, msg_file):
+        """
+        Удалить вложения письма из индекса
+
+        :return: хеши раскодированных вложений письма (их файлы могут стать ненужными)
+        """
+        blobs = [blob for blob, in db.execute(
+            "SELECT blob FROM attachments WHERE msg_file = ? AND blob IS NOT NULL", (msg_file,))]
+        db.execute("DELETE FROM attachments WHERE msg_file = ?", (msg_file,))
+        return blobs
+
+    @classmethod
+    def __insert(cls, db, entries):
+        """
+        Записать письма в индекс, поисковый индекс и список вложений
+
+        :param entries: список (строка таблицы messages, текст письма, вложения mime_parts.MessagePart)
+        :return: хеши раскодированных вложений прежних версий писем
+        """
+        blobs = []
+        for row, body, parts in entries:
+            # REPLACE удаляет старую строку письма без триггеров, ее текст из поиска убираем сами
+            db.execute("DELETE FROM messages_fts WHERE rowid IN (SELECT rowid FROM messages WHERE msg_file = ?)",
+                       (row[0],))
+            cursor = db.execute(f"INSERT OR REPLACE INTO messages ({', '.join(columns)}) "
+                                f"VALUES ({', '.join('?' * len(columns))})", row)
+            db.execute("INSERT INTO messages_fts (rowid, msg_from, msg_to, subject, body) VALUES (?, ?, ?, ?, ?)",
+                       (cursor.lastrowid, row[3], row[4], row[5], body))
+            blobs += cls.__drop_attachments(db, row[0])
+            cls.__insert_attachments(db, row[0], parts)
+        return blobs
+
+    @classmethod
+    def __delete(cls, db, msg_files):
+        """
+        :return: хеши раскодированных вложений удаленных писем
+        """
+        blobs = []
+        for msg_file in msg_files:
+            db.execute("DELETE FROM messages_fts WHERE rowid IN (SELECT rowid FROM messages WHERE msg_file = ?)",
+                       (msg_file,))
+            db.execute("DELETE FROM messages WHERE msg_file = ?", (msg_file,))
+            blobs += cls.__drop_attachments(db, msg_file)
+        return blobs
+
+    def __release_blobs(self, blobs):
+        """
+        Удалить файлы вложений, на которые больше не ссылается ни одно письмо (вызывается под блокировкой)
+        """
+        for blob in set(blobs):
+            if self.__db.execute("SELECT 1 FROM attachments WHERE blob = ? LIMIT 1", (blob,)).fetchone() is None:
+                self.blobs.remove(blob)
+
+    def add(self, msg_file):
+        """
+        Добавить или обновить письмо в индексе
+
+        :param msg_file: имя файла письма в messages_dir
+        """
+        entry = self.__row(msg_file)
+        with self.__lock:
+            blobs = self.__insert(self.__db, [entry])
+            self.__db.commit()
+            self.__release_blobs(blobs)
+
+    def add_parsed(self, entries):
+        """
+        Добавить в индекс письма, уже разобранные parse_message, одной транзакцией
+
+        :param entries: список пар (ключ письма в хранилище, результат parse_message)
+        """
+        rows = []
+        for msg_file, (fields, body, parts) in entries:
+            mtime, size = self.store.stat(msg_file)
+            rows.append(((msg_file, mtime, size) + fields, body, parts))
+        with self.__lock:
+            blobs = self.__insert(self.__db, rows)
+            self.__db.commit()
+            self.__release_blobs(blobs)
+
+    def reset(self):
+        """
+        Очистить индекс и хранилище раскодированных вложений перед полной переиндексацией.
+        Письма в хранилище не удаляются
+        """
+        with self.__lock:
+            for table in ('messages_fts', 'attachments', 'messages'):
+                self.__db.execute(f"DELETE FROM {table}")
+            self.__db.commit()
+            shutil.rmtree(self.blobs.root, ignore_errors=True)
+            self.blobs = BlobStore(self.messages_dir)
+
+    def remove(self, msg_file):
+        """
+        Убрать письмо из индекса
+        """
+        with self.__lock:
+            blobs = self.__delete(self.__db, [msg_file])
+            self.__db.commit()
+            self.__release_blobs(blobs)
+
+    def delete_message(self, msg_file):
+        """
+        Удалить письмо из хранилища и его запись в индексе
+        """
+        self.store.delete(msg_file)
+        self.remove(msg_file)
+
+    def refresh(self):
+        """
+        Сверить индекс с хранилищем писем: проиндексировать новые и измененные письма
+        (по mtime и размеру), удалить записи пропавших писем.
+        Нужен, если письма попали в хранилище в обход индекса
+
+        :return: количество добавленных, обновленных и удаленных записей
+        """
+        with self.__lock:
+            known = {msg_file: (mtime, size) for msg_file, mtime, size
+                     in self.__db.execute("SELECT msg_file, mtime, size FROM messages")}
+        changed = []
+        present = set()
+        for msg_file, mtime, size in self.store.entries():
+            present.add(msg_file)
+            if known.get(msg_file) != (mtime, size):
+                changed.append(self.__row(msg_file))
+        removed = [msg_file for msg_file in known if msg_file not in present]
+        with self.__lock:
+            blobs = self.__insert(self.__db, changed) + self.__delete(self.__db, removed)
+            self.__db.commit()
+            self.__release_blobs(blobs)
+        return len(changed) + len(removed)
+
+    def list(self):
+        """
+        Список писем из индекса
+
+        :return: список словарей с ключами msg_file, from, to, subject, date
+        """
+        with self.__lock:
+            rows = self.__db.execute(
+                "SELECT msg_file, msg_from, msg_to, subject, date FROM messages ORDER BY rowid").fetchall()
+        return [{'msg_file': msg_file, 'from': msg_from, 'to': msg_to, 'subject': subject, 'date': date}
+                for msg_file, msg_from, msg_to, subject, date in rows]
+
+    @staticmethod
+    def __filter(text):
+        """
+        Условие WHERE и его параметры для отбора писем по поисковому запросу
+        """
+        match = match_query(text) if text else None
+        if match is None:
+            return "1", ()
+        return "rowid IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)", (match,)
+
+    def __ranked(self, match, offset=0, limit=-1):
+        """
+        Письма, найденные поиском, от самых подходящих (bm25 среди rank_window последних найденных)
+        """
+        return self.__db.execute(
+            f"SELECT messages.rowid, msg_file, msg_from, msg_to, subject, date FROM ("
+            f"SELECT rowid, bm25(messages_fts, {', '.join(map(str, search_weights))}) AS score "
+            f"FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT ?"
+            f") AS found JOIN messages ON messages.rowid = found.rowid "
+            f"ORDER BY found.score, found.rowid DESC LIMIT ? OFFSET ?", (match, rank_window, limit, offset)).fetchall()
+
+    def __scan_hint(self, order, match, offset, limit):
+        """
+        Подсказка плана для страницы найденных писем в порядке order.
+        Если запрос находит большую часть ящика, страницу быстрее набрать, идя по индексу порядка
+        и пропуская не найденные письма, чем сортировать все найденные; sqlite сам этого не знает
+        """
+        if match is None or order == 'arrival' or limit < 0:
+            return ""
+        found = self.__db.execute("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH ?", (match,)).fetchone()[0]
+        total = self.__db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        # строк индекса до конца страницы: (offset + limit) / доля найденных
+        if found and (offset + limit) * total < found * found:
+            return f"INDEXED BY messages_by_{order}"
+        return ""
+
+    def query(self, order='arrival', descending=False, text=None, offset=0, limit=-1):
+        """
+        Страница списка писем в заданном порядке
+
+        :param order: ключ sort_orders или relevance - по убыванию релевантности запросу text
+        :param descending: обратный порядок (для relevance не действует)
+        :param text: поисковый запрос (match_query), показывать только найденные письма
+        :param offset: сколько писем пропустить
+        :param limit: максимум писем в странице (-1 - все)
+        :return: список словарей с ключами msg_file, from, to, subject, date
+        """
+        match = match_query(text) if text else None
+        if order == 'relevance' and match is None:
+            order = 'arrival'
+        with self.__lock:
+            if order == 'relevance':
+                rows = [row[1:] for row in self.__ranked(match, offset, limit)]
+            else:
+                where, params = self.__filter(text)
+                direction = 'DESC' if descending else 'ASC'
+                hint = self.__scan_hint(order, match, offset, limit)
+                rows = self.__db.execute(
+                    f"SELECT msg_file, msg_from, msg_to, subject, date FROM messages {hint} WHERE {where} "
+                    f"ORDER BY {sort_orders[order]} {direction}, rowid {direction} LIMIT ? OFFSET ?",
+                    params + (limit, offset)).fetchall()
+        return [{'msg_file': msg_file, 'from': msg_from, 'to': msg_to, 'subject': subject, 'date': date}
+                for msg_file, msg_from, msg_to, subject, date in rows]
+
+    def search(self, text, limit=50):
+        """
+        Полнотекстовый поиск по отправителю, получателям, теме и тексту писем
+
+        :param text: запрос: слова (ищутся по префиксу), "фразы", префиксы полей from: to: subject: body:
+        :return: до limit писем от самых подходящих, в формате query
+        """
+        return self.query('relevance', text=text, limit=limit)
+
+    def count(self, text=None):
+        """
+        Количество писем (с поисковым запросом, как в query)
+        """
+        match = match_query(text) if text else None
+        with self.__lock:
+            if match is None:
+                return self.__db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            # у каждого письма ровно одна строка в поисковом индексе, таблицу писем читать не нужно
+            return self.__db.execute("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH ?",
+                                     (match,)).fetchone()[0]
+
+    def position(self, msg_file, order='arrival', descending=False, text=None):
+        """
+        Номер письма в списке query с теми же параметрами
+
+        :return: номер строки или None, если письма нет в индексе или оно не проходит фильтр
+        """
+        match = match_query(text) if text else None
+        if order == 'relevance' and match is not None:
+            with self.__lock:
+                ranked = [row[1] for row in self.__ranked(match)]
+            return ranked.index(msg_file) if msg_file in ranked else None
+        if order == 'relevance':
+            order = 'arrival'
+        where, params = self.__filter(text)
+        expression = sort_orders[order]
+        with self.__lock:
+            found = self.__db.execute(f"SELECT {expression}, rowid FROM messages WHERE msg_file = ? AND {where}",
+                                      (msg_file,) + params).fetchone()
+            if found is None:
+                return None
+            # письма перед данным: меньше (больше в обратном порядке) по ключу, при равенстве - по rowid
+            return self.__db.execute(
+                f"SELECT COUNT(*) FROM messages WHERE {where} "
+                f"AND ({expression}, rowid) {'>' if descending else '<'} (?, ?)", params + found).fetchone()[0]
+
+    def get(self, msg_file):
+        """
+        Запись индекса для одного письма или None
+        """
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT msg_file, msg_from, msg_to, subject, date, body_offset FROM messages WHERE msg_file = ?",
+                (msg_file,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('msg_file', 'from', 'to', 'subject', 'date', 'body_offset'), row))
+
+    def attachments(self, msg_file):
+        """
+        Вложения письма из индекса, само письмо не читается
+
+        :return: список словарей с ключами part, filename, content_type, size, blob
+        """
+        with self.__lock:
+            rows = self.__db.execute("SELECT part, filename, content_type, size, blob FROM attachments "
+                                     "WHERE msg_file = ? ORDER BY part", (msg_file,)).fetchall()
+        return [dict(zip(('part', 'filename', 'content_type', 'size', 'blob'), row)) for row in rows]
+
+    def attachment_file(self, msg_file, part):
+        """
+        Путь к раскодированному вложению. Вложение раскодируется при первом обращении:
+        часть письма читается потоком и пишется в хранилище вложений блоками, одинаковые
+        вложения разных писем хранятся одним файлом
+
+        :param part: номер части (ключ part из attachments)
+        """
+        with self.__lock:
+            row = self.__db.execute("SELECT blob FROM attachments WHERE msg_file = ? AND part = ?",
+                                    (msg_file, part)).fetchone()
+        if row is None:
+            raise KeyError((msg_file, part))
+        if self.blobs.exists(row[0]):
+            return self.blobs.path(row[0])
+        with self.store.open(msg_file) as stream:
+            extracted = self.blobs.extract(stream, part)
+        if extracted is None:
+            raise KeyError((msg_file, part))
+        with self.__lock:
+            self.__db.execute("UPDATE attachments SET blob = ? WHERE msg_file = ? AND part = ?",
+                              (extracted[0], msg_file, part))
+            self.__db.commit()
+        return self.blobs.path(extracted[0])
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
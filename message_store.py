@@ -0,0 +1,865 @@
+import atexit
+import contextlib
+import io
+import json
+import lzma
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: хранилище блокируется только между потоками одного процесса
+    fcntl = None
+
+"""
+Хранилище файлов писем. Письмо хранится под ключом (msg_file), который строится из Message-ID:
+символы, небезопасные для имени файла, заменяются, пустой Message-ID заменяется на message,
+а при совпадении ключей добавляется суффикс -2, -3 ..., поэтому письма не перезаписывают друг друга.
+
+Есть два вида хранилища с одинаковыми методами:
+DirectoryStore - каждое письмо в отдельном файле каталога (прежний формат);
+PackStore - письма дописываются в конец больших файлов-пачек, по отдельности сжатые zlib или lzma,
+а смещения писем хранятся в компактном журнале. Письма читаются из пачек через mmap без копирования,
+место удаленных писем освобождается компактацией (compact).
+
+Вид хранилища записывается в файл .store.json каталога писем при первом открытии: новый каталог
+получает default_backend (переменная окружения MAIL_STORE), а каталог с письмами прежнего формата
+остается DirectoryStore. Хранилище каталога в процессе одно (open_store), его используют индекс,
+клиенты, окно почтового клиента и консольный клиент.
+"""
+
+store_config = '.store.json'
+default_backend = os.environ.get('MAIL_STORE', 'pack')
+# сжатие новых писем в PackStore: none, zlib, lzma
+default_compression = os.environ.get('MAIL_STORE_COMPRESSION', 'zlib')
+
+compressions = {'none': 0, 'zlib': 1, 'lzma': 2}
+max_key_length = 120
+unsafe_chars = re.compile(r'[^A-Za-z0-9._@+=-]')
+chunk_size = 65536
+
+# запись пачки: сигнатура, флаги (сжатие, удаление), длина ключа, длина данных в пачке,
+# длина письма, время записи, CRC32 данных; затем ключ и данные
+record_header = struct.Struct('<4sBHQQdI')
+record_magic = b'MSG1'
+tombstone_flag = 0x80
+# запись журнала смещений: операция, длина ключа, номер пачки, смещение данных, длина данных в пачке,
+# длина письма, время записи, сжатие; затем ключ
+index_entry = struct.Struct('<BHIQQQdB')
+index_magic = b'MIDX1\n'
+op_put, op_delete = 1, 2
+# новая пачка начинается, когда текущая больше этого размера
+pack_size_limit = 256 * 2 ** 20
+# компактация нужна, когда удаленные письма занимают больше этой доли пачек и больше compact_min_bytes
+compact_ratio = 0.5
+compact_min_bytes = 16 * 2 ** 20
+
+stores = {}
+stores_lock = threading.Lock()
+
+
+def safe_name(message_id):
+    """
+    Имя письма из Message-ID, безопасное для файловой системы (без / и начальной точки)
+    """
+    return unsafe_chars.sub('_', message_id or '').lstrip('.')[:max_key_length] or 'message'
+
+
+def candidate_keys(message_id):
+    """
+    Ключи для нового письма по порядку: имя из Message-ID, затем с суффиксами -2, -3 ...
+    """
+    name = safe_name(message_id)
+    yield name
+    number = 2
+    while True:
+        yield f"{name}-{number}"
+        number += 1
+
+
+def headers_length(data):
+    """
+    Длина заголовков письма вместе с пустой строкой после них
+
+    :param data: начало письма (bytes)
+    :return: длина или None, если конец заголовков в data не найден
+    """
+    for blank in (b'\r\n', b'\n'):
+        if data.startswith(blank):
+            return len(blank)
+    ends = [position + len(separator) for separator in (b'\n\r\n', b'\n\n')
+            for position in (data.find(separator),) if position >= 0]
+    return min(ends) if ends else None
+
+
+def fsync_dir(path):
+    """
+    Сбросить на диск запись каталога (после создания или переименования файла)
+    """
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def temp_file(messages_dir):
+    """
+    Временный файл для скачиваемого письма (служебные файлы начинаются с точки)
+    """
+    return tempfile.NamedTemporaryFile(mode='wb', dir=messages_dir, prefix='.retr-', delete=False)
+
+
+def inflate(data, method):
+    """
+    Данные записи блоками не больше chunk_size: сжатые распаковываются по мере чтения,
+    несжатые отдаются срезами memoryview без копирования
+    """
+    if method == 1:
+        decompressor = zlib.decompressobj()
+        for start in range(0, len(data), chunk_size):
+            yield decompressor.decompress(data[start:start + chunk_size], chunk_size)
+            while decompressor.unconsumed_tail:
+                yield decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+    elif method == 2:
+        decompressor = lzma.LZMADecompressor()
+        for start in range(0, len(data), chunk_size):
+            yield decompressor.decompress(data[start:start + chunk_size], chunk_size)
+            while not decompressor.needs_input and not decompressor.eof:
+                yield decompressor.decompress(b'', chunk_size)
+    else:
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+
+class RecordReader(io.RawIOBase):
+    """
+    Класс потока чтения письма из блоков inflate (для построчного чтения оборачивается в BufferedReader)
+    """
+
+    def __init__(self, blocks):
+        self.__blocks = blocks
+        self.__pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.__pending:
+            self.__pending = next(self.__blocks, None)
+            if self.__pending is None:
+                self.__pending = b''
+                return 0
+        length = min(len(buffer), len(self.__pending))
+        buffer[:length] = self.__pending[:length]
+        self.__pending = self.__pending[length:]
+        return length
+
+
+class DirectoryStore:
+    """
+    Класс хранилища, в котором каждое письмо - отдельный файл каталога с именем-ключом.
+    Атрибуты класса:
+    messages_dir - каталог писем
+    """
+    backend = 'directory'
+
+    def __init__(self, messages_dir):
+        self.messages_dir = messages_dir
+        # письма, записанные после прошлого sync
+        self.__unsynced = set()
+        self.__lock = threading.Lock()
+
+    def __path(self, msg_file):
+        return os.path.join(self.messages_dir, msg_file)
+
+    def temp_file(self):
+        return temp_file(self.messages_dir)
+
+    def add_file(self, tmp_path, message_id=''):
+        """
+        Сохранить письмо из временного файла под новым ключом
+
+        :return: ключ письма
+        """
+        for msg_file in candidate_keys(message_id):
+            try:
+                # занимаем имя атомарно: параллельная запись выберет следующее
+                os.close(os.open(self.__path(msg_file), os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+            except FileExistsError:
+                continue
+            os.replace(tmp_path, self.__path(msg_file))
+            with self.__lock:
+                self.__unsynced.add(msg_file)
+            return msg_file
+
+    def replace_file(self, msg_file, tmp_path):
+        """
+        Заменить письмо (например, заголовки - полным письмом) содержимым временного файла
+        """
+        os.replace(tmp_path, self.__path(msg_file))
+        with self.__lock:
+            self.__unsynced.add(msg_file)
+
+    def sync(self):
+        """
+        Сбросить на диск письма, записанные после прошлого sync, и записи каталога о них
+        """
+        with self.__lock:
+            unsynced, self.__unsynced = self.__unsynced, set()
+        for msg_file in unsynced:
+            try:
+                fsync_file(self.__path(msg_file))
+            except FileNotFoundError:
+                # письмо уже удалено
+                pass
+        if unsynced:
+            fsync_dir(self.messages_dir)
+
+    def prepare(self, data):
+        """
+        Подготовить письмо к add_prepared; не требует блокировки и может выполняться в другом процессе
+
+        :param data: письмо (bytes)
+        :return: путь к временному файлу письма
+        """
+        with self.temp_file() as message_file:
+            message_file.write(data)
+        return message_file.name
+
+    def add_prepared(self, items):
+        """
+        Сохранить подготовленные письма
+
+        :param items: список пар (результат prepare, Message-ID)
+        :return: ключи писем
+        """
+        return [self.add_file(tmp_path, message_id) for tmp_path, message_id in items]
+
+    def discard(self, tmp_path):
+        """
+        Удалить подготовленное письмо, которое не нужно сохранять
+        """
+        os.remove(tmp_path)
+
+    def stat(self, msg_file):
+        """
+        :return: время изменения и размер письма
+        """
+        try:
+            stat = os.stat(self.__path(msg_file))
+        except FileNotFoundError:
+            raise KeyError(msg_file) from None
+        return stat.st_mtime, stat.st_size
+
+    def entries(self):
+        """
+        :return: список (ключ, время изменения, размер) всех писем
+        """
+        result = []
+        with os.scandir(self.messages_dir) as dir_entries:
+            for entry in dir_entries:
+                # служебные файлы (индекс, недокачанные письма) начинаются с точки
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                result.append((entry.name, stat.st_mtime, stat.st_size))
+        return result
+
+    def read(self, msg_file):
+        try:
+            with open(self.__path(msg_file), 'rb') as message_file:
+                return message_file.read()
+        except FileNotFoundError:
+            raise KeyError(msg_file) from None
+
+    def open(self, msg_file):
+        """
+        Бинарный поток письма для чтения по частям
+        """
+        try:
+            return open(self.__path(msg_file), 'rb')
+        except FileNotFoundError:
+            raise KeyError(msg_file) from None
+
+    def read_headers(self, msg_file):
+        """
+        Заголовки письма вместе с пустой строкой после них, тело не читается
+        """
+        header_lines = []
+        try:
+            with open(self.__path(msg_file), 'rb') as message_file:
+                for line in message_file:
+                    header_lines.append(line)
+                    if line in (b'\r\n', b'\n'):
+                        break
+        except FileNotFoundError:
+            raise KeyError(msg_file) from None
+        return b''.join(header_lines)
+
+    def delete(self, msg_file):
+        try:
+            os.remove(self.__path(msg_file))
+        except FileNotFoundError:
+            pass
+
+    def compact(self):
+        # место удаленного файла освобождает файловая система
+        return 0
+
+    def maybe_compact(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+class PackStore:
+    """
+    Класс хранилища писем в пачках.
+    Письмо дописывается в конец файла .pack-NNNNNN одной записью, удаление - запись-метка.
+    Журнал .pack-index дублирует заголовки записей (ключ, пачка, смещение, длины), поэтому
+    для открытия хранилища пачки читать не нужно; записи пачек, не попавшие в журнал
+    (обрыв процесса), восстанавливаются при открытии, а недописанные обрезаются.
+    Несколько процессов могут работать с одним каталогом: запись и компактация идут под
+    блокировкой файла, а чужие изменения подхватываются дочитыванием журнала.
+    Атрибуты класса:
+    messages_dir - каталог писем;
+    compression - сжатие новых писем (ключ compressions)
+    """
+    backend = 'pack'
+
+    def __init__(self, messages_dir, compression='zlib'):
+        if compression not in compressions:
+            raise ValueError(f"Unknown compression: {compression}")
+        self.messages_dir = messages_dir
+        self.compression = compression
+        self.__lock = threading.RLock()
+        self.__index_path = os.path.join(messages_dir, '.pack-index')
+        self.__lock_file = open(os.path.join(messages_dir, '.pack-lock'), 'a+b')
+        # ключ -> (пачка, смещение данных, длина в пачке, длина письма, время записи, сжатие)
+        self.__entries = {}
+        # конец последней известной записи каждой пачки
+        self.__pack_ends = {}
+        self.__dead_bytes = 0
+        self.__maps = {}
+        self.__index_file = None
+        self.__index_ino = None
+        self.__index_pos = 0
+        # пачки, в которые писали после прошлого sync
+        self.__unsynced_packs = set()
+        with self.__locked():
+            self.__load()
+            self.__recover()
+
+    @contextlib.contextmanager
+    def __locked(self):
+        """
+        Блокировка записи: между потоками и между процессами (flock файла .pack-lock)
+        """
+        with self.__lock:
+            if fcntl is not None:
+                fcntl.flock(self.__lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self.__lock_file, fcntl.LOCK_UN)
+
+    def __pack_path(self, pack):
+        return os.path.join(self.messages_dir, f'.pack-{pack:06d}')
+
+    def __packs(self):
+        return sorted(int(name[6:]) for name in os.listdir(self.messages_dir)
+                      if name.startswith('.pack-') and name[6:].isdigit())
+
+    def __load(self):
+        """
+        Прочитать журнал смещений с начала
+        """
+        if self.__index_file is not None:
+            self.__index_file.close()
+        self.__index_file = open(self.__index_path, 'a+b')
+        if self.__index_file.tell() == 0:
+            self.__index_file.write(index_magic)
+            self.__index_file.flush()
+        self.__index_ino = os.fstat(self.__index_file.fileno()).st_ino
+        self.__entries = {}
+        self.__pack_ends = {}
+        self.__dead_bytes = 0
+        # пачки могли смениться компактацией; открытые отображения закроются вместе с последним view
+        self.__maps = {}
+        self.__index_pos = len(index_magic)
+        self.__read_index()
+
+    def __read_index(self):
+        """
+        Дочитать записи журнала от последней прочитанной позиции
+        """
+        self.__index_file.seek(self.__index_pos)
+        data = self.__index_file.read()
+        position = 0
+        while position + index_entry.size <= len(data):
+            op, key_length, pack, offset, stored, size, mtime, method = index_entry.unpack_from(data, position)
+            end = position + index_entry.size + key_length
+            if end > len(data):
+                # запись журнала дописывается другим процессом
+                break
+            self.__apply(op, data[position + index_entry.size:end].decode('utf-8'),
+                         (pack, offset, stored, size, mtime, method))
+            position = end
+        self.__index_pos += position
+
+    def __catch_up(self):
+        """
+        Подхватить изменения других процессов: новые записи журнала или новый журнал после компактации
+        """
+        try:
+            ino = os.stat(self.__index_path).st_ino
+        except FileNotFoundError:
+            ino = None
+        if ino != self.__index_ino:
+            self.__load()
+        else:
+            self.__read_index()
+
+    def __apply(self, op, key, entry):
+        old = self.__entries.pop(key, None)
+        if old is not None:
+            self.__dead_bytes += old[2]
+        if op == op_put:
+            self.__entries[key] = entry
+        pack, offset, stored = entry[:3]
+        self.__pack_ends[pack] = max(self.__pack_ends.get(pack, 0), offset + stored)
+
+    def __log(self, op, key, entry):
+        """
+        Записать операцию в журнал (под блокировкой, после __catch_up)
+        """
+        key_bytes = key.encode('utf-8')
+        # недописанная запись журнала после обрыва процесса отбрасывается
+        self.__index_file.truncate(self.__index_pos)
+        self.__index_file.write(index_entry.pack(op, len(key_bytes), *entry) + key_bytes)
+        self.__index_file.flush()
+        self.__index_pos = self.__index_file.tell()
+        self.__apply(op, key, entry)
+
+    def __recover(self):
+        """
+        Внести в журнал записи пачек после последней известной журналу и обрезать недописанную запись
+        """
+        for pack in self.__packs():
+            path = self.__pack_path(pack)
+            position = self.__pack_ends.get(pack, 0)
+            with open(path, 'r+b') as pack_file:
+                file_size = pack_file.seek(0, os.SEEK_END)
+                while position < file_size:
+                    pack_file.seek(position)
+                    header = pack_file.read(record_header.size)
+                    if len(header) < record_header.size:
+                        break
+                    magic, flags, key_length, stored, size, mtime, crc = record_header.unpack(header)
+                    data_offset = position + record_header.size + key_length
+                    if magic != record_magic or data_offset + stored > file_size:
+                        break
+                    key = pack_file.read(key_length).decode('utf-8', errors='replace')
+                    if zlib.crc32(pack_file.read(stored)) != crc:
+                        break
+                    if flags & tombstone_flag:
+                        self.__log(op_delete, key, (pack, data_offset, 0, 0, mtime, 0))
+                    else:
+                        self.__log(op_put, key, (pack, data_offset, stored, size, mtime, flags & 0x03))
+                    position = data_offset + stored
+                if position < file_size:
+                    pack_file.truncate(position)
+
+    def __append(self, key, source_path=None, mtime=None, packed=None):
+        """
+        Дописать запись в текущую пачку (под блокировкой)
+
+        :param source_path: файл письма или None для записи-метки удаления
+        :param packed: результат prepare - уже сжатое письмо копируется в пачку как есть
+        """
+        # последняя пачка известна по журналу (после __catch_up); каталог читается только у нового хранилища
+        packs = [max(self.__pack_ends)] if self.__pack_ends else self.__packs()
+        pack = packs[-1] if packs else 1
+        if packs and os.path.getsize(self.__pack_path(pack)) >= pack_size_limit:
+            pack += 1
+        mtime = time.time() if mtime is None else mtime
+        method = compressions[self.compression] if source_path is not None else 0
+        key_bytes = key.encode('utf-8')
+        self.__unsynced_packs.add(pack)
+        fd = os.open(self.__pack_path(pack), os.O_RDWR | os.O_CREAT, 0o600)
+        with open(fd, 'r+b') as pack_file:
+            start = pack_file.seek(0, os.SEEK_END)
+            # заголовок пишется последним: запись с нулевым заголовком при восстановлении обрезается
+            pack_file.write(bytes(record_header.size) + key_bytes)
+            data_offset = start + record_header.size + len(key_bytes)
+            stored = size = crc = 0
+            if packed is not None:
+                source_path, method, stored, size, crc = packed
+                with open(source_path, 'rb') as source:
+                    while True:
+                        chunk = source.read(chunk_size)
+                        if not chunk:
+                            break
+                        pack_file.write(chunk)
+            elif source_path is not None:
+                compressor = {1: lambda: zlib.compressobj(6), 2: lzma.LZMACompressor}.get(method, lambda: None)()
+                with open(source_path, 'rb') as source:
+                    while True:
+                        chunk = source.read(chunk_size)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        if compressor is not None:
+                            chunk = compressor.compress(chunk)
+                        crc = zlib.crc32(chunk, crc)
+                        stored += len(chunk)
+                        pack_file.write(chunk)
+                if compressor is not None:
+                    chunk = compressor.flush()
+                    crc = zlib.crc32(chunk, crc)
+                    stored += len(chunk)
+                    pack_file.write(chunk)
+            flags = method if source_path is not None else tombstone_flag
+            pack_file.seek(start)
+            pack_file.write(record_header.pack(record_magic, flags, len(key_bytes), stored, size, mtime, crc))
+        if source_path is None:
+            self.__log(op_delete, key, (pack, data_offset, 0, 0, mtime, 0))
+        else:
+            self.__log(op_put, key, (pack, data_offset, stored, size, mtime, method))
+
+    def temp_file(self):
+        return temp_file(self.messages_dir)
+
+    def add_file(self, tmp_path, message_id=''):
+        """
+        Сохранить письмо из временного файла под новым ключом (временный файл удаляется)
+
+        :return: ключ письма
+        """
+        with self.__locked():
+            self.__catch_up()
+            msg_file = next(key for key in candidate_keys(message_id) if key not in self.__entries)
+            self.__append(msg_file, tmp_path)
+        os.remove(tmp_path)
+        return msg_file
+
+    def replace_file(self, msg_file, tmp_path):
+        """
+        Заменить письмо (например, заголовки - полным письмом) содержимым временного файла
+        """
+        with self.__locked():
+            self.__catch_up()
+            self.__append(msg_file, tmp_path)
+        os.remove(tmp_path)
+
+    def prepare(self, data):
+        """
+        Сжать письмо для add_prepared во временный файл. Сжатие - самая долгая часть записи,
+        поэтому оно идет без блокировки хранилища и может выполняться в другом процессе
+
+        :param data: письмо (bytes)
+        :return: (путь к временному файлу, сжатие, длина сжатых данных, длина письма, CRC32 сжатых данных)
+        """
+        method = compressions[self.compression]
+        if method == 1:
+            data_view = memoryview(zlib.compress(data, 6))
+        elif method == 2:
+            data_view = memoryview(lzma.compress(data))
+        else:
+            data_view = memoryview(data)
+        with self.temp_file() as packed_file:
+            packed_file.write(data_view)
+        return packed_file.name, method, len(data_view), len(data), zlib.crc32(data_view)
+
+    def add_prepared(self, items):
+        """
+        Дописать подготовленные письма в пачку под одной блокировкой
+
+        :param items: список пар (результат prepare, Message-ID)
+        :return: ключи писем
+        """
+        keys = []
+        with self.__locked():
+            self.__catch_up()
+            for packed, message_id in items:
+                msg_file = next(key for key in candidate_keys(message_id) if key not in self.__entries)
+                self.__append(msg_file, packed=packed)
+                keys.append(msg_file)
+        for packed, _ in items:
+            os.remove(packed[0])
+        return keys
+
+    def sync(self):
+        """
+        Сбросить на диск записи пачек после прошлого sync и журнал смещений
+        """
+        with self.__lock:
+            unsynced, self.__unsynced_packs = self.__unsynced_packs, set()
+            for pack in unsynced:
+                try:
+                    fsync_file(self.__pack_path(pack))
+                except FileNotFoundError:
+                    # пачку удалила компактация, ее письма уже в новых пачках
+                    pass
+            os.fsync(self.__index_file.fileno())
+            if unsynced:
+                fsync_dir(self.messages_dir)
+
+    def discard(self, packed):
+        """
+        Удалить подготовленное письмо, которое не нужно сохранять
+        """
+        os.remove(packed[0])
+
+    def delete(self, msg_file):
+        with self.__locked():
+            self.__catch_up()
+            if msg_file in self.__entries:
+                self.__append(msg_file)
+
+    def __entry(self, msg_file):
+        with self.__lock:
+            entry = self.__entries.get(msg_file)
+            if entry is None:
+                # письмо могло быть записано другим процессом
+                self.__catch_up()
+                entry = self.__entries.get(msg_file)
+            if entry is None:
+                raise KeyError(msg_file)
+            return entry
+
+    def __view(self, pack, offset, length):
+        """
+        memoryview данных записи поверх mmap пачки (без копирования)
+        """
+        with self.__lock:
+            mapped = self.__maps.get(pack)
+            if mapped is None or len(mapped) < offset + length:
+                # пачка выросла после отображения
+                with open(self.__pack_path(pack), 'rb') as pack_file:
+                    mapped = self.__maps[pack] = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped)[offset:offset + length]
+
+    def __read_entry(self, msg_file, reader):
+        """
+        Прочитать запись функцией reader(запись); если пачку удалила компактация другого процесса,
+        перечитать журнал и повторить
+        """
+        try:
+            return reader(self.__entry(msg_file))
+        except FileNotFoundError:
+            with self.__lock:
+                self.__load()
+            return reader(self.__entry(msg_file))
+
+    def stat(self, msg_file):
+        """
+        :return: время записи и размер письма
+        """
+        entry = self.__entry(msg_file)
+        return entry[4], entry[3]
+
+    def entries(self):
+        """
+        :return: список (ключ, время записи, размер) всех писем
+        """
+        with self.__lock:
+            self.__catch_up()
+            return [(msg_file, entry[4], entry[3]) for msg_file, entry in self.__entries.items()]
+
+    def read(self, msg_file):
+        """
+        Письмо целиком: memoryview поверх mmap для несжатых писем, иначе распакованные bytes
+        """
+        def reader(entry):
+            pack, offset, stored, size, mtime, method = entry
+            data = self.__view(pack, offset, stored)
+            if method == 1:
+                return zlib.decompress(data)
+            if method == 2:
+                return lzma.decompress(data)
+            return data
+
+        return self.__read_entry(msg_file, reader)
+
+    def open(self, msg_file):
+        """
+        Бинарный поток письма: распаковывается блоками по мере чтения, память не зависит от размера письма
+        """
+        def reader(entry):
+            pack, offset, stored, size, mtime, method = entry
+            return io.BufferedReader(RecordReader(inflate(self.__view(pack, offset, stored), method)), chunk_size)
+
+        return self.__read_entry(msg_file, reader)
+
+    def read_headers(self, msg_file):
+        """
+        Заголовки письма вместе с пустой строкой после них; распаковывается только начало письма
+        """
+        def reader(entry):
+            pack, offset, stored, size, mtime, method = entry
+            data = self.__view(pack, offset, stored)
+            if method == 0:
+                # ищем конец заголовков прямо в отображении пачки
+                mapped = self.__maps[pack]
+                length = headers_length(bytes(data[:2]))
+                if length is None:
+                    ends = [position + len(separator) - offset for separator in (b'\n\r\n', b'\n\n')
+                            for position in (mapped.find(separator, offset, offset + stored),) if position >= 0]
+                    length = min(ends) if ends else stored
+                return bytes(data[:length])
+            head = b''
+            for block in inflate(data, method):
+                head += block
+                length = headers_length(head)
+                if length is not None:
+                    return head[:length]
+            return head
+
+        return self.__read_entry(msg_file, reader)
+
+    def __dead_share(self):
+        live = sum(entry[2] for entry in self.__entries.values())
+        return self.__dead_bytes / (self.__dead_bytes + live) if self.__dead_bytes else 0.0
+
+    def compact(self):
+        """
+        Переписать живые письма в новые пачки (без пересжатия) и удалить старые пачки
+
+        :return: сколько байт освобождено
+        """
+        with self.__locked():
+            self.__catch_up()
+            old_packs = self.__packs()
+            before = sum(os.path.getsize(self.__pack_path(pack)) for pack in old_packs)
+            pack = (old_packs[-1] if old_packs else 0) + 1
+            pack_file = open(self.__pack_path(pack), 'wb')
+
+            def finish_pack():
+                pack_file.flush()
+                os.fsync(pack_file.fileno())
+                pack_file.close()
+
+            new_entries = {}
+            index_lines = [index_magic]
+            # письма переносятся в порядке пачек, чтобы чтение шло последовательно
+            for msg_file, entry in sorted(self.__entries.items(), key=lambda item: item[1][:2]):
+                old_pack, offset, stored, size, mtime, method = entry
+                if pack_file.tell() >= pack_size_limit:
+                    finish_pack()
+                    pack += 1
+                    pack_file = open(self.__pack_path(pack), 'wb')
+                data = self.__view(old_pack, offset, stored)
+                key_bytes = msg_file.encode('utf-8')
+                pack_file.write(record_header.pack(record_magic, method, len(key_bytes), stored, size, mtime,
+                                                   zlib.crc32(data)) + key_bytes)
+                new_entry = (pack, pack_file.tell(), stored, size, mtime, method)
+                pack_file.write(data)
+                new_entries[msg_file] = new_entry
+                index_lines.append(index_entry.pack(op_put, len(key_bytes), *new_entry) + key_bytes)
+            finish_pack()
+            # новые пачки и индекс должны быть на диске до подмены индекса,
+            # а подмена - до удаления старых пачек: иначе при сбое питания письма теряются
+            tmp_path = f"{self.__index_path}.tmp"
+            with open(tmp_path, 'wb') as index_file:
+                index_file.write(b''.join(index_lines))
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            fsync_dir(self.messages_dir)
+            os.replace(tmp_path, self.__index_path)
+            fsync_dir(self.messages_dir)
+            for old_pack in old_packs:
+                os.remove(self.__pack_path(old_pack))
+            self.__load()
+            after = sum(os.path.getsize(self.__pack_path(pack)) for pack in self.__packs())
+            return before - after
+
+    def maybe_compact(self):
+        """
+        Компактация, если удаленные письма занимают заметную часть пачек
+
+        :return: сколько байт освобождено
+        """
+        with self.__lock:
+            self.__catch_up()
+            needed = self.__dead_bytes >= compact_min_bytes and self.__dead_share() > compact_ratio
+        return self.compact() if needed else 0
+
+    def close(self):
+        with self.__lock:
+            for mapped in self.__maps.values():
+                try:
+                    mapped.close()
+                except BufferError:
+                    # на отображение еще ссылается memoryview - закроется сборщиком мусора
+                    pass
+            self.__maps = {}
+            self.__index_file.close()
+            self.__lock_file.close()
+
+
+def create_store(messages_dir):
+    """
+    Открыть хранилище каталога по его .store.json; новый каталог получает хранилище default_backend
+    """
+    os.makedirs(messages_dir, exist_ok=True)
+    config_path = os.path.join(messages_dir, store_config)
+    try:
+        with open(config_path) as config_file:
+            config = json.load(config_file)
+    except FileNotFoundError:
+        has_messages = any(not name.startswith('.') and os.path.isfile(os.path.join(messages_dir, name))
+                           for name in os.listdir(messages_dir))
+        # письма прежнего формата остаются отдельными файлами
+        config = {'backend': 'directory' if has_messages else default_backend,
+                  'compression': default_compression}
+        tmp_path = f"{config_path}.tmp"
+        with open(tmp_path, 'w') as config_file:
+            json.dump(config, config_file)
+        os.replace(tmp_path, config_path)
+    if config['backend'] == 'pack':
+        return PackStore(messages_dir, config.get('compression', default_compression))
+    if config['backend'] == 'directory':
+        return DirectoryStore(messages_dir)
+    raise ValueError(f"Unknown message store: {config['backend']}")
+
+
+def open_store(messages_dir):
+    """
+    Общее для процесса хранилище каталога писем
+    """
+    path = os.path.abspath(messages_dir)
+    with stores_lock:
+        store = stores.get(path)
+        if store is None:
+            store = stores[path] = create_store(messages_dir)
+        return store
+
+
+@atexit.register
+def close_all():
+    with stores_lock:
+        opened = list(stores.values())
+        stores.clear()
+    for store in opened:
+        store.close()
@@ -0,0 +1,272 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+
+"""
+Метрики POP3 и SMTP клиентов: гистограммы задержек команд и фаз сессии
+(подключение, TLS, авторизация, скачивание письма, отправка письма), байты
+в обе стороны, счетчики ошибок и событий. Все клиенты процесса пишут в общий
+реестр registry, снимок которого доступен из кода (snapshot) и в виде файла
+в формате JSON или текстовом формате Prometheus (write_snapshot, start_exporter).
+
+Трассировка сессий (последовательность команд с задержками) включается
+registry.tracing = True или переменной окружения MAIL_METRICS_TRACE=1. Событие
+трассы - это кортеж в списке, последние сессии хранятся в ограниченной очереди,
+поэтому трассировку можно держать включенной постоянно.
+"""
+
+# границы корзин гистограмм в секундах
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# команды протоколов, которые попадают в метрики под своим именем (остальные - OTHER),
+# чтобы аргументы и данные авторизации не превращались в метки
+known_commands = {
+    'pop3': {'USER', 'PASS', 'APOP', 'AUTH', 'CAPA', 'STLS', 'STAT', 'LIST', 'UIDL', 'RETR', 'TOP', 'DELE',
+             'NOOP', 'RSET', 'QUIT'},
+    # DATA_END - конец данных письма после DATA
+    'smtp': {'EHLO', 'HELO', 'STARTTLS', 'AUTH', 'MAIL', 'RCPT', 'DATA', 'DATA_END', 'BDAT', 'RSET', 'NOOP', 'QUIT',
+             'VRFY'},
+}
+
+
+def command_name(protocol, command):
+    """
+    Имя команды для метрик: первое слово в верхнем регистре, если это известная команда, иначе OTHER
+    """
+    verb = command.split(' ', 1)[0].upper()
+    return verb if verb in known_commands.get(protocol, ()) else 'OTHER'
+
+
+class Histogram:
+    """
+    Класс гистограммы с фиксированными корзинами
+    """
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        # последняя корзина - значения больше всех границ (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Оценка квантиля по корзинам (верхняя граница корзины, в которую он попал)
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class SessionTrace:
+    """
+    Класс трассы одной сессии.
+    Атрибуты класса:
+    protocol, server - протокол и адрес сервера;
+    started - время начала (time.time());
+    events - список кортежей (смещение от начала в секундах, тип, имя, длительность, байт);
+    error - ошибка, которой закончилась сессия, или None
+    """
+
+    def __init__(self, protocol, server):
+        self.protocol = protocol
+        self.server = server
+        self.started = time.time()
+        self.events = []
+        self.error = None
+        self.__start = time.perf_counter()
+
+    def event(self, kind, name, duration, size=None):
+        self.events.append((time.perf_counter() - self.__start - duration, kind, name, duration, size))
+
+    def as_dict(self):
+        return {'protocol': self.protocol, 'server': self.server, 'started': self.started, 'error': self.error,
+                'events': [{'at': at, 'kind': kind, 'name': name, 'duration': duration, 'bytes': size}
+                           for at, kind, name, duration, size in self.events]}
+
+
+class MetricsRegistry:
+    """
+    Класс реестра метрик.
+    Атрибуты класса:
+    tracing - записывать трассы сессий;
+    traces - последние завершенные трассы (ограниченная очередь)
+    """
+
+    def __init__(self, tracing=False, max_traces=100):
+        self.tracing = tracing
+        self.traces = deque(maxlen=max_traces)
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__commands = {}
+            self.__phases = {}
+            self.__bytes = {}
+            self.__errors = {}
+            self.__counters = {}
+            self.traces.clear()
+
+    @staticmethod
+    def __observe(histograms, key, seconds):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_command(self, protocol, command, seconds, trace=None):
+        """
+        Учесть задержку команды: от отправки до строки статуса ответа
+
+        :param command: текст команды (в метки попадает только имя команды)
+        :param trace: трасса сессии или None
+        """
+        name = command_name(protocol, command)
+        with self.__lock:
+            self.__observe(self.__commands, (protocol, name), seconds)
+        if trace is not None:
+            trace.event('command', name, seconds)
+
+    def observe_phase(self, protocol, phase, seconds, trace=None, size=None):
+        """
+        Учесть длительность фазы сессии (connect, tls, auth, retrieve, send, session)
+        """
+        with self.__lock:
+            self.__observe(self.__phases, (protocol, phase), seconds)
+        if trace is not None:
+            trace.event('phase', phase, seconds, size)
+
+    def add_bytes(self, protocol, bytes_in, bytes_out):
+        with self.__lock:
+            self.__bytes[(protocol, 'in')] = self.__bytes.get((protocol, 'in'), 0) + bytes_in
+            self.__bytes[(protocol, 'out')] = self.__bytes.get((protocol, 'out'), 0) + bytes_out
+
+    def count_error(self, protocol, kind):
+        with self.__lock:
+            self.__errors[(protocol, kind)] = self.__errors.get((protocol, kind), 0) + 1
+
+    def inc(self, protocol, name, value=1):
+        """
+        Увеличить счетчик событий (скачанные письма, отправленные письма и т.п.)
+        """
+        with self.__lock:
+            self.__counters[(protocol, name)] = self.__counters.get((protocol, name), 0) + value
+
+    def start_trace(self, protocol, server):
+        """
+        Начать трассу сессии, если трассировка включена
+
+        :return: объект SessionTrace или None
+        """
+        return SessionTrace(protocol, server) if self.tracing else None
+
+    def finish_trace(self, trace, error=None):
+        if trace is None:
+            return
+        trace.error = None if error is None else f"{type(error).__name__}: {error}"
+        self.traces.append(trace)
+
+    def snapshot(self):
+        """
+        Снимок всех метрик
+
+        :return: словарь, сериализуемый в JSON
+        """
+        with self.__lock:
+            return {
+                'time': time.time(),
+                'commands': {f"{protocol}.{name}": histogram.as_dict()
+                             for (protocol, name), histogram in self.__commands.items()},
+                'phases': {f"{protocol}.{phase}": histogram.as_dict()
+                           for (protocol, phase), histogram in self.__phases.items()},
+                'bytes': {f"{protocol}.{direction}": value for (protocol, direction), value in self.__bytes.items()},
+                'errors': {f"{protocol}.{kind}": value for (protocol, kind), value in self.__errors.items()},
+                'counters': {f"{protocol}.{name}": value for (protocol, name), value in self.__counters.items()},
+            }
+
+    def prometheus_text(self):
+        """
+        Снимок метрик в текстовом формате Prometheus
+        """
+        lines = []
+
+        def histogram_lines(metric, labels, histogram):
+            total = 0
+            for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                total += count
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {total}')
+            lines.append(f'{metric}_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+
+        with self.__lock:
+            lines.append('# TYPE mail_command_seconds histogram')
+            for (protocol, name), histogram in sorted(self.__commands.items()):
+                histogram_lines('mail_command_seconds', f'protocol="{protocol}",command="{name}"', histogram)
+            lines.append('# TYPE mail_phase_seconds histogram')
+            for (protocol, phase), histogram in sorted(self.__phases.items()):
+                histogram_lines('mail_phase_seconds', f'protocol="{protocol}",phase="{phase}"', histogram)
+            lines.append('# TYPE mail_bytes_total counter')
+            for (protocol, direction), value in sorted(self.__bytes.items()):
+                lines.append(f'mail_bytes_total{{protocol="{protocol}",direction="{direction}"}} {value}')
+            lines.append('# TYPE mail_errors_total counter')
+            for (protocol, kind), value in sorted(self.__errors.items()):
+                lines.append(f'mail_errors_total{{protocol="{protocol}",kind="{kind}"}} {value}')
+            lines.append('# TYPE mail_events_total counter')
+            for (protocol, name), value in sorted(self.__counters.items()):
+                lines.append(f'mail_events_total{{protocol="{protocol}",event="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_snapshot(self, path):
+        """
+        Атомарно записать снимок в файл: JSON для *.json, иначе формат Prometheus
+        """
+        if path.endswith('.json'):
+            snapshot = self.snapshot()
+            snapshot['traces'] = [trace.as_dict() for trace in list(self.traces)]
+            text = json.dumps(snapshot, indent=1)
+        else:
+            text = self.prometheus_text()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as snapshot_file:
+            snapshot_file.write(text)
+        os.replace(tmp_path, path)
+
+    def start_exporter(self, path, interval=15):
+        """
+        Периодически записывать снимок в файл фоновым потоком
+
+        :return: threading.Event, установка которого останавливает запись
+        """
+        stopped = threading.Event()
+
+        def export():
+            while not stopped.wait(interval):
+                self.write_snapshot(path)
+            self.write_snapshot(path)
+
+        threading.Thread(target=export, name='metrics-exporter', daemon=True).start()
+        return stopped
+
+
+# метрики, общие для всех клиентов процесса
+registry = MetricsRegistry(tracing=os.environ.get('MAIL_METRICS_TRACE') == '1')
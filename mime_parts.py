@@ -0,0 +1,422 @@
+import binascii
+import hashlib
+import os
+import tempfile
+from email import errors as email_errors
+from email import header as email_header
+from email import utils as email_utils
+from email.parser import BytesHeaderParser
+
+"""
+Потоковый разбор MIME письма: письмо читается построчно, части находятся по границам
+multipart, а тело части раскодируется (base64, quoted-printable) блоками прямо в приемник,
+поэтому память не зависит ни от размера письма, ни от размера вложений.
+Часть, для которой приемник не нужен, пропускается без раскодирования.
+
+Раскодированные вложения хранятся в BlobStore по SHA-256 содержимого: один и тот же файл,
+полученный в разных письмах, хранится один раз.
+"""
+
+# максимальная длина строки, читаемой за раз: длинная строка без переводов читается частями
+line_limit = 65536
+# размер блока тела части, который передается декодеру за раз
+block_size = 65536
+blobs_dir = '.blobs'
+
+
+class MessagePart:
+    """
+    Класс листовой части письма (без раскодирования тела).
+    Атрибуты класса:
+    index - номер части в порядке следования в письме;
+    content_type - MIME тип части;
+    filename - имя файла вложения (раскодированное) или None;
+    disposition - inline, attachment или None;
+    encoding - Content-Transfer-Encoding в нижнем регистре;
+    charset - кодировка текста или None;
+    size - размер тела части в письме (в закодированном виде)
+    """
+
+    def __init__(self, index, headers):
+        self.index = index
+        self.content_type = headers.get_content_type()
+        self.filename = decode_filename(headers)
+        self.disposition = headers.get_content_disposition()
+        self.encoding = (headers.get('Content-Transfer-Encoding') or '7bit').strip().lower()
+        self.charset = headers.get_content_charset()
+        self.size = 0
+
+    def is_attachment(self):
+        return (self.disposition == 'attachment' or self.filename is not None
+                or self.content_type.split('/')[0] not in ('text', 'multipart'))
+
+
+def decode_filename(headers):
+    """
+    Имя файла части: параметр filename (RFC 2231) или name, с раскодированием RFC 2047
+    """
+    filename = headers.get_filename() or headers.get_param('name')
+    if isinstance(filename, tuple):
+        filename = email_utils.collapse_rfc2231_value(filename)
+    if filename is None:
+        return None
+    try:
+        return str(email_header.make_header(email_header.decode_header(filename)))
+    except (UnicodeDecodeError, LookupError, email_errors.HeaderParseError):
+        return filename
+
+
+class LineReader:
+    """
+    Класс построчного чтения бинарного потока с возвратом одной строки (unread)
+    """
+
+    def __init__(self, stream):
+        self.__stream = stream
+        self.__pushed = None
+
+    def readline(self):
+        if self.__pushed is not None:
+            line, self.__pushed = self.__pushed, None
+        else:
+            line = self.__stream.readline(line_limit)
+        return line
+
+    def unread(self, line):
+        self.__pushed = line
+
+
+def split_eol(line):
+    if line.endswith(b'\r\n'):
+        return line[:-2], b'\r\n'
+    if line.endswith(b'\n'):
+        return line[:-1], b'\n'
+    return line, b''
+
+
+def delimiter(line, boundaries):
+    """
+    Проверить, является ли строка границей одной из вложенных частей
+
+    :return: (граница, закрывающая ли) или None
+    """
+    if not line.startswith(b'--'):
+        return None
+    content = line.rstrip(b' \t\r\n')
+    for boundary in reversed(boundaries):
+        if content == b'--' + boundary:
+            return boundary, False
+        if content == b'--' + boundary + b'--':
+            return boundary, True
+    return None
+
+
+class Base64Decoder:
+    """
+    Класс потокового раскодирования base64: декодируются только полные группы по 4 символа
+    """
+
+    def __init__(self):
+        self.__rest = b''
+
+    def decode(self, data):
+        data = self.__rest + data.translate(None, b' \t\r\n')
+        cut = len(data) - len(data) % 4
+        self.__rest = data[cut:]
+        return binascii.a2b_base64(data[:cut]) if cut else b''
+
+    def flush(self):
+        rest, self.__rest = self.__rest, b''
+        if not rest.strip(b'='):
+            return b''
+        try:
+            return binascii.a2b_base64(rest + b'=' * (-len(rest) % 4))
+        except binascii.Error:
+            return b''
+
+
+class QuotedPrintableDecoder:
+    """
+    Класс потокового раскодирования quoted-printable: декодируются только полные строки,
+    чтобы мягкий перенос (= в конце строки) не разорвался между блоками
+    """
+
+    def __init__(self):
+        self.__rest = b''
+
+    def decode(self, data):
+        data = self.__rest + data
+        cut = data.rfind(b'\n') + 1
+        self.__rest = data[cut:]
+        return binascii.a2b_qp(data[:cut]) if cut else b''
+
+    def flush(self):
+        rest, self.__rest = self.__rest, b''
+        return binascii.a2b_qp(rest)
+
+
+class IdentityDecoder:
+    def decode(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+def make_decoder(encoding):
+    if encoding == 'base64':
+        return Base64Decoder()
+    if encoding == 'quoted-printable':
+        return QuotedPrintableDecoder()
+    return IdentityDecoder()
+
+
+class StopScan(Exception):
+    """
+    Нужная часть уже прочитана, остаток письма разбирать не нужно
+    """
+    pass
+
+
+def read_part_headers(reader, boundaries):
+    """
+    Прочитать заголовки части до пустой строки (или до границы, если тела нет)
+    """
+    lines = []
+    while True:
+        line = reader.readline()
+        if not line:
+            break
+        if delimiter(line, boundaries) is not None:
+            reader.unread(line)
+            break
+        if line in (b'\r\n', b'\n'):
+            break
+        lines.append(line)
+    return BytesHeaderParser().parsebytes(b''.join(lines))
+
+
+def skip_to_delimiter(reader, boundaries):
+    """
+    Пропустить строки (преамбулу или эпилог) до границы
+
+    :return: результат delimiter или None в конце письма
+    """
+    at_line_start = True
+    while True:
+        line = reader.readline()
+        if not line:
+            return None
+        found = delimiter(line, boundaries) if at_line_start else None
+        if found is not None:
+            return found
+        at_line_start = line.endswith(b'\n')
+
+
+def copy_body(reader, boundaries, part, sink):
+    """
+    Прочитать тело листовой части до границы, раскодировать и передать в sink.write.
+    Строки копятся в блоки по block_size байт, чтобы декодер вызывался на блок, а не на строку.
+    Перевод строки перед границей относится к границе, поэтому последняя строка блока
+    придерживается до следующей строки
+
+    :param sink: приемник раскодированных данных или None - тело пропускается
+    :return: результат delimiter или None в конце письма
+    """
+    decoder = make_decoder(part.encoding) if sink is not None else None
+    lines = []
+    buffered = 0
+    at_line_start = True
+    while True:
+        line = reader.readline()
+        if not line:
+            found = None
+            break
+        found = delimiter(line, boundaries) if at_line_start and boundaries else None
+        if found is not None:
+            break
+        part.size += len(line)
+        last_line = line
+        at_line_start = line.endswith(b'\n')
+        if decoder is None:
+            continue
+        lines.append(line)
+        buffered += len(line)
+        if buffered >= block_size:
+            last = lines.pop()
+            sink.write(decoder.decode(b''.join(lines)))
+            lines = [last]
+            buffered = len(last)
+    if found is not None and part.size:
+        # перевод строки перед границей
+        eol = len(last_line) - len(split_eol(last_line)[0])
+        part.size -= eol
+        if lines:
+            lines[-1] = lines[-1][:len(lines[-1]) - eol]
+    if decoder is not None:
+        sink.write(decoder.decode(b''.join(lines)))
+        sink.write(decoder.flush())
+    return found
+
+
+def scan_entity(reader, boundaries, visit, counter):
+    """
+    Разобрать часть письма (или письмо целиком) рекурсивно по вложенным multipart
+
+    :param visit: функция (MessagePart) -> приемник раскодированного тела или None
+    :param counter: список из одного числа - номер следующей листовой части
+    :return: граница, на которой закончилась часть, или None в конце письма
+    """
+    headers = read_part_headers(reader, boundaries)
+    boundary = headers.get_param('boundary') if headers.get_content_maintype() == 'multipart' else None
+    if boundary is None:
+        part = MessagePart(counter[0], headers)
+        counter[0] += 1
+        return copy_body(reader, boundaries, part, visit(part))
+
+    inner = boundaries + [boundary.encode('utf-8', errors='replace')]
+    found = skip_to_delimiter(reader, inner)
+    while found is not None and found == (inner[-1], False):
+        found = scan_entity(reader, inner, visit, counter)
+    if found is not None and found[0] == inner[-1]:
+        # закрывающая граница этой части: эпилог пропускаем до границы внешней части
+        return skip_to_delimiter(reader, boundaries) if boundaries else None
+    return found
+
+
+def scan_message(stream, visit):
+    """
+    Пройти по всем листовым частям письма
+
+    :param stream: бинарный поток письма с методом readline
+    :param visit: функция (MessagePart) -> приемник тела части (объект с write) или None;
+        может прервать разбор исключением StopScan
+    """
+    try:
+        scan_entity(LineReader(stream), [], visit, [0])
+    except StopScan:
+        pass
+
+
+class TextSink:
+    """
+    Класс приемника текста: дописывает раскодированные байты текстовой части в bytearray
+    """
+
+    def __init__(self, buffer):
+        self.write = buffer.extend
+
+
+def read_structure(stream):
+    """
+    Текст письма и список его вложений за один проход; вложения не раскодируются
+
+    :return: текст первой части text/plain (не вложения) и список MessagePart вложений
+    """
+    text = None
+    text_part = None
+    attachments = []
+
+    def visit(part):
+        nonlocal text, text_part
+        if part.is_attachment():
+            attachments.append(part)
+        elif text is None and part.content_type == 'text/plain':
+            # раскодированный текст дописывается в один буфер, без списка блоков и их склейки
+            text, text_part = bytearray(), part
+            return TextSink(text)
+        return None
+
+    scan_message(stream, visit)
+    if text is None:
+        return '', attachments
+    try:
+        return text.decode(text_part.charset or 'utf-8', errors='replace'), attachments
+    except LookupError:
+        return text.decode('utf-8', errors='replace'), attachments
+
+
+class BlobWriter:
+    """
+    Класс записи раскодированного вложения во временный файл хранилища с подсчетом SHA-256
+    """
+
+    def __init__(self, directory):
+        self.size = 0
+        self.__hash = hashlib.sha256()
+        self.__file = tempfile.NamedTemporaryFile(mode='wb', dir=directory, prefix='.blob-', delete=False)
+        self.name = self.__file.name
+
+    def write(self, data):
+        if data:
+            self.__hash.update(data)
+            self.__file.write(data)
+            self.size += len(data)
+
+    def close(self):
+        self.__file.close()
+        return self.__hash.hexdigest()
+
+
+class BlobStore:
+    """
+    Класс хранилища раскодированных вложений по хешу содержимого.
+    Файл вложения лежит в .blobs/<первые 2 символа хеша>/<хеш> каталога писем.
+    Атрибуты класса:
+    root - каталог хранилища
+    """
+
+    def __init__(self, messages_dir):
+        self.root = os.path.join(messages_dir, blobs_dir)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        return digest is not None and os.path.exists(self.path(digest))
+
+    def extract(self, stream, part_index):
+        """
+        Раскодировать часть письма в хранилище блоками; если такой файл уже есть, новый не сохраняется
+
+        :param stream: бинарный поток письма
+        :param part_index: номер части (MessagePart.index)
+        :return: хеш содержимого и размер или None, если части нет
+        """
+        result = []
+
+        def visit(part):
+            if result:
+                raise StopScan()
+            if part.index != part_index:
+                return None
+            writer = BlobWriter(self.root)
+            result.append(writer)
+            return writer
+
+        try:
+            scan_message(stream, visit)
+        except BaseException:
+            # обрыв разбора посреди части: недописанный временный файл не должен остаться в хранилище
+            for writer in result:
+                writer.close()
+                os.remove(writer.name)
+            raise
+        if not result:
+            return None
+        writer = result[0]
+        digest = writer.close()
+        target = self.path(digest)
+        if os.path.exists(target):
+            os.remove(writer.name)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(writer.name, target)
+        return digest, writer.size
+
+    def remove(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,215 @@
+import base64
+import mimetypes
+import os
+import uuid
+from email import header as email_header
+from email import utils as email_utils
+
+"""
+Потоковое формирование MIME письма с вложениями.
+Тело и вложения берутся из файлов или итераторов и кодируются в base64 блоками
+по мере отправки, поэтому память не зависит от размера письма: в каждый момент
+в памяти только один блок исходных данных и его закодированная копия.
+"""
+
+# размер блока чтения исходных данных: кратен 57 байтам - одной строке base64 из 76 символов
+read_block = 57 * 1152
+# размер фрагмента, которым письмо уходит в сокет (и размер одного BDAT)
+send_block = 256 * 1024
+
+
+def encode_header_value(value):
+    """
+    Закодировать значение заголовка по RFC 2047, если в нем есть не ASCII символы
+    """
+    try:
+        value.encode('ascii')
+        return value
+    except UnicodeEncodeError:
+        return email_header.Header(value, 'utf-8').encode()
+
+
+def iter_source(source, chunk_size=read_block):
+    """
+    Итератор блоков байт из источника данных
+
+    :param source: путь (str или os.PathLike), bytes, открытый файл (в бинарном режиме)
+        или итератор строк/байт
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as source_file:
+            yield from iter(lambda: source_file.read(chunk_size), b'')
+    elif isinstance(source, (bytes, bytearray)):
+        yield bytes(source)
+    elif hasattr(source, 'read'):
+        yield from iter(lambda: source.read(chunk_size), b'')
+    else:
+        for piece in source:
+            yield piece.encode('utf-8') if isinstance(piece, str) else piece
+
+
+def crlf_lines(pieces):
+    """
+    Привести окончания строк текста к CRLF (каноническая форма text/* для base64).
+    CR на границе блоков переносится в следующий блок, чтобы не разорвать пару CRLF
+    """
+    tail = b''
+    for piece in pieces:
+        piece = tail + piece
+        tail = b''
+        if piece.endswith(b'\r'):
+            piece, tail = piece[:-1], b'\r'
+        yield piece.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+    if tail:
+        yield tail
+
+
+def base64_blocks(pieces, block_size=read_block):
+    """
+    Закодировать поток байт в base64 строками по 76 символов с CRLF.
+    Блоки кодируются по block_size байт (кратно 57), остаток копится до следующего блока
+    """
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= block_size:
+            yield base64.encodebytes(buffer[:block_size]).replace(b'\n', b'\r\n')
+            del buffer[:block_size]
+    if buffer:
+        yield base64.encodebytes(buffer).replace(b'\n', b'\r\n')
+
+
+def dot_stuff(chunks):
+    """
+    Удвоить точку в начале каждой строки потока (RFC 5321, раздел 4.5.2)
+    с учетом строк, начало которых попало на границу блоков
+    """
+    line_start = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if line_start and chunk[:1] == b'.':
+            chunk = b'.' + chunk
+        yield chunk.replace(b'\r\n.', b'\r\n..')
+        line_start = chunk.endswith(b'\r\n')
+
+
+def rechunk(chunks, size=send_block):
+    """
+    Собрать поток мелких и крупных блоков в фрагменты по size байт (последний - меньше)
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+class MessageComposer:
+    """
+    Класс потокового MIME письма.
+    Атрибуты класса:
+    sender, recipients, subj - отправитель, получатели (для заголовка To) и тема;
+    body - текст письма: строка, bytes (UTF-8), pathlib.Path к текстовому файлу,
+        открытый бинарный файл или итератор строк/байт;
+    attachments - список вложений: путь к файлу или кортеж (имя файла, источник[, MIME тип]),
+        где источник - путь, bytes, открытый бинарный файл или итератор байт;
+    message_id - значение заголовка Message-ID
+    """
+
+    def __init__(self, sender, recipients, subj, body='', attachments=()):
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        self.sender = sender
+        self.recipients = recipients
+        self.subj = subj
+        self.body = body
+        self.attachments = list(attachments or ())
+        self.message_id = email_utils.make_msgid()
+        self.__boundary = f"=_{uuid.uuid4().hex}"
+
+    def __headers(self):
+        headers = [f"From: {self.sender}",
+                   f"To: {', '.join(self.recipients)}",
+                   f"Subject: {encode_header_value(self.subj)}",
+                   f"Date: {email_utils.formatdate(localtime=True)}",
+                   f"Message-ID: {self.message_id}",
+                   "MIME-Version: 1.0"]
+        if self.attachments:
+            headers.append(f'Content-Type: multipart/mixed; boundary="{self.__boundary}"')
+        return headers
+
+    def __body_part(self):
+        headers = ["Content-Type: text/plain; charset=utf-8", "Content-Transfer-Encoding: base64"]
+        body = self.body
+        if isinstance(body, str):
+            # строка - это сам текст, а не путь к файлу
+            body = [body]
+        return headers, base64_blocks(crlf_lines(iter_source(body)))
+
+    @staticmethod
+    def __attachment_part(attachment):
+        if isinstance(attachment, tuple):
+            filename, source = attachment[:2]
+            content_type = attachment[2] if len(attachment) > 2 else None
+        else:
+            filename, source, content_type = os.path.basename(attachment), attachment, None
+        if content_type is None:
+            content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        try:
+            filename.encode('ascii')
+            disposition = f'attachment; filename="{filename}"'
+        except UnicodeEncodeError:
+            # не ASCII имя файла - в кодировке RFC 2231
+            disposition = f"attachment; filename*={email_utils.encode_rfc2231(filename, 'utf-8')}"
+        headers = [f'Content-Type: {content_type}', "Content-Transfer-Encoding: base64",
+                   f"Content-Disposition: {disposition}"]
+        return headers, base64_blocks(iter_source(source))
+
+    def estimated_size(self):
+        """
+        Оценка размера письма в байтах для параметра SIZE (RFC 1870)
+
+        :return: размер или None, если размер какого-либо источника заранее неизвестен
+        """
+        def source_size(source):
+            if isinstance(source, (str, os.PathLike)):
+                return os.path.getsize(source)
+            if isinstance(source, (bytes, bytearray)):
+                return len(source)
+            return None
+
+        def base64_size(size):
+            encoded = (size + 2) // 3 * 4
+            return encoded + (encoded + 75) // 76 * 2
+
+        body = self.body.encode('utf-8') if isinstance(self.body, str) else self.body
+        sizes = [source_size(body)] + [source_size(attachment[1] if isinstance(attachment, tuple) else attachment)
+                                       for attachment in self.attachments]
+        if None in sizes:
+            return None
+        # заголовки частей - не больше пары сотен байт, в заголовках письма еще и список получателей
+        return sum(base64_size(size) for size in sizes) + 512 * len(sizes) + len(', '.join(self.recipients))
+
+    def chunks(self):
+        """
+        Итератор байт письма (заголовки и части) с окончаниями строк CRLF, без dot-stuffing.
+        Вложения читаются и кодируются только в момент, когда до них доходит очередь
+        """
+        if not self.attachments:
+            part_headers, part_body = self.__body_part()
+            yield "\r\n".join(self.__headers() + part_headers + ["", ""]).encode()
+            yield from part_body
+            return
+
+        yield "\r\n".join(self.__headers() + ["", "This is a multi-part message in MIME format.", ""]).encode()
+        parts = [self.__body_part] + [lambda attachment=attachment: self.__attachment_part(attachment)
+                                      for attachment in self.attachments]
+        for make_part in parts:
+            part_headers, part_body = make_part()
+            yield "\r\n".join([f"--{self.__boundary}"] + part_headers + ["", ""]).encode()
+            yield from part_body
+        yield f"--{self.__boundary}--\r\n".encode()
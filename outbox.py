@@ -0,0 +1,542 @@
+import getpass
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: очередь не блокируется между процессами
+    fcntl = None
+
+import smtp_client as smtp
+from message_store import fsync_dir
+
+"""
+Исходящая очередь писем (outbox) и движок доставки.
+Письмо сначала надежно сохраняется в каталог очереди (запись во временный файл, fsync
+и атомарное переименование), а его получатели - в sqlite индекс очереди. Затем пул
+потоков доставки разбирает очередь: получатели одного письма с общим доменом уходят
+одной SMTP транзакцией, временные ошибки (4xx, обрыв соединения, таймаут) повторяются
+с экспоненциальной задержкой, постоянные (5xx) записываются как отказ (bounce).
+Каждый поток держит свою долгоживущую сессию SMTPClient и ограничивает свою скорость.
+
+Доставка "хотя бы один раз": если процесс упал во время отправки, при следующем запуске
+получатели в состоянии sending возвращаются в очередь, и письмо может прийти повторно,
+но не потеряется. Это делает движок доставки при запуске, захватив очередь (flock файла
+.queue-lock): разбирать очередь одновременно может только один процесс.
+
+Запуск из командной строки (отправить накопившуюся очередь):
+python outbox.py smtp_host smtp_port login
+"""
+
+spool_filename_suffix = '.json'
+index_filename = '.queue.sqlite'
+lock_filename = '.queue-lock'
+
+# состояния получателя в очереди
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+BOUNCED = 'bounced'
+
+
+def recipient_domain(recipient):
+    """
+    Домен адреса получателя в нижнем регистре ('' для адреса без домена)
+    """
+    address = recipient.strip().strip('<>')
+    return address.rsplit('@', 1)[1].lower() if '@' in address else ''
+
+
+class Outbox:
+    """
+    Класс исходящей очереди.
+    Атрибуты класса:
+    spool_dir - каталог очереди: файлы писем <id>.json и индекс .queue.sqlite;
+    base_retry_delay, max_retry_delay - начальная и максимальная задержка повтора в секундах;
+    max_attempts - после стольких временных ошибок получатель считается недоставленным;
+    max_recipients - сколько получателей передавать в одной транзакции
+    """
+    spool_dir = '.outbox/'
+
+    def __init__(self, spool_dir=None, base_retry_delay=60, max_retry_delay=3600, max_attempts=10,
+                 max_recipients=100):
+        if spool_dir is not None:
+            self.spool_dir = spool_dir
+        self.base_retry_delay = base_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.max_recipients = max_recipients
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.__lock = threading.Lock()
+        # соединение используется потоками доставки, доступ - под блокировкой
+        self.__db = sqlite3.connect(os.path.join(self.spool_dir, index_filename), check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        # подтвержденная транзакция не должна пропасть и при отключении питания
+        self.__db.execute("PRAGMA synchronous=FULL")
+        self.__db.execute("""
+            CREATE TABLE IF NOT EXISTS recipients (
+                letter_id TEXT,
+                recipient TEXT,
+                domain TEXT,
+                state TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_attempt REAL,
+                last_error TEXT,
+                PRIMARY KEY (letter_id, recipient)
+            )""")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS recipients_due ON recipients (state, next_attempt)")
+        self.__db.commit()
+        self.__lock_file = None
+
+    def __spool_path(self, letter_id):
+        return os.path.join(self.spool_dir, letter_id + spool_filename_suffix)
+
+    def __insert_recipients(self, letter_id, recipients):
+        now = time.time()
+        self.__db.executemany(
+            "INSERT OR IGNORE INTO recipients (letter_id, recipient, domain, state, next_attempt) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(letter_id, recipient, recipient_domain(recipient), QUEUED, now) for recipient in recipients])
+
+    def enqueue(self, sender, recipients, subj, msg):
+        """
+        Поставить письмо в очередь. После возврата письмо сохранено на диске
+
+        :param sender: отправитель
+        :param recipients: получатели (список или строка с одним адресом)
+        :param subj: тема письма
+        :param msg: тело письма
+        :return: идентификатор письма в очереди
+        """
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        # повторяющиеся адреса получат письмо один раз
+        recipients = list(dict.fromkeys(recipients))
+        letter_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:12]}"
+        letter = {'sender': sender, 'recipients': recipients, 'subj': subj, 'msg': msg, 'created': time.time()}
+
+        # файл письма пишется первым: если упадем до записи в индекс, recover() восстановит получателей
+        tmp_path = os.path.join(self.spool_dir, f".{letter_id}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as spool_file:
+            json.dump(letter, spool_file, ensure_ascii=False)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        os.replace(tmp_path, self.__spool_path(letter_id))
+        fsync_dir(self.spool_dir)
+
+        with self.__lock:
+            self.__insert_recipients(letter_id, recipients)
+            self.__db.commit()
+        return letter_id
+
+    def load_letter(self, letter_id):
+        """
+        Прочитать письмо из каталога очереди
+
+        :return: словарь с ключами sender, recipients, subj, msg, created или None, если файла нет
+        """
+        try:
+            with open(self.__spool_path(letter_id), 'r', encoding='utf-8') as spool_file:
+                return json.load(spool_file)
+        except FileNotFoundError:
+            return None
+
+    def lock(self):
+        """
+        Захватить очередь для доставки, не дожидаясь освобождения. Без этого recover() в другом
+        процессе вернул бы в очередь получателей, которым письмо отправляется прямо сейчас
+
+        :raise BlockingIOError: очередь уже разбирает другой движок доставки
+        """
+        lock_file = open(os.path.join(self.spool_dir, lock_filename), 'a+b')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                raise BlockingIOError(f"Outbox {self.spool_dir} is locked by another delivery engine") from None
+        self.__lock_file = lock_file
+
+    def unlock(self):
+        if self.__lock_file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self.__lock_file, fcntl.LOCK_UN)
+        self.__lock_file.close()
+        self.__lock_file = None
+
+    def recover(self):
+        """
+        Привести очередь в порядок после падения (вызывается только захватившим очередь, см. lock()): вернуть в очередь получателей, отправка которым
+        не завершилась, восстановить получателей писем без записей в индексе, удалить временные
+        файлы и отметить как недоставленных получателей писем, файлы которых пропали
+        """
+        letter_ids = set()
+        with os.scandir(self.spool_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    if entry.name.endswith('.tmp'):
+                        os.remove(entry.path)
+                    continue
+                if entry.name.endswith(spool_filename_suffix):
+                    letter_ids.add(entry.name[:-len(spool_filename_suffix)])
+
+        with self.__lock:
+            self.__db.execute("UPDATE recipients SET state = ? WHERE state = ?", (QUEUED, SENDING))
+            known = {letter_id for letter_id, in self.__db.execute("SELECT DISTINCT letter_id FROM recipients")}
+            pending = {letter_id for letter_id, in self.__db.execute(
+                "SELECT DISTINCT letter_id FROM recipients WHERE state = ?", (QUEUED,))}
+            self.__db.executemany(
+                "UPDATE recipients SET state = ?, last_error = ? WHERE letter_id = ? AND state = ?",
+                [(BOUNCED, "Spool file is missing", letter_id, QUEUED) for letter_id in pending - letter_ids])
+            self.__db.commit()
+
+        for letter_id in letter_ids - known:
+            letter = self.load_letter(letter_id)
+            with self.__lock:
+                self.__insert_recipients(letter_id, letter['recipients'])
+                self.__db.commit()
+        # письма, доставка которых завершилась, но файл не успели удалить
+        for letter_id in letter_ids & (known - pending):
+            self.__finish_letter(letter_id)
+
+    def claim(self, now=None):
+        """
+        Взять из очереди следующую транзакцию: получателей одного письма с общим доменом,
+        время повтора которых наступило. Взятые получатели переходят в состояние sending
+
+        :return: словарь с ключами letter_id, domain, recipients или None, если доставлять нечего
+        """
+        now = time.time() if now is None else now
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT letter_id, domain FROM recipients WHERE state = ? AND next_attempt <= ? "
+                "ORDER BY next_attempt, rowid LIMIT 1", (QUEUED, now)).fetchone()
+            if row is None:
+                return None
+            letter_id, domain = row
+            recipients = [recipient for recipient, in self.__db.execute(
+                "SELECT recipient FROM recipients WHERE letter_id = ? AND domain = ? AND state = ? "
+                "AND next_attempt <= ? ORDER BY rowid LIMIT ?",
+                (letter_id, domain, QUEUED, now, self.max_recipients))]
+            self.__set_state(letter_id, recipients, SENDING)
+            self.__db.commit()
+        return {'letter_id': letter_id, 'domain': domain, 'recipients': recipients}
+
+    def __set_state(self, letter_id, recipients, state, error=None):
+        self.__db.executemany(
+            "UPDATE recipients SET state = ?, last_error = ? WHERE letter_id = ? AND recipient = ?",
+            [(state, error, letter_id, recipient) for recipient in recipients])
+
+    def retry_delay(self, attempts):
+        """
+        Задержка перед очередной попыткой: экспоненциальный рост с разбросом 50-100%
+        """
+        delay = min(self.max_retry_delay, self.base_retry_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def mark_sent(self, letter_id, recipients):
+        with self.__lock:
+            self.__set_state(letter_id, recipients, SENT)
+            self.__db.commit()
+        self.__finish_letter(letter_id)
+
+    def bounce(self, letter_id, recipients, error):
+        """
+        Отметить получателей как недоставленных (постоянная ошибка)
+        """
+        with self.__lock:
+            self.__set_state(letter_id, recipients, BOUNCED, str(error))
+            self.__db.commit()
+        self.__finish_letter(letter_id)
+
+    def defer(self, letter_id, recipients, error):
+        """
+        Вернуть получателей в очередь после временной ошибки. Когда попытки исчерпаны,
+        получатель считается недоставленным
+        """
+        now = time.time()
+        with self.__lock:
+            attempts = dict(self.__db.execute(
+                f"SELECT recipient, attempts FROM recipients WHERE letter_id = ? "
+                f"AND recipient IN ({', '.join('?' * len(recipients))})", [letter_id, *recipients]))
+            for recipient in recipients:
+                attempt = attempts.get(recipient, 0) + 1
+                if attempt >= self.max_attempts:
+                    self.__db.execute(
+                        "UPDATE recipients SET state = ?, attempts = ?, last_error = ? "
+                        "WHERE letter_id = ? AND recipient = ?",
+                        (BOUNCED, attempt, f"Too many attempts, last error: {error}", letter_id, recipient))
+                else:
+                    self.__db.execute(
+                        "UPDATE recipients SET state = ?, attempts = ?, next_attempt = ?, last_error = ? "
+                        "WHERE letter_id = ? AND recipient = ?",
+                        (QUEUED, attempt, now + self.retry_delay(attempt), str(error), letter_id, recipient))
+            self.__db.commit()
+        self.__finish_letter(letter_id)
+
+    def __finish_letter(self, letter_id):
+        """
+        Удалить файл письма, если всем получателям доставка завершена (отправлено или отказ)
+        """
+        with self.__lock:
+            left = self.__db.execute(
+                "SELECT COUNT(*) FROM recipients WHERE letter_id = ? AND state IN (?, ?)",
+                (letter_id, QUEUED, SENDING)).fetchone()[0]
+        if left:
+            return
+        # сначала удаляем файл: если упадем раньше, чем записи, recover() не отправит письмо повторно
+        try:
+            os.remove(self.__spool_path(letter_id))
+        except FileNotFoundError:
+            pass
+        # об успешно доставленных записи больше не нужны, отказы остаются для просмотра
+        with self.__lock:
+            self.__db.execute("DELETE FROM recipients WHERE letter_id = ? AND state = ?", (letter_id, SENT))
+            self.__db.commit()
+
+    def next_due(self):
+        """
+        Время (time.time()) ближайшей попытки доставки или None, если очередь пуста
+        """
+        with self.__lock:
+            return self.__db.execute(
+                "SELECT MIN(next_attempt) FROM recipients WHERE state = ?", (QUEUED,)).fetchone()[0]
+
+    def counts(self):
+        """
+        Количество получателей по состояниям
+
+        :return: словарь {состояние: количество}
+        """
+        with self.__lock:
+            rows = self.__db.execute("SELECT state, COUNT(*) FROM recipients GROUP BY state").fetchall()
+        result = {QUEUED: 0, SENDING: 0, BOUNCED: 0}
+        result.update(rows)
+        return result
+
+    def bounces(self):
+        """
+        Список недоставленных получателей
+
+        :return: список словарей с ключами letter_id, recipient, attempts, error
+        """
+        with self.__lock:
+            rows = self.__db.execute(
+                "SELECT letter_id, recipient, attempts, last_error FROM recipients WHERE state = ? ORDER BY rowid",
+                (BOUNCED,)).fetchall()
+        return [{'letter_id': letter_id, 'recipient': recipient, 'attempts': attempts, 'error': error}
+                for letter_id, recipient, attempts, error in rows]
+
+    def close(self):
+        self.unlock()
+        with self.__lock:
+            self.__db.close()
+
+
+class DeliveryEngine:
+    """
+    Класс движка доставки: пул потоков, разбирающих исходящую очередь.
+    Атрибуты класса:
+    outbox - объект Outbox;
+    client_factory - функция без параметров, возвращающая новый SMTPClient
+        (параметры подключения читаются в момент создания сессии);
+    workers - количество потоков доставки (одновременных SMTP сессий);
+    rate_limit - ограничение одного потока в транзакциях в секунду (None - без ограничения);
+    poll_interval - как часто проверять очередь без явного пробуждения, в секундах
+    """
+
+    def __init__(self, outbox, client_factory, workers=4, rate_limit=None, poll_interval=5):
+        self.outbox = outbox
+        self.client_factory = client_factory
+        self.workers = workers
+        self.rate_limit = rate_limit
+        self.poll_interval = poll_interval
+        self.sent = 0
+        self.deferred = 0
+        self.bounced = 0
+        self.__threads = []
+        self.__condition = threading.Condition()
+        self.__stopped = threading.Event()
+
+    def start(self):
+        """
+        Захватить очередь, вернуть в нее незавершенные после падения отправки и запустить потоки доставки
+
+        :raise BlockingIOError: очередь уже разбирает другой движок доставки
+        """
+        self.outbox.lock()
+        self.outbox.recover()
+        self.__stopped.clear()
+        self.__threads = [threading.Thread(target=self.__worker, name=f'smtp-delivery-{number}', daemon=True)
+                          for number in range(self.workers)]
+        for thread in self.__threads:
+            thread.start()
+        return self
+
+    def wake(self):
+        """
+        Разбудить потоки доставки (например, после постановки письма в очередь)
+        """
+        with self.__condition:
+            self.__condition.notify_all()
+
+    def stop(self):
+        """
+        Остановить потоки доставки. Текущие транзакции дорабатывают до конца
+        """
+        self.__stopped.set()
+        self.wake()
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+        self.outbox.unlock()
+
+    def wait_idle(self, timeout=None):
+        """
+        Дождаться, пока в очереди не останется писем, готовых к отправке сейчас
+        (отложенные до следующей попытки не ждем)
+
+        :return: True, если очередь разобрана, False - по таймауту
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__condition:
+            while True:
+                next_due = self.outbox.next_due()
+                if not self.outbox.counts()[SENDING] and (next_due is None or next_due > time.time()):
+                    return True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.__condition.wait(min(self.poll_interval, remaining) if remaining is not None
+                                      else self.poll_interval)
+
+    def status(self):
+        """
+        Состояние очереди и счетчики доставки
+
+        :return: словарь с количеством получателей по состояниям и ключами sent, deferred, bounced
+        """
+        status = self.outbox.counts()
+        status.update(sent=self.sent, deferred=self.deferred, bounced=self.bounced)
+        return status
+
+    def __wait_for_work(self):
+        next_due = self.outbox.next_due()
+        delay = self.poll_interval if next_due is None else min(self.poll_interval, next_due - time.time())
+        if delay > 0:
+            with self.__condition:
+                self.__condition.wait(delay)
+
+    def __worker(self):
+        client = None
+        last_send = 0.0
+        while not self.__stopped.is_set():
+            job = self.outbox.claim()
+            if job is None:
+                self.__wait_for_work()
+                continue
+            if self.rate_limit:
+                # выдерживаем интервал между транзакциями этого потока
+                delay = last_send + 1 / self.rate_limit - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            last_send = time.monotonic()
+            try:
+                if client is None:
+                    client = self.client_factory()
+                    client.keep_alive = True
+                client = self.__deliver(client, job)
+            except Exception as e:
+                # сбой вне отправки (например, при создании клиента) - получатели не должны застрять в sending
+                print(traceback.format_exc())
+                self.__defer(job['letter_id'], job['recipients'], f"{type(e).__name__}: {e}")
+                client = None
+            with self.__condition:
+                self.__condition.notify_all()
+        if client is not None:
+            client.quit()
+            client.close()
+
+    def __deliver(self, client, job):
+        """
+        Отправить одну транзакцию и разнести результат по получателям
+
+        :return: клиент для следующей транзакции или None, если сессию нужно открыть заново
+        """
+        letter_id, recipients = job['letter_id'], job['recipients']
+        letter = self.outbox.load_letter(letter_id)
+        if letter is None:
+            self.outbox.bounce(letter_id, recipients, "Spool file is missing")
+            return client
+        try:
+            result = client.send_letter(letter['sender'], recipients, letter['subj'], letter['msg'],
+                                        header_recipients=letter['recipients'])
+        except Exception as e:
+            # соединение не установлено или оборвано - временная ошибка, сессию открываем заново
+            print(traceback.format_exc())
+            self.__defer(letter_id, recipients, f"{type(e).__name__}: {e}")
+            return None
+
+        rejected = client.rejected_recipients
+        others = [recipient for recipient in recipients if recipient not in rejected]
+        if result == 0:
+            self.outbox.mark_sent(letter_id, others)
+            self.__count('sent', len(others))
+        elif others:
+            # ошибка касается всей транзакции: 5xx - отказ, остальное (4xx, таймаут, обрыв) - повтор
+            error = client.last_error
+            if (getattr(error, 'status_code', None) or '').startswith('5'):
+                self.__bounce(letter_id, others, error)
+            else:
+                self.__defer(letter_id, others, f"{type(error).__name__}: {error}")
+
+        # отказы по отдельным получателям разбираем по коду ответа
+        for recipient, reply in rejected.items():
+            if reply.startswith('5'):
+                self.__bounce(letter_id, [recipient], reply)
+            else:
+                self.__defer(letter_id, [recipient], reply)
+        return client
+
+    def __count(self, counter, value):
+        with self.__condition:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def __defer(self, letter_id, recipients, error):
+        self.outbox.defer(letter_id, recipients, error)
+        self.__count('deferred', len(recipients))
+
+    def __bounce(self, letter_id, recipients, error):
+        self.outbox.bounce(letter_id, recipients, error)
+        self.__count('bounced', len(recipients))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print("Usage: python outbox.py smtp_host smtp_port login")
+        exit(code=1)
+    smtp_host, smtp_port, login = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+    password = getpass.getpass()
+    outbox = Outbox()
+    try:
+        engine = DeliveryEngine(outbox, lambda: smtp.SMTPClient(smtp_host, smtp_port, login, password)).start()
+    except BlockingIOError as e:
+        print(f"{e}. The letters will be sent by it.")
+        exit(code=1)
+    engine.wait_idle()
+    engine.stop()
+    status = engine.status()
+    print(f"Sent: {status['sent']}, deferred: {status['deferred']}, bounced: {status['bounced']}, "
+          f"still queued: {status[QUEUED]}")
+    for bounce in outbox.bounces():
+        print(f"Bounced {bounce['recipient']} (letter {bounce['letter_id']}): {bounce['error']}")
+    outbox.close()
@@ -3,51 +3,102 @@ import socket
 import ssl
 import traceback
 import getpass
-import email
+import functools
+import json
 import os
-from email import header as email_header
+import shutil
+import time
+import threading
+from collections import defaultdict, deque
 
+import tls_context
 from logger import FileLogger
+from metrics import registry as metrics
+from message_index import MessageIndex, parse_headers, read_headers, read_text_body, text_body
+from message_store import fsync_dir
+from sync_journal import SyncJournal
 
 log_filename = "pop_3.log"
 # host = 'mail2.nstu.ru'
 # host = 'smtp.freesmtpservers.com'
 host = 'pop.yandex.ru'
 port = 995
-bufsize = 1024
+bufsize = 65536
+
+# блокировка файлов состояния учетных записей
+state_lock = threading.Lock()
+# POP3 сервер блокирует ящик на время сессии, поэтому сессии одной учетной записи идут по очереди
+session_locks = defaultdict(threading.Lock)
+
+
+# сколько файлов писем держит кэш раскодированных заголовков
+header_cache_size = 65536
+
+
+@functools.lru_cache(maxsize=header_cache_size)
+def cached_headers(path, mtime_ns, size):
+    """
+    Раскодированные заголовки письма. Ключ кэша включает время изменения и размер файла,
+    поэтому перезаписанное письмо (докачанное тело) читается заново
+    """
+    return read_headers(path)[0]
+
+
+@functools.lru_cache(maxsize=header_cache_size)
+def cached_store_headers(store, msg_file, mtime, size):
+    """
+    Раскодированные заголовки письма из хранилища (ключ кэша - как у cached_headers)
+    """
+    return parse_headers(store.read_headers(msg_file))
+
+
+class MessageData(dict):
+    """
+    Словарь письма: заголовки from/to/subject/date и ключ body.
+    Тело раскодируется только при первом обращении к msg_data['body']
+    Атрибуты класса:
+    read_body - функция без аргументов, возвращающая текст письма
+    """
+
+    def __init__(self, headers, read_body):
+        super(MessageData, self).__init__(headers)
+        self.read_body = read_body
+
+    def __missing__(self, key):
+        if key != 'body':
+            raise KeyError(key)
+        self['body'] = self.read_body()
+        return self['body']
 
 
 def read_message_from_file(path, without_body=False):
-    message_file = open(path, 'r')
-    email_msg = email.message_from_file(message_file)
-    msg_data = {}
-    for key in ('from', 'to', 'subject', 'date'):
-        if key == 'subject':
-            header, encoding = email_header.decode_header(email_msg[key])[0]
-            if encoding:
-                msg_data[key] = header.decode(encoding)
-            else:
-                msg_data[key] = email_msg[key]
-        # elif key == 'date':
-        #     msg_data[key] = datetime.datetime.strptime(email_msg[key].rstrip(), '%a, %d %b %Y %H:%M:%S %z')
-        else:
-            msg_data[key] = email_msg[key]
-
-    if not without_body:
-        msg_body = ''
-        if email_msg.is_multipart():
-            for msg in email_msg.walk():
-                if msg.get_content_type() == 'text/plain':
-                    email_msg = msg
-                    break
+    """
+    Прочитать письмо из файла: читаются только заголовки (до пустой строки), все части
+    RFC 2047 в From/To/Subject/Date раскодируются. Заголовки кэшируются по (путь, mtime),
+    текстовая часть тела раскодируется при первом обращении к ключу body
 
-        if email_msg['Content-Transfer-Encoding'] in ('base64', 'quoted-printable'):
-            msg_body = email_msg.get_payload(decode=True).decode('utf-8')
-        else:
-            msg_body = msg_body = email_msg.get_payload()
+    :param without_body: оставлен для совместимости, тело и так не читается без обращения
+    :return: MessageData
+    """
+    stat = os.stat(path)
+    return MessageData(cached_headers(path, stat.st_mtime_ns, stat.st_size), lambda: read_text_body(path))
+
+
+def read_message(store, msg_file):
+    """
+    Прочитать письмо из хранилища так же, как read_message_from_file
 
-        msg_data['body'] = msg_body
-    return msg_data
+    :param store: хранилище писем (MessageIndex.store)
+    :param msg_file: ключ письма
+    :return: MessageData
+    """
+    def read_body():
+        # письмо читается потоком, вложения пропускаются без раскодирования
+        with store.open(msg_file) as stream:
+            return text_body(stream)
+
+    mtime, size = store.stat(msg_file)
+    return MessageData(cached_store_headers(store, msg_file, mtime, size), read_body)
 
 
 class POPClientException(Exception):
@@ -57,10 +108,558 @@ class POPClientException(Exception):
     pass
 
 
+def check_status(command, server_response):
+    """
+    Разобрать строку статуса ответа сервера
+
+    :param command: команда, на которую получен ответ (для сообщения об ошибке)
+    :param server_response: строка ответа
+    :return: статус и остаток строки ответа
+    """
+    status_code, _, msg = server_response.rstrip('\r\n').partition(' ')
+
+    if status_code != '+OK':
+        raise POPClientException(
+            f"Error while sending command {command}.\nResponse from server: {server_response}")
+    return status_code, msg
+
+
+class MessageFileWriter:
+    """
+    Класс записи многострочного ответа RETR/TOP в хранилище писем.
+    Строки ответа подаются по одной (feed) и сразу пишутся во временный файл,
+    после терминатора письмо переносится в хранилище (finish).
+    Используется и блокирующим, и асинхронным клиентом.
+    Атрибуты класса:
+    store - хранилище писем (message_store);
+    size - количество записанных байт письма;
+    message_id - Message-ID из заголовков письма
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.size = 0
+        self.message_id = ''
+        self.__in_headers = True
+        self.__tmp_file = store.temp_file()
+
+    def feed(self, line):
+        """
+        Обработать очередную строку ответа сервера
+
+        :param line: строка в байтах вместе с CRLF
+        :return: False, если получен терминатор многострочного ответа
+        """
+        if line in (b'.\r\n', b'.\n'):
+            self.__tmp_file.close()
+            return False
+        if line[:1] == b'.':
+            # снимаем dot-stuffing (RFC 1939, раздел 3)
+            line = line[1:]
+        if self.__in_headers:
+            if line in (b'\r\n', b'\n'):
+                self.__in_headers = False
+            elif line[:11].lower() == b'message-id:':
+                self.message_id = line[11:].decode('utf-8', errors='replace').strip(' <>\t\r\n')
+        self.__tmp_file.write(line)
+        self.size += len(line)
+        return True
+
+    def abort(self):
+        """
+        Удалить недописанный временный файл
+        """
+        self.__tmp_file.close()
+        os.remove(self.__tmp_file.name)
+
+    def finish(self, msg_file=None):
+        """
+        Перенести письмо из временного файла в хранилище
+
+        :param msg_file: заменить письмо с этим ключом; по умолчанию - новое письмо
+            под ключом из Message-ID (уникальным, даже если Message-ID пустой или повторяется)
+        :return: ключ письма в хранилище
+        """
+        if msg_file:
+            self.store.replace_file(msg_file, self.__tmp_file.name)
+            return msg_file
+        return self.store.add_file(self.__tmp_file.name, self.message_id)
+
+
+class AccountState:
+    """
+    Класс сохраненного состояния учетной записи: какие письма (по UIDL) уже скачаны.
+    Состояние хранится в JSON файле, рядом с ним - журнал синхронизации учетной записи.
+    Атрибуты класса:
+    state_dir - каталог состояния;
+    path - путь к файлу состояния;
+    journal_path - путь к журналу синхронизации (SyncJournal)
+    """
+
+    def __init__(self, state_dir, login, server_host):
+        self.state_dir = state_dir
+        self.path = state_dir + f"{login}@{server_host}.json"
+        self.journal_path = state_dir + f"{login}@{server_host}.journal"
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {'uidl': {}}
+
+    def __save(self, state):
+        os.makedirs(self.state_dir, exist_ok=True)
+        # пишем во временный файл и подменяем, чтобы не остаться с обрезанным состоянием;
+        # после записи состояния записи журнала синхронизации удаляются, поэтому оно сбрасывается на диск
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        fsync_dir(self.state_dir)
+
+    def update(self, updates, server_uidls=None):
+        """
+        Внести изменения в сохраненное состояние учетной записи.
+        Состояние перечитывается под блокировкой, чтобы не затереть изменения
+        параллельной сессии (например, фоновой докачки писем)
+
+        :param updates: новые сведения о письмах {UIDL: {...}}
+        :param server_uidls: если передано, забыть письма, которых больше нет на сервере
+        """
+        with state_lock:
+            state = self.load()
+            if server_uidls is not None:
+                state['uidl'] = {uidl: info for uidl, info in state['uidl'].items() if uidl in server_uidls}
+            state['uidl'].update(updates)
+            self.__save(state)
+
+    def partial_files(self):
+        return [info['msg_file'] for info in self.load()['uidl'].values() if info.get('partial')]
+
+    def is_partial(self, msg_file):
+        return any(info['msg_file'] == msg_file and info.get('partial') for info in self.load()['uidl'].values())
+
+
+class POPSession:
+    """
+    Класс логики POP3 сессии без ввода-вывода, общий для POPClient и async_client.AsyncPOPClient.
+    Шаги сессии - генераторы: они выдают (yield) операции, клиент выполняет их своим транспортом
+    и возвращает результат в генератор (send), а ошибку - исключением в генераторе (throw).
+    Операции:
+    ('send', команды) - отправить список команд одной записью;
+    ('recv',) - прочитать строку ответа сервера, результат - строка;
+    ('read_body', writer) - прочитать многострочный ответ в MessageFileWriter.feed до терминатора;
+    ('call', функция, аргументы...) - блокирующая работа с хранилищем, индексом и файлами
+        состояния (сжатие, fsync, sqlite): асинхронный клиент выполняет ее в пуле потоков.
+    Атрибуты класса:
+    client - клиент сессии: параметры учетной записи и синхронизации, счетчики downloaded и expected,
+        on_message, capabilities и метод cancelled;
+    index - индекс писем сессии (MessageIndex);
+    logfile - журнал клиента (FileLogger);
+    trace - трасса метрик сессии;
+    state - сохраненное состояние учетной записи (AccountState);
+    after_quit - операция, выполняемая после успешного QUIT (очистка журнала синхронизации)
+    """
+
+    def __init__(self, client, index, logfile, trace=None):
+        self.client = client
+        self.index = index
+        self.logfile = logfile
+        self.trace = trace
+        self.state = AccountState(client.state_dir, client.login, client.server_host)
+        self.after_quit = None
+
+    def run(self, steps):
+        """
+        Сессия после приветствия сервера: авторизация, шаги steps и QUIT
+
+        :param steps: генератор операций (download, fetch_bodies, retrieve)
+        :return: результат steps
+        """
+        yield from self.__authenticate()
+        result = yield from steps
+        if self.after_quit is None:
+            yield ('send', ["QUIT"])
+        else:
+            # сервер выполняет DELE только при успешном QUIT, поэтому ответ дожидаемся
+            yield from self.command("QUIT")
+            yield self.after_quit
+        return result
+
+    def command(self, command):
+        """
+        Отправить команду и получить строку статуса
+
+        :return: статус и остаток строки ответа
+        """
+        start = time.perf_counter()
+        yield ('send', [command])
+        status = check_status(command, (yield ('recv',)))
+        metrics.observe_command('pop3', command, time.perf_counter() - start, self.trace)
+        return status
+
+    def __multiline(self):
+        """
+        Получить строки многострочного ответа (после строки статуса) до терминатора "."
+
+        :return: список строк без CRLF
+        """
+        lines = []
+        while True:
+            line = (yield ('recv',)).rstrip('\r\n')
+            if line == '.':
+                break
+            if line[:1] == '.':
+                line = line[1:]
+            lines.append(line)
+        return lines
+
+    def __authenticate(self):
+        start = time.perf_counter()
+        yield from self.command(f"USER {self.client.login}")
+        # пароль в журнале заменяется фильтром FileLogger
+        yield from self.command(f"PASS {self.client.password}")
+        metrics.observe_phase('pop3', 'auth', time.perf_counter() - start, self.trace)
+
+        # список расширений сервера (RFC 2449)
+        try:
+            yield from self.command("CAPA")
+        except POPClientException:
+            # сервер не поддерживает CAPA
+            self.client.capabilities = set()
+        else:
+            self.client.capabilities = {line.split(' ', 1)[0].upper() for line in (yield from self.__multiline())}
+
+    def __run_commands(self, commands):
+        """
+        Выполнить пакет команд. Если сервер поддерживает PIPELINING (RFC 2449), то на сервер
+        отправлено до pipeline_window команд сразу, а ответы разбираются строго по порядку.
+        Иначе команды выполняются по очереди, каждая со своим ожиданием ответа.
+
+        :param commands: список пар (команда, обработчик ответа или None).
+            Обработчик - функция без аргументов, возвращающая генератор операций; он выполняется
+            после успешной строки статуса и дочитывает тело ответа
+        :return: количество выполненных команд: при отмене (cancel_event) оставшиеся
+            команды не отправляются, а уже отправленные дочитываются
+        """
+        window = self.client.pipeline_window
+        if 'PIPELINING' not in self.client.capabilities or window <= 1:
+            for executed, (command, on_reply) in enumerate(commands):
+                if self.client.cancelled():
+                    return executed
+                yield from self.command(command)
+                if on_reply:
+                    yield from on_reply()
+            return len(commands)
+
+        # очередь команд, ответы на которые ещё не получены
+        pending = deque()
+        unsent = deque(commands)
+
+        def send_next(count):
+            batch = []
+            sent_at = time.perf_counter()
+            if self.client.cancelled():
+                unsent.clear()
+            while unsent and count > 0:
+                command, on_reply = unsent.popleft()
+                batch.append(command)
+                pending.append((command, on_reply, sent_at))
+                count -= 1
+            if batch:
+                yield ('send', batch)
+
+        yield from send_next(window)
+        while pending:
+            command, on_reply, sent_at = pending.popleft()
+            check_status(command, (yield ('recv',)))
+            # задержка конвейерной команды - от отправки до её строки статуса
+            metrics.observe_command('pop3', command, time.perf_counter() - sent_at, self.trace)
+            if on_reply:
+                yield from on_reply()
+            # ответ получен полностью - освободилось место в окне
+            yield from send_next(1)
+        return len(commands) - len(unsent)
+
+    def __uidl_list(self):
+        """
+        Получить уникальные идентификаторы писем командой UIDL
+
+        :return: словарь {номер письма: UIDL}
+        """
+        yield from self.command("UIDL")
+        uidl_list = {}
+        for line in (yield from self.__multiline()):
+            number, uidl = line.split(' ', 1)
+            uidl_list[int(number)] = uidl.strip()
+        return uidl_list
+
+    def retrieve(self, msg_id, msg_size):
+        """
+        Скачать письмо командой RETR и сохранить его в хранилище писем
+
+        :return: ключ письма в хранилище
+        """
+        yield from self.command(f"RETR {msg_id}")
+        return (yield from self.read_message(msg_id, msg_size))
+
+    def read_message(self, msg_id, msg_size, msg_file=None):
+        """
+        Построчно читать многострочный ответ сервера и сразу писать его во временный файл.
+        Письмо целиком в памяти не держится, поэтому расход памяти не зависит от его размера.
+
+        :param msg_id: номер письма на сервере
+        :param msg_size: ожидаемый размер письма или None, если размер не проверяется (TOP)
+        :param msg_file: ключ заменяемого письма, по умолчанию - новое письмо с ключом из Message-ID
+        :return: ключ письма в хранилище
+        """
+        start = time.perf_counter()
+        writer = MessageFileWriter(self.index.store)
+        try:
+            yield ('read_body', writer)
+        except BaseException:
+            # в том числе при отмене асинхронной сессии
+            writer.abort()
+            raise
+
+        if msg_size is not None and writer.size != msg_size:
+            self.logfile.write_log(f"Unexpected end of message. Message ID: {msg_id}, message size: {msg_size}, readed: {writer.size}", "WARNING")
+
+        # сжатие, запись в хранилище и разбор письма для индекса
+        msg_file = yield ('call', self.__store_message, writer, msg_file)
+        client = self.client
+        client.downloaded += 1
+        metrics.observe_phase('pop3', 'retrieve', time.perf_counter() - start, self.trace, writer.size)
+        metrics.inc('pop3', 'messages_retrieved')
+        if client.on_message is not None:
+            client.on_message(msg_file, client.downloaded, client.expected)
+        return msg_file
+
+    def __store_message(self, writer, msg_file):
+        msg_file = writer.finish(msg_file)
+        self.index.add(msg_file)
+        return msg_file
+
+    def __checkpoint(self, journal):
+        """
+        Контрольная точка журнала синхронизации: письма и записи о них сбрасываются на диск
+        """
+        start = time.perf_counter()
+        durable = yield ('call', journal.checkpoint, self.index.store)
+        if durable:
+            metrics.observe_phase('pop3', 'checkpoint', time.perf_counter() - start, self.trace)
+        return durable
+
+    def __select_for_retention(self, msg_list, uidl_list, fetched):
+        """
+        Выбрать уже скачанные письма, которые по политике хранения пора удалить с сервера
+
+        :param msg_list: список писем из ответа на LIST
+        :param uidl_list: словарь {номер письма: UIDL}
+        :param fetched: сведения о скачанных письмах {UIDL: {'fetched': время, ...}}
+        :return: список писем для DELE
+        """
+        # письма, от которых скачаны только заголовки, с сервера не удаляем
+        downloaded = [msg for msg in msg_list
+                      if uidl_list.get(msg['id']) in fetched and not fetched[uidl_list[msg['id']]].get('partial')]
+        # сначала самые давно скачанные
+        downloaded.sort(key=lambda msg: fetched[uidl_list[msg['id']]]['fetched'])
+
+        to_delete = []
+        if self.client.delete_after_days is not None:
+            deadline = time.time() - self.client.delete_after_days * 86400
+            to_delete = [msg for msg in downloaded if fetched[uidl_list[msg['id']]]['fetched'] <= deadline]
+
+        if self.client.server_quota is not None:
+            server_size = sum(msg['size'] for msg in msg_list) - sum(msg['size'] for msg in to_delete)
+            deleted_ids = {msg['id'] for msg in to_delete}
+            for msg in downloaded:
+                if server_size <= self.client.server_quota:
+                    break
+                if msg['id'] not in deleted_ids:
+                    to_delete.append(msg)
+                    server_size -= msg['size']
+        return to_delete
+
+    def download(self):
+        """
+        Скачать письма из ящика: все с удалением либо только новые (leave_on_server)
+
+        :return: количество писем в ящике
+        """
+        inbox_info = yield from self.command("LIST")
+        msg_count, total_size = inbox_info[1].split(' ')[:2]
+        print(f"Msg count: {msg_count}, total size: {total_size}")
+
+        msg_list = []
+        for msg_info in (yield from self.__multiline()):
+            msg_info = msg_info.split(' ')
+            msg_list.append({'id': int(msg_info[0]), 'size': int(msg_info[1])})
+        print(f"Msg list: {msg_list}")
+
+        journal = yield ('call', SyncJournal, self.state.journal_path)
+        try:
+            if self.client.leave_on_server:
+                yield from self.__sync_leave_on_server(msg_list, journal)
+            else:
+                yield from self.__sync_and_delete(msg_list, journal)
+        finally:
+            # из закрытого журнала удаленные письма убираются после QUIT (forget)
+            journal.close()
+        return msg_count
+
+    def __sync_leave_on_server(self, msg_list, journal):
+        """
+        Инкрементальная синхронизация: скачать только письма с новыми UIDL, а удалять
+        с сервера только по политике хранения (delete_after_days, server_quota).
+        В режиме headers_only от новых писем скачиваются только заголовки (TOP n 0).
+        Скачанные письма отмечаются в журнале синхронизации, поэтому после обрыва процесса
+        они не скачиваются заново, даже если состояние учетной записи не успело записаться
+
+        :param msg_list: список писем из ответа на LIST
+        :param journal: журнал синхронизации (SyncJournal)
+        """
+        client = self.client
+        uidl_list = yield from self.__uidl_list()
+        server_uidls = set(uidl_list.values())
+        if journal.entries:
+            # письма, сохраненные прерванной сессией
+            yield ('call', self.state.update, journal.entries, server_uidls)
+            yield ('call', journal.forget, list(journal.entries))
+        fetched = (yield ('call', self.state.load))['uidl']
+        updates = {}
+
+        def on_retrieved(msg, uidl):
+            msg_size = None if client.headers_only else msg['size']
+            msg_file = yield from self.read_message(msg['id'], msg_size)
+            updates[uidl] = {'fetched': time.time(), 'size': msg['size'], 'msg_file': msg_file,
+                             'partial': client.headers_only}
+            journal.record(uidl, updates[uidl])
+            if journal.checkpoint_due():
+                yield from self.__checkpoint(journal)
+
+        new_messages = [msg for msg in msg_list if uidl_list.get(msg['id']) not in fetched]
+        client.expected = len(new_messages)
+        print(f"New messages: {len(new_messages)} of {len(msg_list)}")
+        command = "TOP {} 0" if client.headers_only else "RETR {}"
+        try:
+            yield from self.__run_commands([(command.format(msg['id']),
+                                             lambda msg=msg: on_retrieved(msg, uidl_list[msg['id']]))
+                                            for msg in new_messages])
+        finally:
+            # даже при обрыве сессии запоминаем то, что успели скачать,
+            # и забываем письма, которых больше нет на сервере
+            yield from self.__checkpoint(journal)
+            yield ('call', self.state.update, updates, server_uidls)
+            yield ('call', journal.forget, list(updates))
+
+        if client.cancelled():
+            return
+        fetched.update(updates)
+        to_delete = self.__select_for_retention(msg_list, uidl_list, fetched)
+        yield from self.__run_commands([(f"DELE {msg['id']}", None) for msg in to_delete])
+
+    def __sync_and_delete(self, msg_list, journal):
+        """
+        Скачать письма и удалить их с сервера. DELE отправляется только для писем,
+        надежно сохраненных контрольной точкой журнала синхронизации, после всех RETR.
+        Письма, сохраненные прерванной сессией, не скачиваются заново, а сразу удаляются.
+        После успешного QUIT удаленные письма убираются из журнала
+
+        :param msg_list: список писем из ответа на LIST
+        :param journal: журнал синхронизации (SyncJournal)
+        """
+        try:
+            uidl_list = yield from self.__uidl_list()
+        except POPClientException:
+            yield from self.__sync_and_delete_without_uidl(msg_list)
+            return
+
+        # записи писем, которых уже нет на сервере: их DELE выполнен в прошлой сессии
+        server_uidls = set(uidl_list.values())
+        yield ('call', journal.forget, [uidl for uidl in journal.entries if uidl not in server_uidls])
+
+        def on_retrieved(msg, uidl):
+            msg_file = yield from self.read_message(msg['id'], msg['size'])
+            journal.record(uidl, {'fetched': time.time(), 'size': msg['size'], 'msg_file': msg_file})
+            if journal.checkpoint_due():
+                yield from self.__checkpoint(journal)
+
+        new_messages = [msg for msg in msg_list if uidl_list.get(msg['id']) not in journal.entries]
+        self.client.expected = len(new_messages)
+        if len(new_messages) < len(msg_list):
+            print(f"Resuming sync: {len(msg_list) - len(new_messages)} messages already stored")
+        try:
+            yield from self.__run_commands([(f"RETR {msg['id']}", lambda msg=msg: on_retrieved(msg, uidl_list[msg['id']]))
+                                            for msg in new_messages])
+        finally:
+            yield from self.__checkpoint(journal)
+        # при отмене сессии DELE не отправляются: письма остаются в журнале и удаляются в следующей сессии
+        to_delete = [msg for msg in msg_list if uidl_list.get(msg['id']) in journal.entries]
+        yield from self.__run_commands([(f"DELE {msg['id']}", None) for msg in to_delete])
+        if to_delete and not self.client.cancelled():
+            self.after_quit = ('call', journal.forget, [uidl_list[msg['id']] for msg in to_delete])
+
+    def __sync_and_delete_without_uidl(self, msg_list):
+        """
+        Скачать письма и удалить их с сервера, если сервер не поддерживает UIDL.
+        Без UIDL письма нельзя узнать в следующей сессии, поэтому журнал не ведется,
+        а DELE отправляется после сброса на диск всех скачанных писем
+
+        :param msg_list: список писем из ответа на LIST
+        """
+        retrieved = []
+
+        def on_retrieved(msg):
+            yield from self.read_message(msg['id'], msg['size'])
+            retrieved.append(msg)
+
+        self.client.expected = len(msg_list)
+        yield from self.__run_commands([(f"RETR {msg['id']}", lambda msg=msg: on_retrieved(msg)) for msg in msg_list])
+        yield ('call', self.index.store.sync)
+        yield from self.__run_commands([(f"DELE {msg['id']}", None) for msg in retrieved])
+
+    def fetch_bodies(self, msg_files):
+        """
+        Докачать полные письма взамен сохраненных заголовков
+
+        :param msg_files: имена файлов писем или None - все письма без тела
+        :return: количество докачанных писем
+        """
+        state = yield ('call', self.state.load)
+        partial = {uidl: info for uidl, info in state['uidl'].items()
+                   if info.get('partial') and (msg_files is None or info['msg_file'] in msg_files)}
+        if not partial:
+            return 0
+
+        uidl_list = yield from self.__uidl_list()
+        updates = {}
+        self.client.expected = len(partial)
+
+        def on_retrieved(number, uidl):
+            info = partial[uidl]
+            yield from self.read_message(number, info['size'], msg_file=info['msg_file'])
+            updates[uidl] = dict(info, partial=False)
+
+        try:
+            yield from self.__run_commands([(f"RETR {number}", lambda number=number, uidl=uidl: on_retrieved(number, uidl))
+                                            for number, uidl in uidl_list.items() if uidl in partial])
+        finally:
+            yield ('call', self.state.update, updates)
+        return len(updates)
+
+
 class POPClient:
     messages_dir = '.msg/'
+    # каталог для служебного состояния учетных записей (скачанные UIDL и т.п.)
+    state_dir = '.state/'
 
-    def __init__(self, server_host, server_port, login, password):
+    def __init__(self, server_host, server_port, login, password, pipeline_window=32,
+                 leave_on_server=False, delete_after_days=None, server_quota=None, headers_only=False,
+                 timeout=10, use_tls=None):
         """
         Конструктор класса. Инициализирует объект класса при вызове POPClient() c переданными параметрами
 
@@ -68,159 +667,298 @@ class POPClient:
         :param server_port: порт сервера
         :param login: логин пользователя
         :param password: пароль
+        :param pipeline_window: сколько команд держать отправленными без ответа,
+            если сервер поддерживает PIPELINING. 0 или 1 - работать строго по очереди
+        :param leave_on_server: оставлять письма на сервере и скачивать только новые (по UIDL)
+        :param delete_after_days: в режиме leave_on_server удалять с сервера письма,
+            скачанные больше указанного числа дней назад
+        :param server_quota: в режиме leave_on_server удалять с сервера самые старые скачанные
+            письма, пока общий размер ящика больше указанного числа байт
+        :param headers_only: скачивать у новых писем только заголовки (TOP n 0), а тело - по
+            запросу (fetch_bodies, prefetch_bodies). Письма при этом остаются на сервере
+        :param timeout: таймаут сетевых операций в секундах
+        :param use_tls: подключаться по TLS; None - определяется по порту (995)
         """
         self.server_host = server_host
         self.server_port = server_port
         self.login = login
         self.password = password
+        self.pipeline_window = pipeline_window
+        # без тела на сервере письмо нельзя будет дочитать, поэтому удалять его сразу нельзя
+        self.leave_on_server = leave_on_server or headers_only
+        self.headers_only = headers_only
+        self.timeout = timeout
+        self.delete_after_days = delete_after_days
+        self.server_quota = server_quota
+        self.capabilities = set()
+        # результат последней сессии: исключение (или None) и количество скачанных писем
+        self.last_error = None
+        self.downloaded = 0
+        # сколько писем предстоит скачать в текущей сессии (известно после LIST/UIDL)
+        self.expected = 0
+        # функция (ключ письма, скачано писем, всего писем), вызываемая после сохранения
+        # каждого письма (из потока сессии), и threading.Event для отмены сессии между письмами
+        self.on_message = None
+        self.cancel_event = None
+        self.__client_sock = None
+        self.__reader = None
+        # байты сессии копятся в клиенте и передаются в метрики при закрытии соединения
+        self.__bytes_in = 0
+        self.__bytes_out = 0
+        self.__trace = None
+        # идущая сейчас сессия (POPSession)
+        self.__session = None
         self.__logfile = FileLogger(log_filename)
-        self.use_tls = True if self.server_port == 995 else False
+        # использовать шифрование или нет по умолчанию определяется по порту
+        self.use_tls = (self.server_port == 995) if use_tls is None else use_tls
 
     def __create_socket_connection(self):
         """
         Создание сокета и подключение к серверу
         """
         self.__client_sock = socket.socket()
-        self.__client_sock.settimeout(10)
+        self.__client_sock.settimeout(self.timeout)
+        # команды короткие, не даем алгоритму Нейгла задерживать их отправку
+        self.__client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         print("Creating socket connection")
+        start = time.perf_counter()
         self.__client_sock.connect((self.server_host, self.server_port))
+        metrics.observe_phase('pop3', 'connect', time.perf_counter() - start, self.__trace)
         if self.use_tls:
-            ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            # общий контекст для сервера и возобновление сохраненной TLS сессии
             # используем временный сокет, закрыть обычный сокет, так как он больше не нужен
             tmp_sock = self.__client_sock
-            self.__client_sock = ssl_context.wrap_socket(sock=self.__client_sock, server_hostname=host)
+            start = time.perf_counter()
+            self.__client_sock = tls_context.contexts.wrap_socket(self.__client_sock, self.server_host,
+                                                                  self.server_port)
+            metrics.observe_phase('pop3', 'tls', time.perf_counter() - start, self.__trace)
             tmp_sock.close()
 
+        # буферизованный байтовый поток для построчного чтения ответов сервера
+        self.__reader = self.__client_sock.makefile('rb', buffering=bufsize)
+
         self.__logfile.write_log(f"Successfully connected to {self.server_host}:{self.server_port}")
         # получаем ответ от сервера о подключении
-        server_response = self.__client_sock.recv(1024).decode('utf-8')
-        server_log = f"Server: {server_response}"
-        self.__logfile.write_log(server_log)
+        self.__recv()
+        if isinstance(self.__client_sock, ssl.SSLSocket):
+            # к этому моменту билет сессии TLS 1.3 уже получен
+            tls_context.contexts.save_session(self.__client_sock, self.server_host, self.server_port)
 
-        # использовать шифрование или нет определяется по порту
-        self.use_tls = True if self.server_port == 995 else False
+    def __send_many(self, commands):
+        """
+        Отправить несколько команд одной записью в сокет (для конвейерного режима)
+
+        :param commands: список команд в виде строк
+        """
+        for command in commands:
+            self.__logfile.write_log(f"Client: {command}", "DEBUG")
+        data = ''.join(command + "\r\n" for command in commands).encode()
+        self.__bytes_out += len(data)
+        self.__client_sock.sendall(data)
 
-    def __send(self, text):
-        client_log = f"Client: {text}"
-        self.__logfile.write_log(client_log)
-        self.__client_sock.send((text + "\r\n").encode())
+    def __readline(self):
+        """
+        Прочитать одну строку ответа сервера в байтах (вместе с CRLF)
+        """
+        line = self.__reader.readline()
+        if not line:
+            raise POPClientException("Connection closed by server")
+        self.__bytes_in += len(line)
+        return line
 
     def __recv(self):
-        server_response = self.__client_sock.recv(bufsize).decode('utf-8')
+        server_response = self.__readline().decode('utf-8', errors='replace')
         server_log = f"Server: {server_response}"
-        self.__logfile.write_log(server_log.rstrip())
+        self.__logfile.write_log(server_log.rstrip(), "DEBUG")
         return server_response
 
-    def __send_cmd(self, command, no_response=False):
+    def __drive(self, steps):
         """
-        Отправить команду на сервер
+        Выполнить шаги POPSession блокирующим транспортом: операции генератора выполняются
+        по очереди, ошибка операции передается в генератор, чтобы сработали его finally
 
-        :param command: команда в виде строки
-        :param no_response: признак "не ждать ответа от сервера"
-        :return: ответ от сервера
+        :param steps: генератор операций
+        :return: результат генератора
         """
-        self.__send(command)
-        if no_response:
-            # если "не ждать ответа", то выходим из метода
-            return
-
-        else:
-            # иначе получаем ответ от сервера
-            server_response = self.__recv()
-            status_code, msg = server_response.split(' ', 1)
+        result, error = None, None
+        while True:
+            try:
+                operation = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            result, error = None, None
+            try:
+                result = self.__execute(operation)
+            except BaseException as e:
+                error = e
 
-            if status_code != '+OK':
-                raise POPClientException(
-                    f"Error while sending command {command}.\nResponse from server: {server_response}")
-            return status_code, msg
+    def __execute(self, operation):
+        kind = operation[0]
+        if kind == 'recv':
+            return self.__recv()
+        if kind == 'send':
+            return self.__send_many(operation[1])
+        if kind == 'read_body':
+            writer = operation[1]
+            while writer.feed(self.__readline()):
+                pass
+            return None
+        return operation[1](*operation[2:])
 
     def save_message_to_file(self, msg_id, msg_data):
-        with open(self.messages_dir + msg_id, 'w') as file:
-            file.write(msg_data)
+        """
+        Сохранить текст письма в хранилище
+
+        :param msg_id: Message-ID письма (из него строится ключ)
+        :return: ключ письма в хранилище
+        """
+        index = MessageIndex(self.messages_dir)
+        with index.store.temp_file() as tmp_file:
+            tmp_file.write(msg_data.encode('utf-8'))
+        msg_file = index.store.add_file(tmp_file.name, msg_id)
+        index.add(msg_file)
+        index.close()
+        return msg_file
 
     def retrieve_message(self, msg_id, msg_size):
-        msg_info = self.__send_cmd(f"RETR {msg_id}")
-        size_readed = 0
-        msg_string = ''
-        self.__logfile.change_active_state(False)
-        # while size_readed < msg_size:
-        global_message_id = ''
-        while True:
-            data = self.__recv()
-            if data == '.\r\n':
-                if size_readed != msg_size:
-                    self.__logfile.write_log(f"Unexpected end of message. Message ID: {msg_id}, message size: {msg_size}, readed: {size_readed}", "WARNING")
-                    # raise POPClientException()
+        """
+        Скачать письмо командой RETR и сохранить его в хранилище писем.
+        Внутри сессии (например, из on_message) письмо скачивается в ней же,
+        иначе открывается отдельная сессия со своим индексом хранилища
 
-                break
-            elif data[:10].lower() == 'message-id':
-                global_message_id = data.split(':', 1)[1].strip(' <>\r\n')
-            # elif not data[0].isspace() and ':' in data:
-            #     tag, value = data.split(':', 1)
-            #     if tag in ('From', 'To', 'Subject', 'Date'):
-            #         msg_data[tag.lower()] = value.strip()
-            msg_string += data
-            size_readed += len(data)
-        self.__logfile.change_active_state(True)
+        :param msg_id: номер письма на сервере
+        :param msg_size: размер письма из ответа на LIST
+        :return: ключ письма в хранилище (строится из Message-ID) или 1, если сессия завершилась ошибкой
+        """
+        if self.__session is not None:
+            return self.__drive(self.__session.retrieve(msg_id, msg_size))
+        return self.__run_session(lambda session: session.retrieve(msg_id, msg_size))
 
-        self.save_message_to_file(global_message_id, msg_string)
+    def __account_state(self):
+        return AccountState(self.state_dir, self.login, self.server_host)
 
-        return global_message_id
+    def is_partial(self, msg_file):
+        """
+        Проверить, скачаны ли у письма только заголовки
+
+        :param msg_file: ключ письма в хранилище
+        """
+        return self.__account_state().is_partial(msg_file)
+
+    def cancelled(self):
+        """
+        Запрошена ли отмена сессии (cancel_event)
+        """
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def __run_session(self, action, close_logger=True):
+        """
+        Провести одну POP3 сессию: подключиться, авторизоваться, выполнить action и выйти.
+        Сессии одной учетной записи выполняются по очереди, так как сервер блокирует ящик
+
+        :param action: функция (POPSession) -> генератор операций шагов сессии
+        :param close_logger: закрыть журнал после сессии
+        :return: результат action или 1, если произошла ошибка
+        """
+        with session_locks[(self.login, self.server_host)]:
+            index = MessageIndex(self.messages_dir)
+            self.last_error = None
+            self.downloaded = 0
+            self.__trace = metrics.start_trace('pop3', f"{self.server_host}:{self.server_port}")
+            session_start = time.perf_counter()
+            try:
+                # создаем соединение и здороваемся
+                self.__create_socket_connection()
+
+                self.__session = POPSession(self, index, self.__logfile, self.__trace)
+                result = self.__drive(self.__session.run(action(self.__session)))
+
+                self.__close_connection()
+                # место удаленных писем освобождается после сессии, в потоке клиента
+                index.store.maybe_compact()
+                if close_logger:
+                    self.__logfile.close()
+                return result
+            except POPClientException as e:
+                self.__logfile.write_log(f"POPClientException: {e}", msg_type="ERROR")
+                self.last_error = e
+                self.__close_connection()
+                return 1
+            except TimeoutError as e:
+                self.__logfile.write_log("POP3 command timeout", msg_type="ERROR")
+                self.last_error = e
+                self.__close_connection()
+                return 1
+            except Exception as e:
+                self.__logfile.write_log(f"Unexpected exception: {e}", msg_type="ERROR")
+                self.last_error = e
+                print(traceback.format_exc())
+                self.close()
+                raise
+                # exit()
+            finally:
+                self.__session = None
+                index.close()
+                metrics.observe_phase('pop3', 'session', time.perf_counter() - session_start, self.__trace)
+                if self.last_error is not None:
+                    metrics.count_error('pop3', type(self.last_error).__name__)
+                metrics.finish_trace(self.__trace, self.last_error)
+                self.__trace = None
 
     def get_messages(self):
-        try:
-            # создаем соединение и здороваемся
-            self.__create_socket_connection()
+        return self.__run_session(lambda session: session.download())
 
-            self.__send_cmd(f"USER {self.login}")
+    def fetch_bodies(self, msg_files=None):
+        """
+        Докачать тела писем, от которых при синхронизации были скачаны только заголовки
 
-            self.__logfile.change_active_state(False)
-            self.__send_cmd(f"PASS {self.password}")
-            self.__logfile.change_active_state(True)
+        :param msg_files: ключи писем в хранилище или None - все такие письма
+        :return: количество докачанных писем
+        """
+        return self.__run_session(lambda session: session.fetch_bodies(msg_files))
 
-            inbox_info = self.__send_cmd("LIST")
-            msg_count, total_size = inbox_info[1].split(' ')
-            print(f"Msg count: {msg_count}, total size: {total_size}")
+    def prefetch_bodies(self, batch_size=20, stop_event=None):
+        """
+        Фоновая докачка тел писем небольшими пачками. Между пачками ящик освобождается,
+        поэтому открытие конкретного письма (fetch_bodies) ждет не дольше одной пачки
 
-            msg_list = []
-            # for i in range(1, int(msg_count) + 1):
-            while True:
-                msg_info = self.__recv()
-                if msg_info == '.\r\n':
+        :param batch_size: количество писем в одной сессии
+        :param stop_event: threading.Event для остановки докачки
+        """
+        try:
+            while stop_event is None or not stop_event.is_set():
+                partial = self.__account_state().partial_files()
+                if not partial:
                     break
-                msg_info = msg_info.split(' ')
-                msg_list.append({'id': int(msg_info[0]), 'size': int(msg_info[1].rstrip())})
-            print(f"Msg list: {msg_list}")
-
-            for msg in msg_list:
-                self.retrieve_message(msg['id'], msg['size'])
-                self.__send_cmd(f"DELE {msg['id']}")
-
-            self.__send_cmd("QUIT", no_response=True)
-
-            self.close()
-            return msg_count
-        except POPClientException as e:
-            self.__logfile.write_log(f"POPClientException: {e}", msg_type="ERROR")
-            return 1
-        except TimeoutError:
-            self.__logfile.write_log("POP3 command timeout", msg_type="ERROR")
-            return 1
-        except Exception as e:
-            self.__logfile.write_log(f"Unexpected exception: {e}", msg_type="ERROR")
-            print(traceback.format_exc())
-            self.close()
-            raise
-            # exit()
+                self.__run_session(lambda session: session.fetch_bodies(set(partial[:batch_size])),
+                                   close_logger=False)
+                if len(self.__account_state().partial_files()) >= len(partial):
+                    # ни одно письмо не докачалось (ошибка сессии или письма пропали с сервера)
+                    break
+        finally:
+            self.__logfile.close()
 
     def close(self):
         """
         Метод закрытия соединения и файлов
         """
+        self.__close_connection()
+        self.__logfile.close()
+
+    def __close_connection(self):
+        if self.__client_sock is None:
+            return
         print("Connection closed")
         self.__logfile.write_log("Connection closed\n___________________\n\n\n")
+        if isinstance(self.__client_sock, ssl.SSLSocket):
+            tls_context.contexts.save_session(self.__client_sock, self.server_host, self.server_port)
+        metrics.add_bytes('pop3', self.__bytes_in, self.__bytes_out)
+        self.__bytes_in = self.__bytes_out = 0
+        if self.__reader is not None:
+            self.__reader.close()
         self.__client_sock.close()
-        self.__logfile.close()
+        self.__client_sock = None
+        self.__reader = None
 
 
 if __name__ == "__main__":
@@ -232,35 +970,56 @@ if __name__ == "__main__":
     client = POPClient(host, port, login, password)
     client.get_messages()
     
-    command_list = ('show', 'del')
+    command_list = ('show', 'del', 'search', 'save')
+    index = MessageIndex(POPClient.messages_dir)
+    # подхватываем письма, сохраненные в обход индекса
+    index.refresh()
     while True:
       try:
 
-        msg_list = os.listdir('.msg/')
-        if not msg_list:
+        msg_info_list = index.list()
+        if not msg_info_list:
             print("No messages are available")
             exit()
 
         print("Current inbox:")
-        msg_info_list = []
-        for i, file in enumerate(msg_list):
-            print(file)
-            msg_data = read_message_from_file(".msg/" + file, without_body=True)
+        for i, msg_data in enumerate(msg_info_list):
+            print(msg_data['msg_file'])
             print(f"[{i}]: {msg_data['date']} From {msg_data['from']} To {msg_data['to']}. Subject: {msg_data['subject']}")
-            #print(msg_data['body'])
             msg_data['local_id'] = i
-            msg_data['msg_file'] = file
-            msg_info_list.append(msg_data)
-        command, arg = input(f"Input a command. Available commands: {command_list}\nExamples: show 1; del 3. ").split(" ")
+        command, arg = input(f"Input a command. Available commands: {command_list}\n"
+                             f"Examples: show 1; del 3; search from:alice invoice; save 1 2. ").split(" ", 1)
         
         if command == "show":
-          msg_data = read_message_from_file(f"./.msg/{msg_info_list[int(arg)]['msg_file']}")
+          msg_file = msg_info_list[int(arg)]['msg_file']
+          if client.is_partial(msg_file):
+              POPClient(host, port, login, password).fetch_bodies([msg_file])
+          msg_data = read_message(index.store, msg_file)
           print(f"From: {msg_data['from']}")
           print(f"To: {msg_data['to']}")
           print(f"Subject: {msg_data['subject']}")
           print(f"Body: {msg_data['body']}")
+          for attachment in index.attachments(msg_file):
+              print(f"Attachment [{attachment['part']}]: {attachment['filename']} "
+                    f"({attachment['content_type']}, {attachment['size']} bytes)")
         elif command == "del":
-          msg_data = os.remove(f"./.msg/{msg_info_list[int(arg)]['msg_file']}")
+          index.delete_message(msg_info_list[int(arg)]['msg_file'])
+        elif command == "search":
+          # номера найденных писем - те же, что в списке ящика, их можно передать show и del
+          local_ids = {msg_data['msg_file']: msg_data['local_id'] for msg_data in msg_info_list}
+          found = index.search(arg)
+          print(f"Found {len(found)} messages:" if found else "Nothing found")
+          for msg_data in found:
+              print(f"[{local_ids[msg_data['msg_file']]}]: {msg_data['date']} From {msg_data['from']}. Subject: {msg_data['subject']}")
+          input("Press Enter to continue...")
+        elif command == "save":
+          # save <номер письма> <номер вложения из show>: вложение сохраняется в текущий каталог
+          local_id, part = map(int, arg.split())
+          msg_file = msg_info_list[local_id]['msg_file']
+          attachment = next(item for item in index.attachments(msg_file) if item['part'] == part)
+          target = os.path.basename(attachment['filename'] or f"part-{part}")
+          shutil.copyfile(index.attachment_file(msg_file, part), target)
+          print(f"Saved {target}")
       except EOFError:
           print("\nGoodbye!")
           break
@@ -269,4 +1028,3 @@ if __name__ == "__main__":
           print(traceback.format_exc())
           print("Terminating...")
           exit(code=1)
-
@@ -1,10 +1,18 @@
 import base64
+import contextlib
 import socket
 import ssl
+import threading
+import time
 import traceback
 import getpass
+from collections import defaultdict, deque
 
+import outbox
+import tls_context
 from logger import FileLogger
+from metrics import registry as metrics
+from mime_stream import MessageComposer, dot_stuff, rechunk
 
 log_filename = "smtp_3.log"
 host = 'mail2.nstu.ru'
@@ -25,9 +33,133 @@ port = 587
 
 class SMTPClientException(Exception):
     """
-    Собственное исключение, чтобы вызывать его при ответах сервера об ошибке
+    Собственное исключение, чтобы вызывать его при ответах сервера об ошибке.
+    status_code - код ответа сервера (None, если ошибка не связана с конкретным ответом)
     """
-    pass
+
+    def __init__(self, message='', status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def check_reply(command, server_response):
+    """
+    Проверить ответ сервера на команду
+
+    :param command: команда, на которую получен ответ (для сообщения об ошибке)
+    :param server_response: ответ сервера
+    :return: код ответа (первые 3 символа)
+    """
+    status_code = server_response[0:3]
+    # если код ответа от сервера начинается не с 2 (успешно) или 3 (ожидает команды),
+    # то выбрасываем исключение об ошибке от сервера
+    if status_code[:1] not in ('2', '3'):
+        raise SMTPClientException(
+            f"Error while sending command {command}.\nStatus code: {status_code}.\nResponse from server: {server_response}",
+            status_code)
+    return status_code
+
+
+class Capabilities(dict):
+    """
+    Расширения сервера из ответа на EHLO: словарь {ключевое слово в верхнем регистре: список параметров},
+    например {'SIZE': ['52428800'], 'PIPELINING': [], 'AUTH': ['LOGIN', 'PLAIN']}
+    """
+
+    @property
+    def max_size(self):
+        """
+        Максимальный размер письма (RFC 1870) или None, если сервер его не объявил или не ограничивает
+        """
+        params = self.get('SIZE')
+        if params and params[0].isdigit() and int(params[0]) > 0:
+            return int(params[0])
+        return None
+
+    @property
+    def auth_mechanisms(self):
+        """
+        Поддерживаемые механизмы авторизации (RFC 4954)
+        """
+        return {mechanism.upper() for mechanism in self.get('AUTH', [])}
+
+
+def parse_ehlo_reply(server_response):
+    """
+    Разобрать список расширений из ответа на EHLO
+
+    :param server_response: многострочный ответ "250-host", "250-PIPELINING", ..., "250 ..."
+    :return: объект Capabilities
+    """
+    capabilities = Capabilities()
+    for line in server_response.splitlines()[1:]:
+        words = line[4:].split()
+        if not words:
+            continue
+        keyword, params = words[0].upper(), words[1:]
+        # старые серверы пишут "AUTH=LOGIN PLAIN"
+        if '=' in keyword:
+            keyword, first_param = keyword.split('=', 1)
+            params = [first_param] + params
+        capabilities.setdefault(keyword, []).extend(params)
+    return capabilities
+
+
+class CapabilityCache:
+    """
+    Класс кэша расширений серверов с ключом (сервер, порт).
+    Позволяет до подключения спланировать отправку: проверить размер письма,
+    выбрать BDAT или DATA, механизм авторизации.
+    Атрибуты класса:
+    ttl - время жизни записи в секундах
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.__entries = {}
+        self.__lock = threading.Lock()
+
+    def get(self, server_host, server_port):
+        """
+        Расширения сервера из кэша или None, если записи нет или она устарела
+        """
+        with self.__lock:
+            entry = self.__entries.get((server_host, server_port))
+            if entry is None:
+                return None
+            stored_at, capabilities = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self.__entries[(server_host, server_port)]
+                return None
+            return capabilities
+
+    def put(self, server_host, server_port, capabilities):
+        with self.__lock:
+            self.__entries[(server_host, server_port)] = (time.monotonic(), capabilities)
+
+    def invalidate(self, server_host, server_port):
+        with self.__lock:
+            self.__entries.pop((server_host, server_port), None)
+
+
+# расширения серверов, общие для всех клиентов процесса
+capability_cache = CapabilityCache()
+
+
+def format_letter(sender, recipients, subj, msg):
+    """
+    Сформировать текст письма для передачи после команды DATA:
+    заголовки, тело с окончаниями строк CRLF и dot-stuffing (RFC 5321, раздел 4.5.2), завершающая точка
+
+    :return: строка без последнего CRLF
+    """
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    lines = [f"FROM:{sender}", f"TO:{', '.join(recipients)}", f"SUBJECT:{subj}", ""]
+    for line in msg.replace("\r\n", "\n").split("\n"):
+        lines.append("." + line if line[:1] == "." else line)
+    lines.append(".")
+    return "\r\n".join(lines)
 
 
 class SMTPClient:
@@ -41,11 +173,15 @@ class SMTPClient:
     password - его пароль
     client_sock - сокет клиента
     use_tls - признак использования шифрования
+    capabilities - расширения сервера из ответа на EHLO (объект Capabilities)
+    rejected_recipients - получатели последнего письма, отклоненные сервером
+    keep_alive - признак долгоживущей сессии: соединение и авторизация сохраняются между письмами
     Двойное подчеркивание __ означает приватный атрибут или метод
     """
 
 
-    def __init__(self, server_host, server_port, login, password):
+    def __init__(self, server_host, server_port, login, password, timeout=10, keep_alive=False, noop_after=30,
+                 pipelining=True, use_tls=None):
         """
         Конструктор класса. Инициализирует объект класса при вызове SMTPClient() c переданными параметрами
 
@@ -53,164 +189,542 @@ class SMTPClient:
         :param server_port: порт сервера
         :param login: логин пользователя
         :param password: пароль
+        :param timeout: таймаут сетевых операций в секундах
+        :param keep_alive: не закрывать соединение после отправки письма
+        :param noop_after: через сколько секунд простоя проверять сессию командой NOOP перед отправкой
+        :param pipelining: отправлять конверт письма конвейером, если сервер поддерживает PIPELINING
+        :param use_tls: включать шифрование командой STARTTLS; None - определяется по порту (465, 587)
         """
         self.server_host = server_host
         self.server_port = server_port
         self.login = login
         self.password = password
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.noop_after = noop_after
+        self.pipelining = pipelining
+        # расширения сервера из ответа на EHLO и отклоненные получатели последнего письма
+        self.capabilities = Capabilities()
+        self.rejected_recipients = {}
+        # исключение последней неудачной отправки или None
+        self.last_error = None
+        self.__client_sock = None
+        self.__reader = None
+        # время последнего обмена с сервером и признак "после предыдущей транзакции нужен RSET"
+        self.__last_used = 0
+        self.__need_reset = False
+        # команды, ожидающие ответа: (имя для метрик, время отправки); байты копятся до конца отправки
+        self.__inflight = deque()
+        self.__bytes_in = 0
+        self.__bytes_out = 0
+        self.__trace = None
         self.__logfile = FileLogger(log_filename)
+        # использовать шифрование (STARTTLS) или нет по умолчанию определяется по порту
+        self.use_tls = (self.server_port in (465, 587)) if use_tls is None else use_tls
 
     def __create_socket_connection(self):
         """
         Создание сокета и подключение к серверу
         """
         self.__client_sock = socket.socket()
-        self.__client_sock.settimeout(10)
+        self.__client_sock.settimeout(self.timeout)
 
+        start = time.perf_counter()
         self.__client_sock.connect((self.server_host, self.server_port))
+        metrics.observe_phase('smtp', 'connect', time.perf_counter() - start, self.__trace)
+        # буферизованный поток для чтения ответов: многострочные ответы читаются целиком,
+        # и остаток одного ответа не попадает в следующий
+        self.__reader = self.__client_sock.makefile('rb')
         self.__logfile.write_log(f"Successfully connected to {self.server_host}:{self.server_port}")
         # получаем ответ от сервера о подключении
-        server_response = self.__client_sock.recv(1024).decode('utf-8')
-        server_log = f"Server: {server_response}"
-        self.__logfile.write_log(server_log)
-
-        # использовать шифрование или нет определяется по порту
-        self.use_tls = True if self.server_port in (465, 587) else False
+        server_response = self.__recv_reply()
+        check_reply("connect", server_response)
 
     def __create_ssl_socket(self):
         """
         Заменить обычный сокет на TLS сокет
         """
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        self.__reader.close()
+        # общий контекст для сервера и возобновление сохраненной TLS сессии
         # используем временный сокет, закрыть обычный сокет, так как он больше не нужен
         tmp_sock = self.__client_sock
-        self.__client_sock = ssl_context.wrap_socket(sock=self.__client_sock, server_hostname=host)
+        start = time.perf_counter()
+        self.__client_sock = tls_context.contexts.wrap_socket(self.__client_sock, self.server_host, self.server_port)
+        metrics.observe_phase('smtp', 'tls', time.perf_counter() - start, self.__trace)
         tmp_sock.close()
+        self.__reader = self.__client_sock.makefile('rb')
+
+    def __recv_reply(self):
+        """
+        Прочитать ответ сервера целиком, включая строки продолжения ("250-...")
+        """
+        lines = []
+        while True:
+            line = self.__reader.readline()
+            if not line:
+                raise SMTPClientException("Connection closed by server")
+            self.__bytes_in += len(line)
+            line = line.decode('utf-8', errors='replace')
+            lines.append(line)
+            if line[3:4] != '-':
+                break
+        server_response = ''.join(lines)
+        # логируем ответ от сервера
+        server_log = f"Server: {server_response}"
+        self.__logfile.write_log(server_log, "DEBUG")
+        self.__last_used = time.monotonic()
+        if self.__inflight:
+            # ответы приходят в порядке команд, в том числе при конвейерной отправке
+            name, sent_at = self.__inflight.popleft()
+            metrics.observe_command('smtp', name, time.perf_counter() - sent_at, self.__trace)
+        return server_response
+
+    def __send_many(self, commands, label=None):
+        """
+        Отправить одну или несколько команд одной записью в сокет
 
-    def __send_cmd(self, command, no_response=False):
+        :param commands: список команд в виде строк
+        :param label: имя команд для метрик, если оно не совпадает с первым словом (данные письма, AUTH)
+        """
+        for command in commands:
+            # логируем команду клиента
+            client_log = f"Client: {command}"
+            self.__logfile.write_log(client_log, "DEBUG")
+        data = ''.join(command + "\r\n" for command in commands).encode()
+        sent_at = time.perf_counter()
+        self.__inflight.extend((label or command, sent_at) for command in commands)
+        self.__bytes_out += len(data)
+        self.__client_sock.sendall(data)
+
+    def __send_cmd(self, command, no_response=False, label=None):
         """
         Отправить команду на сервер
 
         :param command: команда в виде строки
         :param no_response: признак "не ждать ответа от сервера"
+        :param label: имя команды для метрик (по умолчанию - первое слово команды)
         :return: ответ от сервера
         """
-        # логируем команду клиента
-        client_log = f"Client: {command}"
-        self.__logfile.write_log(client_log)
-        self.__client_sock.send((command + "\r\n").encode())
+        self.__send_many([command], label)
         if no_response:
             # если "не ждать ответа", то выходим из метода
             return
 
         else:
             # иначе получаем ответ от сервера
-            server_response = self.__client_sock.recv(1024).decode('utf-8')
-            # записываем код ответа от сервера (первые 3 символа)
-            status_code = server_response[0:3]
-
-            # if b64decode_response is True:
-            #     server_response = base64.b64decode(server_response[4:] + b'==').decode('utf-8')
-            # else:
-            #     server_response = server_response.decode('utf-8')
-
-            # логируем ответ от сервера
-            server_log = f"Server: {server_response}"
-            self.__logfile.write_log(server_log)
-            # если код ответа от сервера начинается не с 2 (успешно) или 3 (ожидает команды),
-            # то выбрасываем исключение об ошибке от сервера
-            if status_code[0] not in ('2', '3'):
-                raise SMTPClientException(
-                    f"Error while sending command {command}.\nStatus code: {status_code}.\nResponse from server: {server_response}")
+            server_response = self.__recv_reply()
+            check_reply(command, server_response)
             return server_response
 
-    def send_letter(self, sender, recipients, subj, msg):
+    def open(self):
         """
-        Метод отправки письма
-
-        :param sender: отправитель
-        :param recipients: получатели (список)
-        :param subj: тема письма
-        :param msg: тело письма
-        :return: 0, если письмо успешно отправлено и 1, если произошла ошибка и письимо не было отправлено
+        Открыть сессию: подключиться, поздороваться, включить шифрование и авторизоваться
         """
-        try:
-            # создаем соединение и здороваемся
-            self.__create_socket_connection()
-            self.__send_cmd("EHLO localhost")
-
-            if self.use_tls is True:
-                # если используется шифрование, то даем команду на начало шифрования
-                self.__send_cmd("STARTTLS")
-                # и создаем TLS сокет
-                self.__create_ssl_socket()
-                # ещё раз здороваемся
-                self.__send_cmd("EHLO localhost")
-
-                # авторизуемся
+        # создаем соединение и здороваемся
+        self.__create_socket_connection()
+        self.capabilities = parse_ehlo_reply(self.__send_cmd("EHLO localhost"))
+
+        if self.use_tls is True:
+            # если используется шифрование, то даем команду на начало шифрования
+            self.__send_cmd("STARTTLS")
+            # и создаем TLS сокет
+            self.__create_ssl_socket()
+            # ещё раз здороваемся, после STARTTLS список расширений может измениться
+            self.capabilities = parse_ehlo_reply(self.__send_cmd("EHLO localhost"))
+            # к этому моменту билет сессии TLS 1.3 уже получен
+            tls_context.contexts.save_session(self.__client_sock, self.server_host, self.server_port)
+
+            # авторизуемся: AUTH PLAIN с начальным ответом занимает один обмен вместо трех у AUTH LOGIN
+            auth_start = time.perf_counter()
+            if 'PLAIN' in self.capabilities.auth_mechanisms:
+                credentials = base64.b64encode(f"\0{self.login}\0{self.password}".encode()).decode()
+                self.__send_cmd(f"AUTH PLAIN {credentials}")
+            else:
                 self.__send_cmd("AUTH LOGIN")
-                self.__send_cmd(base64.b64encode(self.login.encode()).decode())
+                self.__send_cmd(base64.b64encode(self.login.encode()).decode(), label="AUTH")
+
+                # данные авторизации в журнале заменяются фильтром FileLogger, ответы сервера пишутся
+                self.__send_cmd(base64.b64encode(self.password.encode()).decode(), label="AUTH")
+            metrics.observe_phase('smtp', 'auth', time.perf_counter() - auth_start, self.__trace)
+        capability_cache.put(self.server_host, self.server_port, self.capabilities)
+        self.__need_reset = False
+
+    def known_capabilities(self):
+        """
+        Расширения сервера без подключения: из текущей сессии или из кэша
+
+        :return: объект Capabilities или None, если о сервере ничего не известно
+        """
+        if self.is_connected():
+            return self.capabilities
+        return capability_cache.get(self.server_host, self.server_port)
+
+    def __check_size(self, size):
+        """
+        Отказаться от отправки письма больше объявленного сервером SIZE, не передавая его
+        """
+        capabilities = self.known_capabilities()
+        max_size = capabilities.max_size if capabilities is not None else None
+        if size is not None and max_size is not None and size > max_size:
+            raise SMTPClientException(
+                f"Letter size {size} exceeds the server limit {max_size}", "552")
 
-                # отключаем логирование на период передачи пароля
-                # TODO: отключить логирование только на момент передачи сообщение клиента о пароле. Ответ от сервера должен логироваться
-                self.__logfile.change_active_state(False)
-                self.__send_cmd(base64.b64encode(self.password.encode()).decode())
-                self.__logfile.change_active_state(True)
+    def is_connected(self):
+        return self.__client_sock is not None
 
+    def __ensure_session(self):
+        """
+        Подготовить сессию к новой транзакции: открыть, если её нет, проверить командой NOOP
+        после долгого простоя и переподключиться, если сервер её уже закрыл
+        """
+        if not self.is_connected():
+            self.open()
+            return
+        try:
+            if time.monotonic() - self.__last_used > self.noop_after:
+                self.__send_cmd("NOOP")
+            if self.__need_reset:
+                # сбрасываем состояние после прерванной или чужой транзакции
+                self.__send_cmd("RSET")
+                self.__need_reset = False
+        except (SMTPClientException, OSError):
+            self.__logfile.write_log("Session is stale, reconnecting", msg_type="WARNING")
+            self.__close_connection()
+            self.open()
+
+    def __send_envelope(self, sender, recipients, send_data=True, size=None):
+        """
+        Передать конверт письма: MAIL FROM, RCPT TO для каждого получателя и DATA.
+        Если сервер поддерживает PIPELINING (RFC 2920), все команды уходят одной записью,
+        а ответы затем читаются и сопоставляются по порядку. Отказ по отдельному получателю
+        не прерывает транзакцию, письмо уходит остальным.
+
+        :param send_data: завершить конверт командой DATA (не нужна, если письмо передается BDAT)
+        :param size: оценка размера письма для параметра SIZE команды MAIL FROM (RFC 1870)
+        :return: словарь отклоненных получателей {адрес: ответ сервера}
+        """
+        rejected = {}
+        mail_command = f"MAIL FROM:{sender}"
+        if size is not None and 'SIZE' in self.capabilities:
+            # сервер откажет сразу, если письмо не поместится, а не после передачи данных
+            mail_command += f" SIZE={size}"
+        rcpt_commands = [f"RCPT TO:{recipient}" for recipient in recipients]
+        data_reply = None
+
+        if self.pipelining and 'PIPELINING' in self.capabilities:
+            self.__send_many([mail_command] + rcpt_commands + (["DATA"] if send_data else []))
+            mail_reply = self.__recv_reply()
+            rcpt_replies = [self.__recv_reply() for _ in rcpt_commands]
+            if send_data:
+                data_reply = self.__recv_reply()
+        else:
             # указываем отправителя
-            self.__send_cmd(f"MAIL FROM:{sender}")
+            mail_reply = self.__send_cmd(mail_command)
             # получателей в цикле передаем каждого отдельной командой
-            print(f"Recipients {recipients}")
-            if type(recipients) is list:
-                for recipient in recipients:
-                    self.__send_cmd(f"RCPT TO:{recipient}")
-            else:
-                self.__send_cmd(f"RCPT TO:{recipients}")
+            rcpt_replies = []
+            for command in rcpt_commands:
+                self.__send_many([command])
+                rcpt_replies.append(self.__recv_reply())
+
+        check_reply(mail_command, mail_reply)
+        for recipient, reply in zip(recipients, rcpt_replies):
+            if reply[:1] != '2':
+                rejected[recipient] = reply.strip()
+        # отказы сохраняем сразу, чтобы они были доступны и при исключении ниже
+        self.rejected_recipients = rejected
+
+        if len(rejected) == len(recipients):
+            if data_reply is not None and data_reply[:3] == '354':
+                # сервер готов принять данные, но получателей нет - завершаем пустое письмо (RFC 2920)
+                self.__send_cmd(".", no_response=True, label="DATA_END")
+                self.__recv_reply()
+            raise SMTPClientException(f"All recipients were rejected: {rejected}", next(iter(rejected.values()))[:3])
+        if send_data:
+            if data_reply is None:
+                data_reply = self.__send_cmd("DATA")
+            check_reply("DATA", data_reply)
+        return rejected
+
+    def __send_data_stream(self, chunks):
+        """
+        Передать письмо после DATA потоком: с dot-stuffing и завершающей точкой
+        """
+        size = 0
+        for chunk in rechunk(dot_stuff(chunks)):
+            self.__client_sock.sendall(chunk)
+            size += len(chunk)
+        self.__bytes_out += size
+        self.__logfile.write_log(f"Client: <message data, {size} bytes>", "DEBUG")
+        self.__send_cmd(".", label="DATA_END")
+
+    def __send_bdat(self, chunks, window=4):
+        """
+        Передать письмо командами BDAT (RFC 3030, CHUNKING): каждый фрагмент с точным размером,
+        без dot-stuffing, последний - с LAST. При поддержке PIPELINING ответы на несколько
+        фрагментов читаются с опозданием, чтобы не ждать сервер после каждого фрагмента
+        """
+        if not (self.pipelining and 'PIPELINING' in self.capabilities):
+            window = 1
+        pending = 0
+        size = 0
+        chunk = b''
+        try:
+            for next_chunk in rechunk(chunks):
+                if chunk:
+                    self.__inflight.append(("BDAT", time.perf_counter()))
+                    self.__client_sock.sendall(f"BDAT {len(chunk)}\r\n".encode() + chunk)
+                    size += len(chunk)
+                    pending += 1
+                    if pending >= window:
+                        check_reply("BDAT", self.__recv_reply())
+                        pending -= 1
+                chunk = next_chunk
+            self.__inflight.append(("BDAT", time.perf_counter()))
+            self.__client_sock.sendall(f"BDAT {len(chunk)} LAST\r\n".encode() + chunk)
+            size += len(chunk)
+            self.__bytes_out += size
+            self.__logfile.write_log(f"Client: <BDAT message data, {size} bytes>", "DEBUG")
+            for _ in range(pending + 1):
+                check_reply("BDAT", self.__recv_reply())
+        except SMTPClientException:
+            # ответы на уже отправленные фрагменты еще в пути - сессию дальше использовать нельзя
+            self.__close_connection()
+            raise
+
+    def __send_transaction(self, sender, recipients, letter, size=None):
+        """
+        Одна почтовая транзакция MAIL FROM / RCPT TO / DATA (или BDAT) в уже открытой сессии
 
+        :param letter: текст письма от format_letter или потоковое письмо MessageComposer
+        :param size: оценка размера письма в байтах или None
+        """
+        self.__check_size(size)
+        use_bdat = isinstance(letter, MessageComposer) and 'CHUNKING' in self.capabilities
+
+        # если транзакция оборвется посередине, перед следующей нужен RSET
+        self.__need_reset = True
+        print(f"Recipients {recipients}")
+        self.__send_envelope(sender, recipients, send_data=not use_bdat, size=size)
+        if self.rejected_recipients:
+            self.__logfile.write_log(f"Rejected recipients: {self.rejected_recipients}", msg_type="WARNING")
+
+        if not isinstance(letter, MessageComposer):
             # отправляем тело с нужными заголовками
-            self.__send_cmd("DATA")
-            self.__send_cmd(f"FROM:{sender}\r\n" +
-                            f"TO:{', '.join(recipients)}\r\n" +
-                            f"SUBJECT:{subj}", no_response=True)
-            self.__send_cmd(f"\n{msg}", no_response=True)
-            self.__send_cmd(".")
-            # закрываем соединение
-            self.__send_cmd("QUIT")
-            self.__logfile.write_log("Letter was sent successfully!")
+            self.__send_cmd(letter, label="DATA_END")
+        elif use_bdat:
+            self.__send_bdat(letter.chunks())
+        else:
+            self.__send_data_stream(letter.chunks())
+        self.__need_reset = False
+        self.__logfile.write_log("Letter was sent successfully!")
 
-            self.close()
+    def send_letter(self, sender, recipients, subj, msg, header_recipients=None, attachments=None):
+        """
+        Метод отправки письма
+
+        :param sender: отправитель
+        :param recipients: получатели (список)
+        :param subj: тема письма
+        :param msg: тело письма: строка или, для потоковой отправки, pathlib.Path к файлу,
+            открытый бинарный файл или итератор (см. mime_stream.MessageComposer)
+        :param header_recipients: получатели для заголовка TO, если письмо уходит
+            только части адресатов (по умолчанию - recipients)
+        :param attachments: список вложений: пути к файлам или кортежи (имя файла, источник[, MIME тип])
+        :return: 0, если письмо успешно отправлено и 1, если произошла ошибка и письимо не было отправлено
+        """
+        self.last_error = None
+        self.rejected_recipients = {}
+        if type(recipients) is not list:
+            recipients = [recipients]
+        if header_recipients is None:
+            header_recipients = recipients
+        # вложения и тело из файла или итератора передаются потоковым MIME письмом
+        if attachments or not isinstance(msg, str):
+            letter = MessageComposer(sender, header_recipients, subj, msg, attachments)
+            size = letter.estimated_size()
+        else:
+            letter = format_letter(sender, header_recipients, subj, msg)
+            size = len(letter.encode())
+        self.__trace = metrics.start_trace('smtp', f"{self.server_host}:{self.server_port}")
+        start = time.perf_counter()
+        error = None
+        try:
+            # слишком большое письмо отклоняем до подключения, если лимит сервера известен из кэша
+            self.__check_size(size)
+            if self.keep_alive:
+                self.__ensure_session()
+            else:
+                self.open()
+
+            self.__send_transaction(sender, recipients, letter, size)
+            metrics.observe_phase('smtp', 'send', time.perf_counter() - start, self.__trace, size)
+            metrics.inc('smtp', 'letters_sent')
+            if self.rejected_recipients:
+                metrics.inc('smtp', 'recipients_rejected', len(self.rejected_recipients))
+
+            if not self.keep_alive:
+                # закрываем соединение
+                self.__send_cmd("QUIT")
+                self.close()
             return 0
         except SMTPClientException as e:
             # TODO: обработка различных ответов от сервера об ошибке, чтобы говорить о них пользователю
             self.__logfile.write_log(f"SMTPClientException: {e}", msg_type="ERROR")
+            self.last_error = error = e
+            # ошибки сервера считаются по классу ответа (SMTP4xx, SMTP5xx)
+            metrics.count_error('smtp', f"SMTP{e.status_code[0]}xx" if e.status_code else type(e).__name__)
+            if not self.keep_alive:
+                self.__close_connection()
             return 1
-        except TimeoutError:
+        except TimeoutError as e:
             self.__logfile.write_log("SMTP command timeout", msg_type="ERROR")
+            self.last_error = error = e
+            metrics.count_error('smtp', type(e).__name__)
+            # после таймаута ответы сервера могут прийти не к той команде, сессию не переиспользуем
+            self.__close_connection()
             return 1
         except Exception as e:
             self.__logfile.write_log(f"Unexpected exception: {e}", msg_type="ERROR")
+            self.last_error = error = e
+            metrics.count_error('smtp', type(e).__name__)
             print(traceback.format_exc())
             self.close()
             raise
             # exit()
+        finally:
+            self.__flush_metrics()
+            metrics.finish_trace(self.__trace, error)
+            self.__trace = None
 
-    def close(self):
+    def send_many(self, letters):
         """
-        Метод закрытия соединения и файлов
+        Отправить пачку писем в одной сессии
+
+        :param letters: список словарей с ключами sender, recipients, subj, msg (и необязательным attachments)
+        :return: список результатов send_letter (0 - отправлено, 1 - ошибка) в том же порядке
         """
+        keep_alive = self.keep_alive
+        self.keep_alive = True
+        try:
+            return [self.send_letter(**letter) for letter in letters]
+        finally:
+            self.keep_alive = keep_alive
+            if not keep_alive:
+                self.quit()
+
+    def quit(self):
+        """
+        Корректно завершить сессию командой QUIT, журнал остается открытым
+        """
+        if not self.is_connected():
+            return
+        try:
+            self.__send_cmd("QUIT")
+        except (SMTPClientException, OSError):
+            pass
+        self.__close_connection()
+
+    def __flush_metrics(self):
+        """
+        Передать накопленные счетчики байт в общий реестр метрик
+        """
+        metrics.add_bytes('smtp', self.__bytes_in, self.__bytes_out)
+        self.__bytes_in = self.__bytes_out = 0
+
+    def __close_connection(self):
+        self.__inflight.clear()
+        self.__flush_metrics()
+        if self.__client_sock is None:
+            return
         print("Connection closed")
         self.__logfile.write_log("Connection closed\n___________________\n\n\n")
+        if isinstance(self.__client_sock, ssl.SSLSocket):
+            tls_context.contexts.save_session(self.__client_sock, self.server_host, self.server_port)
+        if self.__reader is not None:
+            self.__reader.close()
         self.__client_sock.close()
+        self.__client_sock = None
+        self.__reader = None
+
+    def close(self):
+        """
+        Метод закрытия соединения и файлов
+        """
+        self.__close_connection()
         self.__logfile.close()
 
 
+class SMTPPool:
+    """
+    Класс пула долгоживущих SMTP сессий с ключом (сервер, порт, логин).
+    Сессия берется из пула (acquire) или открывается новая, после отправки возвращается (release).
+    Атрибуты класса:
+    max_idle - сколько свободных сессий хранить на один ключ
+    """
+
+    def __init__(self, max_idle=2, timeout=10, noop_after=30):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.noop_after = noop_after
+        self.__idle = defaultdict(list)
+        self.__lock = threading.Lock()
+
+    def acquire(self, server_host, server_port, login, password):
+        key = (server_host, server_port, login)
+        with self.__lock:
+            if self.__idle[key]:
+                return self.__idle[key].pop()
+        return SMTPClient(server_host, server_port, login, password, timeout=self.timeout,
+                          keep_alive=True, noop_after=self.noop_after)
+
+    def release(self, client):
+        key = (client.server_host, client.server_port, client.login)
+        with self.__lock:
+            if client.is_connected() and len(self.__idle[key]) < self.max_idle:
+                self.__idle[key].append(client)
+                return
+        client.quit()
+        client.close()
+
+    @contextlib.contextmanager
+    def session(self, server_host, server_port, login, password):
+        """
+        Взять сессию из пула на время блока with
+        """
+        client = self.acquire(server_host, server_port, login, password)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def send_letter(self, server_host, server_port, login, password, sender, recipients, subj, msg):
+        with self.session(server_host, server_port, login, password) as client:
+            return client.send_letter(sender, recipients, subj, msg)
+
+    def send_many(self, server_host, server_port, login, password, letters):
+        with self.session(server_host, server_port, login, password) as client:
+            return client.send_many(letters)
+
+    def close(self):
+        """
+        Завершить все свободные сессии
+        """
+        with self.__lock:
+            clients = [client for idle in self.__idle.values() for client in idle]
+            self.__idle.clear()
+        for client in clients:
+            client.quit()
+            client.close()
+
+
 if __name__ == "__main__":
     print(f"Welcome to SMTP Client!\nYou are going to connect to this SMTP server: {host}:{port}")
     # считываем логин и пароль пользователя
     login = input("Enter login from the server: ")
     password = getpass.getpass()
     # создаем экземпляр класса
-    client = SMTPClient(host, port, login, password)
+    # сессия живет между письмами, повторной авторизации для каждого письма не будет
+    client = SMTPClient(host, port, login, password, keep_alive=True)
 
     # в бесконечном цикле отправляем письма, запрашивая у пользователя куда их отправлять
     # выход из цикла производится нажатием Ctrl-D или Ctrl-Z
@@ -247,9 +761,16 @@ if __name__ == "__main__":
             if status_code == 0:
                 print("Hell yeah! The letter was sent.")
             else:
-                print("This is very sad. Letter wasn't sent.")
+                # письмо не теряется: сохраняем в исходящую очередь для повторной отправки
+                letters = outbox.Outbox()
+                letters.enqueue(from_address, to_address_list, subject, message)
+                letters.close()
+                print(f"This is very sad. Letter wasn't sent. It was saved to the outbox, "
+                      f"send it later with: python outbox.py {host} {port} {login}")
         except EOFError:
             print("\nGoodbye!")
+            client.quit()
+            client.close()
             break
         except Exception as e:
             print("Unexpected exception caught:", e)
@@ -0,0 +1,115 @@
+import json
+import os
+
+from message_store import fsync_dir
+
+"""
+Журнал синхронизации POP3 ящика. Для каждого письма, надежно сохраненного в хранилище,
+в журнал дописывается строка JSON {"uidl": ..., "info": {...}}. Строки копятся в памяти и
+сбрасываются контрольной точкой (checkpoint): сначала store.sync() сбрасывает на диск
+сами письма, затем строки журнала дописываются и сбрасываются fsync. Поэтому письмо,
+попавшее в журнал, переживает обрыв процесса или питания, и только такие письма можно
+удалять с сервера (DELE).
+
+После обрыва сессии следующая сессия не скачивает письма из журнала заново: в режиме
+удаления она сразу отправляет для них DELE, в режиме leave_on_server переносит их в
+состояние учетной записи. Записи убираются из журнала (forget), когда они больше не нужны.
+"""
+
+# контрольная точка после стольких писем или байт, сохраненных с прошлой точки
+checkpoint_messages = 32
+checkpoint_bytes = 16 * 2 ** 20
+
+
+class SyncJournal:
+    """
+    Класс журнала синхронизации учетной записи.
+    Атрибуты класса:
+    path - путь к файлу журнала;
+    entries - надежно сохраненные письма {UIDL: сведения о письме}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.__pending = []
+        self.__pending_bytes = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.__file = open(path, 'a+b')
+        self.__load()
+
+    def __load(self):
+        """
+        Прочитать журнал; недописанная при обрыве последняя строка отбрасывается
+        """
+        self.__file.seek(0)
+        position = 0
+        for line in self.__file:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            self.entries[record['uidl']] = record['info']
+            position += len(line)
+        self.__file.truncate(position)
+        self.__file.seek(position)
+
+    def record(self, uidl, info):
+        """
+        Запомнить сохраненное письмо; в журнал на диске оно попадет на следующей контрольной точке
+
+        :param info: сведения о письме (JSON), в том числе size - размер письма
+        """
+        self.__pending.append((uidl, info))
+        self.__pending_bytes += info.get('size', 0)
+
+    def checkpoint_due(self):
+        return len(self.__pending) >= checkpoint_messages or self.__pending_bytes >= checkpoint_bytes
+
+    def checkpoint(self, store):
+        """
+        Надежно сохранить письма и их записи журнала
+
+        :param store: хранилище, в которое записаны письма (message_store)
+        :return: UIDL писем, которые стали надежно сохраненными
+        """
+        if not self.__pending:
+            return []
+        store.sync()
+        self.__file.write(b''.join(json.dumps({'uidl': uidl, 'info': info}).encode('utf-8') + b'\n'
+                                   for uidl, info in self.__pending))
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        durable = [uidl for uidl, _ in self.__pending]
+        self.entries.update(self.__pending)
+        self.__pending = []
+        self.__pending_bytes = 0
+        return durable
+
+    def forget(self, uidls):
+        """
+        Убрать письма из журнала (удалены с сервера или перенесены в состояние учетной записи).
+        Можно вызывать и после close
+        """
+        uidls = [uidl for uidl in uidls if uidl in self.entries]
+        if not uidls:
+            return
+        for uidl in uidls:
+            del self.entries[uidl]
+        # журнал переписывается целиком во временный файл и подменяется
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(b''.join(json.dumps({'uidl': uidl, 'info': info}).encode('utf-8') + b'\n'
+                                    for uidl, info in self.entries.items()))
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, self.path)
+        fsync_dir(os.path.dirname(self.path) or '.')
+        if not self.__file.closed:
+            self.__file.close()
+            self.__file = open(self.path, 'a+b')
+
+    def close(self):
+        self.__file.close()
@@ -0,0 +1,278 @@
+import heapq
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pop_client as pop
+from metrics import registry as metrics
+
+"""
+Планировщик синхронизации нескольких почтовых ящиков.
+Каждая учетная запись опрашивается со своим интервалом, синхронизации выполняются
+параллельно в ограниченном пуле потоков, число одновременных подключений к одному
+серверу ограничено, а после ошибок следующая попытка откладывается с экспоненциально
+растущей задержкой со случайным разбросом.
+
+Запуск из командной строки:
+python sync_scheduler.py accounts.json [metrics.prom]
+где accounts.json - список объектов с полями name, pop_host, pop_port, login, password
+и необязательными poll_interval, messages_dir и параметрами POPClient в client_options.
+Если задан второй аргумент, в этот файл периодически пишется снимок метрик (metrics.py).
+"""
+
+
+class AccountConfig:
+    """
+    Класс настроек одной учетной записи.
+    Атрибуты класса:
+    name - уникальное имя учетной записи;
+    pop_host, pop_port, login, password - параметры подключения к POP3 серверу;
+    poll_interval - интервал опроса в секундах;
+    messages_dir - каталог писем учетной записи (по умолчанию - общий каталог POPClient);
+    client_options - дополнительные параметры конструктора POPClient
+    """
+
+    def __init__(self, name, pop_host, pop_port, login, password, poll_interval=300, messages_dir=None,
+                 client_options=None):
+        self.name = name
+        self.pop_host = pop_host
+        self.pop_port = int(pop_port)
+        self.login = login
+        self.password = password
+        self.poll_interval = poll_interval
+        self.messages_dir = messages_dir
+        self.client_options = client_options or {}
+
+    def create_client(self):
+        client = pop.POPClient(self.pop_host, self.pop_port, self.login, self.password, **self.client_options)
+        if self.messages_dir:
+            client.messages_dir = self.messages_dir
+        return client
+
+
+class AccountStatus:
+    """
+    Класс состояния синхронизации учетной записи
+    """
+
+    def __init__(self):
+        self.last_sync = None
+        self.last_duration = None
+        self.last_error = None
+        self.messages = 0
+        self.messages_per_second = 0.0
+        self.syncs = 0
+        self.error_count = 0
+        self.consecutive_errors = 0
+        self.next_sync = None
+        self.running = False
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class SyncScheduler:
+    """
+    Класс планировщика синхронизации.
+    Атрибуты класса:
+    max_workers - размер пула потоков синхронизации;
+    max_connections_per_host - ограничение одновременных сессий на один сервер;
+    base_backoff, max_backoff - начальная и максимальная задержка повтора после ошибки в секундах
+    """
+
+    def __init__(self, accounts=(), max_workers=4, max_connections_per_host=2, base_backoff=30, max_backoff=3600):
+        self.max_workers = max_workers
+        self.max_connections_per_host = max_connections_per_host
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.__accounts = {}
+        self.__status = {}
+        # очередь запусков: (время запуска, метка, имя учетной записи); у учетной записи действует
+        # только запуск с последней выданной меткой, остальные записи очереди устарели и пропускаются
+        self.__queue = []
+        self.__tokens = {}
+        self.__next_token = itertools.count()
+        self.__active_per_host = defaultdict(int)
+        # учетные записи, ждущие свободного подключения к серверу, в порядке очереди
+        self.__waiting_per_host = defaultdict(deque)
+        self.__condition = threading.Condition()
+        self.__executor = None
+        self.__thread = None
+        self.__stopped = threading.Event()
+        for account in accounts:
+            self.add_account(account)
+
+    def add_account(self, account, start_at=None):
+        """
+        Добавить учетную запись в расписание
+
+        :param account: объект AccountConfig
+        :param start_at: время первого запуска (time.monotonic()), по умолчанию - сразу
+        """
+        with self.__condition:
+            self.__accounts[account.name] = account
+            self.__status.setdefault(account.name, AccountStatus())
+            self.__schedule(account.name, time.monotonic() if start_at is None else start_at)
+
+    def remove_account(self, name):
+        with self.__condition:
+            self.__accounts.pop(name, None)
+            self.__status.pop(name, None)
+            self.__tokens.pop(name, None)
+
+    def sync_now(self, name):
+        """
+        Запустить синхронизацию учетной записи вне расписания (вместо запланированного запуска)
+        """
+        with self.__condition:
+            self.__schedule(name, time.monotonic())
+
+    def __schedule(self, name, when):
+        """
+        Назначить следующий запуск учетной записи; прежний запуск из очереди отменяется
+        """
+        if name not in self.__accounts:
+            return
+        token = next(self.__next_token)
+        self.__tokens[name] = token
+        heapq.heappush(self.__queue, (when, token, name))
+        self.__status[name].next_sync = time.time() + (when - time.monotonic())
+        self.__condition.notify()
+
+    def backoff_delay(self, consecutive_errors):
+        """
+        Задержка перед повтором после серии ошибок: экспоненциальный рост с разбросом 50-100%,
+        чтобы ящики на одном сервере не повторяли попытки одновременно
+        """
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (consecutive_errors - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def start(self):
+        self.__stopped.clear()
+        self.__executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='pop-sync')
+        self.__thread = threading.Thread(target=self.__dispatch_loop, name='sync-scheduler', daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self, wait=True):
+        """
+        Остановить планировщик. Уже идущие синхронизации дорабатывают до конца
+        """
+        self.__stopped.set()
+        with self.__condition:
+            self.__condition.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=wait)
+
+    def __dispatch_loop(self):
+        while not self.__stopped.is_set():
+            with self.__condition:
+                if not self.__queue:
+                    self.__condition.wait()
+                    continue
+                when, token, name = self.__queue[0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    self.__condition.wait(delay)
+                    continue
+                heapq.heappop(self.__queue)
+                if self.__tokens.get(name) != token:
+                    # запуск отменен: назначен другой или учетная запись удалена
+                    continue
+                account = self.__accounts.get(name)
+                status = self.__status.get(name)
+                if account is None or status.running:
+                    # учетная запись удалена или уже синхронизируется - следующий запуск запланирует воркер
+                    continue
+                if self.__active_per_host[account.pop_host] >= self.max_connections_per_host:
+                    # сервер занят другими ящиками - ждем освобождения подключения
+                    if name not in self.__waiting_per_host[account.pop_host]:
+                        self.__waiting_per_host[account.pop_host].append(name)
+                    continue
+                self.__active_per_host[account.pop_host] += 1
+                status.running = True
+                status.next_sync = None
+            self.__executor.submit(self.__sync_account, account, status)
+
+    def __sync_account(self, account, status):
+        start = time.monotonic()
+        error = None
+        client = None
+        try:
+            client = account.create_client()
+            client.get_messages()
+            error = client.last_error
+        except Exception as e:
+            error = e
+            print(traceback.format_exc())
+        duration = time.monotonic() - start
+
+        with self.__condition:
+            self.__active_per_host[account.pop_host] -= 1
+            waiting = self.__waiting_per_host[account.pop_host]
+            if waiting:
+                # освободившееся подключение отдаем ящику, который ждет дольше всех
+                self.__schedule(waiting.popleft(), time.monotonic())
+            if self.__status.get(account.name) is not status:
+                # учетную запись удалили (или удалили и добавили заново) во время синхронизации:
+                # ее расписанием и состоянием уже управляет новая запись
+                return
+            status.running = False
+            status.syncs += 1
+            status.last_sync = time.time()
+            status.last_duration = duration
+            if error is None:
+                status.last_error = None
+                status.consecutive_errors = 0
+                status.messages += client.downloaded
+                status.messages_per_second = client.downloaded / duration if duration else 0.0
+                delay = account.poll_interval
+            else:
+                status.last_error = f"{type(error).__name__}: {error}"
+                status.error_count += 1
+                status.consecutive_errors += 1
+                delay = self.backoff_delay(status.consecutive_errors)
+            if not self.__stopped.is_set():
+                self.__schedule(account.name, time.monotonic() + delay)
+
+    def status(self):
+        """
+        Состояние всех учетных записей
+
+        :return: словарь {имя учетной записи: словарь с полями last_sync, last_duration, last_error,
+            messages, messages_per_second, syncs, error_count, consecutive_errors, next_sync, running}
+        """
+        with self.__condition:
+            return {name: status.as_dict() for name, status in self.__status.items()}
+
+
+def load_accounts(path):
+    with open(path, 'r') as file:
+        return [AccountConfig(**account) for account in json.load(file)]
+
+
+if __name__ == "__main__":
+    # второй аргумент - файл снимка метрик (*.json или формат Prometheus), обновляется раз в 15 секунд
+    metrics_exporter = metrics.start_exporter(sys.argv[2]) if len(sys.argv) > 2 else None
+    scheduler = SyncScheduler(load_accounts(sys.argv[1])).start()
+    try:
+        while True:
+            time.sleep(30)
+            for name, status in scheduler.status().items():
+                print(f"{name}: syncs {status['syncs']}, messages {status['messages']}, "
+                      f"{status['messages_per_second']:.1f} msg/s, errors {status['error_count']}, "
+                      f"last error: {status['last_error']}")
+    except KeyboardInterrupt:
+        print("\nGoodbye!")
+        scheduler.stop()
+        if metrics_exporter is not None:
+            metrics_exporter.set()
+            metrics.write_snapshot(sys.argv[2])
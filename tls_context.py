@@ -0,0 +1,137 @@
+import ssl
+import threading
+import time
+
+"""
+Общие TLS контексты и возобновление TLS сессий для POP3S и STARTTLS.
+На каждый сервер (адрес, порт) создается один настроенный контекст (проверка сертификата
+и имени сервера, TLS не ниже 1.2), а сессия после успешного рукопожатия сохраняется
+и предлагается серверу при следующем подключении. Возобновленное рукопожатие обходится
+без обмена сертификатами и проверки подписи, что заметно на коротких сессиях.
+Время рукопожатий и факт возобновления собираются в статистику.
+"""
+
+
+class TLSStats:
+    """
+    Класс статистики рукопожатий с одним сервером
+    """
+
+    def __init__(self):
+        self.handshakes = 0
+        self.resumed = 0
+        self.total_time = 0.0
+        self.last_time = None
+        self.last_resumed = None
+
+    def as_dict(self):
+        result = dict(self.__dict__)
+        result['average_time'] = self.total_time / self.handshakes if self.handshakes else None
+        return result
+
+
+class TLSContextManager:
+    """
+    Класс менеджера TLS контекстов.
+    Атрибуты класса:
+    verify - проверять сертификат и имя сервера;
+    cafile - файл корневых сертификатов (по умолчанию - системные)
+    """
+
+    def __init__(self, verify=True, cafile=None):
+        self.verify = verify
+        self.cafile = cafile
+        self.__contexts = {}
+        self.__sessions = {}
+        self.__stats = {}
+        self.__lock = threading.Lock()
+
+    def configure(self, verify=True, cafile=None):
+        """
+        Изменить настройки проверки сертификатов. Созданные контексты и сессии сбрасываются
+        """
+        with self.__lock:
+            self.verify = verify
+            self.cafile = cafile
+            self.__contexts.clear()
+            self.__sessions.clear()
+
+    def context(self, server_host, server_port):
+        """
+        Контекст для сервера (создается при первом обращении)
+        """
+        key = (server_host, server_port)
+        with self.__lock:
+            context = self.__contexts.get(key)
+            if context is None:
+                context = ssl.create_default_context(cafile=self.cafile)
+                context.minimum_version = ssl.TLSVersion.TLSv1_2
+                if not self.verify:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                self.__contexts[key] = context
+            return context
+
+    def session(self, server_host, server_port):
+        """
+        Сохраненная сессия для возобновления или None, если её нет или она истекла
+        """
+        with self.__lock:
+            session = self.__sessions.get((server_host, server_port))
+            if session is not None and session.time + session.timeout < time.time():
+                del self.__sessions[(server_host, server_port)]
+                return None
+            return session
+
+    def save_session(self, ssl_sock, server_host, server_port):
+        """
+        Запомнить сессию соединения для следующих подключений.
+        В TLS 1.3 билет сессии приходит после рукопожатия, поэтому вызывать стоит
+        после получения первого ответа сервера
+        """
+        session = ssl_sock.session
+        if session is None:
+            return
+        with self.__lock:
+            # сессия без билета не заменяет уже сохраненную
+            if session.has_ticket or (server_host, server_port) not in self.__sessions:
+                self.__sessions[(server_host, server_port)] = session
+
+    def record(self, server_host, server_port, elapsed, resumed):
+        """
+        Учесть рукопожатие в статистике
+        """
+        with self.__lock:
+            stats = self.__stats.setdefault(f"{server_host}:{server_port}", TLSStats())
+            stats.handshakes += 1
+            stats.resumed += 1 if resumed else 0
+            stats.total_time += elapsed
+            stats.last_time = elapsed
+            stats.last_resumed = resumed
+
+    def wrap_socket(self, sock, server_host, server_port):
+        """
+        Выполнить TLS рукопожатие на подключенном сокете, предложив сохраненную сессию
+
+        :return: TLS сокет
+        """
+        context = self.context(server_host, server_port)
+        session = self.session(server_host, server_port)
+        start = time.perf_counter()
+        ssl_sock = context.wrap_socket(sock, server_hostname=server_host, session=session)
+        self.record(server_host, server_port, time.perf_counter() - start, ssl_sock.session_reused)
+        return ssl_sock
+
+    def stats(self):
+        """
+        Статистика рукопожатий
+
+        :return: словарь {"адрес:порт": словарь с полями handshakes, resumed, total_time,
+            average_time, last_time, last_resumed}
+        """
+        with self.__lock:
+            return {server: stats.as_dict() for server, stats in self.__stats.items()}
+
+
+# контексты и сессии, общие для всех клиентов процесса
+contexts = TLSContextManager()